@@ -7,10 +7,65 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cropmate.settings')
 
-application = get_asgi_application()
+
+class CancelOnDisconnect:
+    """
+    Cancel the request when the client goes away.
+
+    Django 4.2 stops listening to the connection once it has read the request
+    body, so an async view keeps waiting on Open-Meteo or Groq for a client
+    that has already left. This watches for http.disconnect after the body
+    and cancels the view's task, which also cancels its upstream calls.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        body_read = asyncio.Event()
+        disconnected = asyncio.Event()
+
+        async def app_receive():
+            if body_read.is_set():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+            message = await receive()
+            if message['type'] != 'http.request' or not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        app_task = asyncio.ensure_future(self.app(scope, app_receive, send))
+        body_wait = asyncio.ensure_future(body_read.wait())
+        await asyncio.wait({app_task, body_wait}, return_when=asyncio.FIRST_COMPLETED)
+        body_wait.cancel()
+        if app_task.done():
+            return app_task.result()
+
+        watch = asyncio.ensure_future(receive())
+        await asyncio.wait({app_task, watch}, return_when=asyncio.FIRST_COMPLETED)
+        if app_task.done():
+            watch.cancel()
+            return app_task.result()
+
+        if watch.result()['type'] == 'http.disconnect':
+            disconnected.set()
+            app_task.cancel()
+            try:
+                await app_task
+            except asyncio.CancelledError:
+                pass
+        else:
+            await app_task
+
+
+application = CancelOnDisconnect(get_asgi_application())
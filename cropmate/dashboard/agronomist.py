@@ -0,0 +1,401 @@
+"""
+Agronomist chat service.
+
+One AgronomistService per process wraps a chat backend: GroqBackend keeps a
+single pooled client for blocking calls, which WSGI requests use, and one
+AsyncGroq per event loop for ASGI (sharing dashboard.http_client's
+connection pool); FakeBackend answers offline for tests and local
+development. The service owns the system
+prompt, the request timeout and a limit on concurrent completions. Choose the
+backend with CROPMATE_AGRONOMIST['BACKEND'].
+
+Conversations are stored per user. Each question is sent with the most
+recent turns that fit in CONTEXT_TOKENS (at most HISTORY_TURNS turns); the
+questions of older turns are kept as a short summary note instead.
+is_follow_up() tells questions that lean on those turns ("what about
+its pests?") from ones that stand on their own.
+"""
+import asyncio
+import re
+import threading
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+from groq import AsyncGroq, Groq
+
+from . import http_client
+from .models import ChatMessage, Conversation
+
+SYSTEM_PROMPT = """You are a professional agronomist. Your only role is to give clear, practical, agriculture-focused advice. Always answer directly, briefly, and to the point. Do not give generic suggestions such as “contact your local expert,” “seek local advice,” or “consult professionals.” Provide the best possible farming guidance using your own knowledge.
+
+You must stay strictly on farming topics: crops, soil health, fertilizers, irrigation, pests, climate, yield improvement, and farm management. When the user goes off-topic, politely redirect them back to agriculture.
+
+Your responses must follow these rules:
+
+Short and concise
+
+Contains only the essential information
+
+Always relevant to farming
+
+Friendly and professional
+
+No emojis or decorative symbols
+
+No unnecessary storytelling, small talk, or disclaimers
+
+Do not refer the user to local offices or third-party experts
+
+Examples
+
+User: How can you help me?
+Assistant: I can help you with crop advice, soil improvement, fertilizer planning, pest control, irrigation methods, and practical steps to improve your farm. Tell me what crop or issue you want to focus on.
+
+User: What fertilizer should I use for wheat?
+Assistant: Apply a balanced NPK, typically around 60–80 kg nitrogen, 30–40 kg phosphorus, and 20–25 kg potassium per hectare. Adjust based on soil tests.
+
+User: Tell me a story.
+Assistant: I focus on farming topics. If you want, I can explain how a farmer improves soil health or increases yield."""
+
+SYSTEM_MESSAGE = {'role': 'system', 'content': SYSTEM_PROMPT}
+
+DEFAULTS = {
+    'BACKEND': 'dashboard.agronomist.GroqBackend',
+    'API_KEY': None,
+    'MODEL': 'llama-3.1-8b-instant',
+    'TEMPERATURE': 0.8,
+    'MAX_TOKENS': 200,
+    'TIMEOUT': 30,
+    'MAX_CONCURRENCY': 50,
+    'HISTORY_TURNS': 6,
+    'CONTEXT_TOKENS': 1000,
+    'SUMMARY_TOKENS': 200,
+}
+
+
+# Words that point back at something said earlier in the conversation
+REFERENCE_WORDS = frozenset([
+    'it', 'its', 'itself', 'this', 'that', 'these', 'those', 'they', 'them', 'their', 'theirs',
+    'he', 'she', 'him', 'her', 'one', 'ones', 'above', 'earlier', 'previous', 'before', 'again',
+    'else', 'also', 'instead', 'same', 'more', 'said', 'mentioned', 'you', 'your',
+])
+
+# ...and openers that continue the previous question ("and for rice?")
+FOLLOW_UP_OPENERS = ('and ', 'but ', 'so ', 'then ', 'or ', 'what about ', 'how about ', 'what if ')
+
+_word_re = re.compile(r"[a-z]+")
+
+
+class AgronomistUnavailable(Exception):
+    """No completion slot freed up within the service timeout."""
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'CROPMATE_AGRONOMIST', {}))
+    return config
+
+
+class GroqBackend:
+
+    def __init__(self, config):
+        if not config['API_KEY']:
+            raise ImproperlyConfigured('GroqBackend needs CROPMATE_AGRONOMIST API_KEY (set GROQ_API_KEY)')
+        self.api_key = config['API_KEY']
+        self.timeout = config['TIMEOUT']
+        self.options = {
+            'model': config['MODEL'],
+            'temperature': config['TEMPERATURE'],
+            'max_tokens': config['MAX_TOKENS'],
+        }
+        self._client = None
+        self._lock = threading.Lock()
+        # AsyncGroq wraps an httpx.AsyncClient, which is bound to the event loop it was created on
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    http = http_client.get_config()
+                    self._client = Groq(
+                        api_key=self.api_key,
+                        http_client=httpx.Client(
+                            limits=httpx.Limits(max_keepalive_connections=http['POOL_MAXSIZE']),
+                            timeout=httpx.Timeout(http['READ_TIMEOUT'], connect=http['CONNECT_TIMEOUT']),
+                        ),
+                        timeout=self.timeout,
+                    )
+        return self._client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = AsyncGroq(
+                api_key=self.api_key,
+                http_client=http_client.client.async_client(),
+                timeout=self.timeout,
+            )
+        return client
+
+    def complete(self, messages):
+        completion = self.client().chat.completions.create(messages=messages, **self.options)
+        return completion.choices[0].message.content
+
+    async def acomplete(self, messages):
+        completion = await self.async_client().chat.completions.create(messages=messages, **self.options)
+        return completion.choices[0].message.content
+
+    async def astream(self, messages):
+        stream = await self.async_client().chat.completions.create(messages=messages, stream=True, **self.options)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Give the pooled connection back even if the client stopped reading
+            await stream.response.aclose()
+
+    def stream(self, messages):
+        stream = self.client().chat.completions.create(messages=messages, stream=True, **self.options)
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.response.close()
+
+
+class FakeBackend:
+    """
+    Offline backend. Replies with config['FAKE_REPLY'] (formatted with the
+    question) streamed word by word, waiting config['FAKE_DELAY'] seconds
+    before each word.
+    """
+
+    def __init__(self, config):
+        self.reply = config.get('FAKE_REPLY', 'Offline answer to: {question}')
+        self.delay = config.get('FAKE_DELAY', 0.0)
+
+    def _words(self, messages):
+        text = self.reply.format(question=messages[-1]['content'])
+        words = text.split(' ')
+        return [word if i == 0 else ' ' + word for i, word in enumerate(words)]
+
+    def complete(self, messages):
+        time.sleep(self.delay * len(self._words(messages)))
+        return ''.join(self._words(messages))
+
+    async def acomplete(self, messages):
+        await asyncio.sleep(self.delay * len(self._words(messages)))
+        return ''.join(self._words(messages))
+
+    async def astream(self, messages):
+        for word in self._words(messages):
+            await asyncio.sleep(self.delay)
+            yield word
+
+    def stream(self, messages):
+        for word in self._words(messages):
+            time.sleep(self.delay)
+            yield word
+
+
+class AgronomistService:
+
+    def __init__(self, backend, timeout=30, max_concurrency=50):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._async_slots = weakref.WeakKeyDictionary()
+
+    def messages(self, user_message, context=()):
+        return [SYSTEM_MESSAGE, *context, {'role': 'user', 'content': user_message}]
+
+    def _async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_slots.get(loop)
+        if semaphore is None:
+            semaphore = self._async_slots[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def _acquire(self):
+        semaphore = self._async_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise AgronomistUnavailable('Too many agronomist requests in flight')
+        return semaphore
+
+    async def acomplete(self, user_message, context=()):
+        semaphore = await self._acquire()
+        try:
+            return await asyncio.wait_for(self.backend.acomplete(self.messages(user_message, context)), self.timeout)
+        finally:
+            semaphore.release()
+
+    async def astream(self, user_message, context=()):
+        """Yield the answer's text as it is generated."""
+        semaphore = await self._acquire()
+        try:
+            async for text in self.backend.astream(self.messages(user_message, context)):
+                yield text
+        finally:
+            semaphore.release()
+
+    def _acquire_slot(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise AgronomistUnavailable('Too many agronomist requests in flight')
+
+    def complete(self, user_message, context=()):
+        """Blocking acomplete(), for WSGI."""
+        self._acquire_slot()
+        try:
+            return self.backend.complete(self.messages(user_message, context))
+        finally:
+            self._slots.release()
+
+    def stream(self, user_message, context=()):
+        """Blocking astream(), for WSGI."""
+        self._acquire_slot()
+        try:
+            yield from self.backend.stream(self.messages(user_message, context))
+        finally:
+            self._slots.release()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                config = get_config()
+                backend = import_string(config['BACKEND'])(config)
+                _service = AgronomistService(backend, config['TIMEOUT'], config['MAX_CONCURRENCY'])
+    return _service
+
+
+def estimate_tokens(text):
+    """Rough token count: about four characters per token for English text."""
+    return max(1, (len(text) + 3) // 4)
+
+
+def truncate_tokens(text, tokens):
+    limit = tokens * 4
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + '...'
+
+
+def fold_summary(summary, questions, budget):
+    """Append earlier questions to the summary, keeping the newest lines that fit in `budget` tokens."""
+    lines = [line for line in summary.split('\n') if line]
+    lines += [truncate_tokens(' '.join(question.split()), 40) for question in questions]
+    kept, used = [], 0
+    for line in reversed(lines):
+        used += estimate_tokens(line)
+        if used > budget:
+            break
+        kept.append(line)
+    return '\n'.join(reversed(kept))
+
+
+def build_context(summary, history, budget, summary_budget):
+    """
+    Messages to send ahead of a new question. `history` is the recent turns
+    as (role, content, tokens), oldest first; the newest ones that fit in
+    `budget` tokens are kept verbatim, the questions of the rest are folded
+    into the summary note.
+    """
+    kept, used = [], 0
+    for role, content, tokens in reversed(history):
+        used += tokens
+        if used > budget:
+            break
+        kept.append((role, content))
+    kept.reverse()
+    # Never open the window on an answer whose question was cut off
+    while kept and kept[0][0] != 'user':
+        kept.pop(0)
+
+    dropped = history[:len(history) - len(kept)]
+    summary = fold_summary(summary, [content for role, content, _ in dropped if role == 'user'], summary_budget)
+
+    messages = []
+    if summary:
+        messages.append({'role': 'system', 'content': 'Earlier in this conversation the farmer asked:\n' + summary})
+    messages.extend({'role': role, 'content': content} for role, content in kept)
+    return messages
+
+
+def is_follow_up(question):
+    """
+    Whether `question` needs the earlier turns to make sense: it uses a word
+    that refers back, opens as a continuation, or is too short ("why?",
+    "how much") to stand alone.
+    """
+    words = _word_re.findall(question.lower())
+    return (
+        len(words) < 3
+        or not REFERENCE_WORDS.isdisjoint(words)
+        or (' '.join(words) + ' ').startswith(FOLLOW_UP_OPENERS)
+    )
+
+
+def load_conversation(user):
+    """Return the user's current conversation (or None) and the context to send with the next question."""
+    config = get_config()
+    conversation = Conversation.objects.filter(user=user).first()
+    if conversation is None:
+        return None, []
+    recent = list(
+        conversation.messages.order_by('-id')
+        .values_list('role', 'content', 'token_count')[:config['HISTORY_TURNS'] * 2]
+    )
+    recent.reverse()
+    return conversation, build_context(
+        conversation.summary, recent, config['CONTEXT_TOKENS'], config['SUMMARY_TOKENS'],
+    )
+
+
+def record_turn(user, conversation, question, answer):
+    """Store a question and its answer, folding the turn that left the window into the summary."""
+    config = get_config()
+    with transaction.atomic():
+        if conversation is None:
+            conversation = Conversation.objects.create(user=user)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(conversation=conversation, role='user', content=question,
+                        token_count=estimate_tokens(question)),
+            ChatMessage(conversation=conversation, role='assistant', content=answer,
+                        token_count=estimate_tokens(answer)),
+        ])
+        window = config['HISTORY_TURNS'] * 2
+        evicted = conversation.messages.order_by('-id').values_list('role', 'content')[window:window + 2]
+        questions = [content for role, content in evicted if role == 'user']
+        conversation.summary = fold_summary(conversation.summary, questions, config['SUMMARY_TOKENS'])
+        conversation.save(update_fields=['summary', 'updated_at'])
+    return conversation
+
+
+def start_conversation(user):
+    return Conversation.objects.create(user=user)
+
+
+def recent_messages(user, limit=50):
+    """The current conversation's last `limit` messages, oldest first, for display."""
+    conversation = Conversation.objects.filter(user=user).first()
+    if conversation is None:
+        return []
+    messages = list(conversation.messages.order_by('-id').values('role', 'content')[:limit])
+    messages.reverse()
+    return messages
@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class DashboardConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dashboard'
+
+    def ready(self):
+        from .db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='dashboard.configure_sqlite')
+
+        # Warm the crop pipeline in each worker so the first request doesn't pay for unpickling
+        if getattr(settings, 'CROPMATE_PRELOAD_MODELS', False):
+            from .crop_model import registry
+            registry.get_pipeline()
+
+        # Without a shared cache a prefetch_weather process can't reach this worker, so refresh in-process
+        if getattr(settings, 'CROPMATE_WEATHER_CACHE', {}).get('PREFETCH_INTERVAL'):
+            from . import weather
+            weather.start_prefetcher()
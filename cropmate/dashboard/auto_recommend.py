@@ -0,0 +1,186 @@
+"""
+Crop recommendations generated from sensor readings.
+
+Ingestion calls notify() once its batch commits. A background worker waits
+BATCH_DELAY seconds so bursts from many devices land in one run, then picks
+every device with readings newer than its last recommendation (at most once
+per MIN_INTERVAL), joins its latest nitrogen, phosphorus, potassium,
+temperature and humidity with the device's soil pH and the weekly rainfall
+of its city's cached forecast, and runs the classifier once over the whole
+batch. Results are stored as CropRecommendation rows linked to the device.
+
+Deployments with several worker processes can set ENABLED to False and run
+the recommend_from_sensors command on a schedule instead.
+"""
+import datetime
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from . import weather
+from .crop_model import FEATURE_NAMES, get_pipeline, rows_to_matrix, validate_features
+from .models import CropRecommendation, SensorDevice, SensorReading
+
+logger = logging.getLogger(__name__)
+
+SOIL_METRICS = ['nitrogen', 'phosphorus', 'potassium', 'temperature', 'humidity']
+
+DEFAULTS = {
+    'ENABLED': True,
+    'BATCH_DELAY': 5,
+    'MIN_INTERVAL': 900,
+    'MAX_READING_AGE': 86400,
+    'MAX_BATCH': 500,
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'CROPMATE_AUTO_RECOMMEND', {}))
+    return config
+
+
+def _latest(metric, since):
+    # Walks the (device, timestamp) index backwards and stops at the first reading with the metric
+    readings = SensorReading.objects.filter(
+        device=OuterRef('pk'), timestamp__gte=since, **{f'{metric}__isnull': False}
+    )
+    return Subquery(readings.order_by('-timestamp').values(metric)[:1])
+
+
+def changed_devices(now, config):
+    """Devices with new readings that are due a recommendation and have a city and soil pH."""
+    never = Q(recommended_at__isnull=True)
+    due = never | Q(recommended_at__lte=now - datetime.timedelta(seconds=config['MIN_INTERVAL']))
+    changed = never | Q(last_seen_at__gt=F('recommended_at'))
+    return (
+        SensorDevice.objects
+        .filter(due, changed, last_seen_at__isnull=False, soil_ph__isnull=False)
+        .exclude(city='')
+        .order_by('pk')
+    )
+
+
+def rainfall_by_city(cities):
+    """Weekly forecast rainfall per city, served from the shared weather cache."""
+    rainfall = {}
+    for city in cities:
+        try:
+            weather_data, _ = weather.get_weather(city)
+        except KeyError:
+            logger.warning('Sensor devices reference unknown city %r', city)
+            continue
+        except (requests.exceptions.RequestException, weather.WeatherServiceError):
+            logger.warning('No forecast for %s, skipping its devices', city)
+            continue
+        rainfall[city] = weather_data['total_rain_week']
+    return rainfall
+
+
+def _run_batch(now, config, after):
+    since = now - datetime.timedelta(seconds=config['MAX_READING_AGE'])
+    devices = list(
+        changed_devices(now, config)
+        .filter(pk__gt=after)
+        .annotate(**{f'latest_{metric}': _latest(metric, since) for metric in SOIL_METRICS})
+        [:config['MAX_BATCH']]
+    )
+    if not devices:
+        return [], []
+
+    rainfall = rainfall_by_city({device.city for device in devices})
+    rows = []
+    for device in devices:
+        row = {metric: getattr(device, f'latest_{metric}') for metric in SOIL_METRICS}
+        row['ph'] = device.soil_ph
+        row['rainfall'] = rainfall.get(device.city)
+        rows.append(row)
+
+    matrix = rows_to_matrix(rows)
+    valid, errors = validate_features(matrix)
+    for i, messages in errors.items():
+        logger.debug('No recommendation for device %s: %s', devices[i].pk, '; '.join(messages))
+    valid_indices = valid.nonzero()[0]
+    recommendations = get_pipeline().recommend(matrix[valid_indices], k=getattr(settings, 'CROPMATE_TOP_K', 3))
+
+    to_create = []
+    for i, recommendation in zip(valid_indices.tolist(), recommendations):
+        if recommendation['crop'] is None:
+            continue
+        device = devices[i]
+        to_create.append(CropRecommendation(
+            user_id=device.user_id,
+            device=device,
+            recommended_crop=recommendation['crop'],
+            confidence=recommendation['confidence'],
+            **dict(zip(FEATURE_NAMES, matrix[i].tolist()))
+        ))
+
+    with transaction.atomic():
+        CropRecommendation.objects.bulk_create(to_create)
+        # Only devices that got a recommendation wait out MIN_INTERVAL; the rest (no
+        # forecast yet, incomplete readings) are retried on the next run
+        SensorDevice.objects.filter(pk__in=[r.device_id for r in to_create]).update(recommended_at=now)
+    return devices, to_create
+
+
+def recommend_changed(now=None):
+    """Recommend for every changed device, MAX_BATCH at a time. Returns the rows created."""
+    config = get_config()
+    now = now or timezone.now()
+    created = []
+    after = 0
+    while True:
+        # Walk the devices by pk: skipped ones are still "changed" and would be picked again
+        devices, batch = _run_batch(now, config, after)
+        created.extend(batch)
+        if len(devices) < config['MAX_BATCH']:
+            return created
+        after = devices[-1].pk
+
+
+class Worker:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = False
+
+    def notify(self):
+        if not get_config()['ENABLED']:
+            return
+        with self._lock:
+            self._pending = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='auto-recommend', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(get_config()['BATCH_DELAY'])
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+            try:
+                created = recommend_changed()
+                if created:
+                    logger.info('Stored %d sensor-based recommendations', len(created))
+            except Exception:
+                logger.exception('Automatic recommendation batch failed')
+            finally:
+                close_old_connections()
+
+
+worker = Worker()
+
+
+def notify():
+    worker.notify()
@@ -0,0 +1,32 @@
+"""
+SQLite backend that can start transactions with BEGIN IMMEDIATE.
+
+A plain (deferred) BEGIN only takes the write lock at the transaction's
+first write. If another connection has written in the meantime SQLite
+can't wait for it without risking a deadlock, so it fails straight away
+with "database is locked" and the busy timeout never applies. With
+OPTIONS['transaction_mode'] = 'IMMEDIATE' the lock is taken up front and
+concurrent writers queue on the busy timeout instead. Django 5.1 ships the
+same option; this backports it to 4.2.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        mode = params.pop('transaction_mode', None)
+        if mode is not None and mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(f"transaction_mode must be one of {', '.join(TRANSACTION_MODES)}")
+        self.transaction_mode = mode.upper() if mode else None
+        return params
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
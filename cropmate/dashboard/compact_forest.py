@@ -0,0 +1,160 @@
+"""
+Array-backed random forest format for the crop classifier.
+
+The fitted sklearn RandomForestClassifier is flattened into a handful of
+plain .npy files (one node table shared by all trees). They are loaded with
+mmap_mode='r' so every worker process maps the same physical pages instead
+of holding its own unpickled copy, and prediction reproduces sklearn's
+arithmetic exactly: float32 inputs, float64 thresholds, per-tree normalised
+leaf probabilities summed in estimator order.
+"""
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+ARRAY_NAMES = ['feature', 'threshold', 'children', 'leaf', 'leaf_proba', 'roots', 'classes']
+
+
+def export_forest(model, directory, source_sha256=None):
+    """
+    Flatten a fitted RandomForestClassifier into `directory`. Returns the
+    metadata dict, which records `source_sha256` (the digest of the pickle the
+    model came from) when given.
+    """
+    if getattr(model, 'n_outputs_', 1) != 1:
+        raise ValueError('Only single-output classifiers can be exported')
+
+    n_classes = len(model.classes_)
+    features, thresholds, children, leaves, probas, roots = [], [], [], [], [], []
+    offset = 0
+    leaf_offset = 0
+    max_depth = 0
+
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        n = tree.node_count
+        is_leaf = tree.children_left == -1
+        node_ids = np.arange(offset, offset + n, dtype=np.int32)
+
+        features.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+        thresholds.append(np.where(is_leaf, 0.0, tree.threshold).astype(np.float64))
+        # Interleaved (left, right) pairs so a traversal step is a single gather;
+        # leaves point at themselves
+        left = np.where(is_leaf, node_ids, tree.children_left + offset)
+        right = np.where(is_leaf, node_ids, tree.children_right + offset)
+        children.append(np.stack([left, right], axis=1).ravel().astype(np.int32))
+
+        leaf_ids = np.full(n, -1, dtype=np.int32)
+        leaf_ids[is_leaf] = np.arange(leaf_offset, leaf_offset + is_leaf.sum(), dtype=np.int32)
+        leaves.append(leaf_ids)
+
+        # Same normalisation as DecisionTreeClassifier.predict_proba
+        proba = tree.value[is_leaf][:, 0, :n_classes]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        probas.append(proba / normalizer)
+
+        roots.append(offset)
+        offset += n
+        leaf_offset += int(is_leaf.sum())
+        max_depth = max(max_depth, tree.max_depth)
+
+    arrays = {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'children': np.concatenate(children),
+        'leaf': np.concatenate(leaves),
+        'leaf_proba': np.ascontiguousarray(np.concatenate(probas)),
+        'roots': np.asarray(roots, dtype=np.int32),
+        'classes': np.asarray(model.classes_),
+    }
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'n_features': int(model.n_features_in_),
+        'n_classes': n_classes,
+        'n_trees': len(model.estimators_),
+        'n_nodes': offset,
+        'n_leaves': leaf_offset,
+        'max_depth': int(max_depth),
+    }
+    if source_sha256:
+        meta['source_sha256'] = source_sha256
+
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        tmp_path = os.path.join(directory, f'.{name}.npy.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, os.path.join(directory, f'{name}.npy'))
+
+    # meta.json is written last: its presence marks a complete export
+    tmp_path = os.path.join(directory, '.meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+    return meta
+
+
+def artifact_exists(directory):
+    return os.path.exists(os.path.join(directory, 'meta.json'))
+
+
+class CompactForest:
+    """
+    Drop-in replacement for the fitted RandomForestClassifier backed by
+    memory-mapped arrays. Exposes classes_, predict() and predict_proba().
+    """
+
+    # Rows traversed at once; bounds the (rows, trees) index matrices
+    chunk_size = 4096
+
+    def __init__(self, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact model format {self.meta.get('format_version')}")
+
+        for name in ARRAY_NAMES:
+            # Plain ndarray views over the mapping avoid np.memmap overhead on every gather
+            array = np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+            setattr(self, '_' + name, np.asarray(array))
+        self.classes_ = self._classes
+        self.n_features_in_ = self.meta['n_features']
+        self._is_leaf = self._leaf >= 0
+
+    def apply(self, X):
+        """Return the global leaf node reached in every tree, shape (n_samples, n_trees)."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_samples, n_features = X.shape
+        n_trees = len(self._roots)
+        flat_X = X.ravel()
+
+        nodes = np.tile(self._roots, n_samples)
+        row_offsets = np.repeat(np.arange(n_samples) * n_features, n_trees)
+        # Only (sample, tree) pairs still sitting on a split node take another step
+        active = np.flatnonzero(~self._is_leaf[nodes])
+        while active.size:
+            current = nodes[active]
+            go_right = ~(flat_X[row_offsets[active] + self._feature[current]] <= self._threshold[current])
+            current = self._children[2 * current + go_right]
+            nodes[active] = current
+            active = active[~self._is_leaf[current]]
+        return nodes.reshape(n_samples, n_trees)
+
+    def predict_proba(self, X):
+        X = np.asarray(X).reshape(-1, self.n_features_in_)
+        proba = np.zeros((len(X), len(self.classes_)))
+        for start in range(0, len(X), self.chunk_size):
+            leaves = self._leaf[self.apply(X[start:start + self.chunk_size])]
+            out = proba[start:start + self.chunk_size]
+            # Accumulate tree by tree, in estimator order, like sklearn does
+            for t in range(leaves.shape[1]):
+                out += self._leaf_proba[leaves[:, t]]
+        proba /= len(self._roots)
+        return proba
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
@@ -0,0 +1,240 @@
+"""
+Precomputed crop lookup grid ("fast mode").
+
+`manage.py build_crop_grid` evaluates the classifier at the centre of every
+cell of a coarse grid over the seven features and stores its top-k labels
+and their probabilities as uint8 arrays with a trailing rank axis. Online
+lookups are plain index arithmetic. Cells next to a decision boundary (a
+neighbour along any axis disagrees on the winner) are stored as 0 and fall
+back to the real model, as does anything outside the grid and any request
+for more alternatives than the grid holds.
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .crop_model import CROP_DICT, FEATURE_NAMES, ML_MODELS_DIR, registry
+
+# Typical ranges of the crop dataset; requests outside them use the model
+DEFAULT_BOUNDS = {
+    'nitrogen': (0, 140),
+    'phosphorus': (5, 145),
+    'potassium': (5, 205),
+    'temperature': (8, 44),
+    'humidity': (14, 100),
+    'ph': (3.5, 10),
+    'rainfall': (20, 300),
+}
+
+DEFAULT_PATH = os.path.join(ML_MODELS_DIR, 'crop_grid.npz')
+
+FALLBACK = 0
+
+
+def grid_axes(bounds, bins):
+    """Cell centres along each feature axis."""
+    axes = []
+    for name, n in zip(FEATURE_NAMES, bins):
+        low, high = bounds[name]
+        width = (high - low) / n
+        axes.append(low + width * (np.arange(n) + 0.5))
+    return axes
+
+
+def mark_boundaries(labels):
+    """Replace cells whose label differs from any axis neighbour with FALLBACK."""
+    boundary = np.zeros(labels.shape, dtype=bool)
+    for axis in range(labels.ndim):
+        differs = np.diff(labels, axis=axis) != 0
+        lower = [slice(None)] * labels.ndim
+        upper = [slice(None)] * labels.ndim
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        boundary[tuple(lower)] |= differs
+        boundary[tuple(upper)] |= differs
+    marked = labels.copy()
+    marked[boundary] = FALLBACK
+    return marked
+
+
+def build_grid(pipeline, bounds, bins, min_confidence=0.0, top_k=1, chunk_size=65536):
+    """
+    Evaluate the pipeline over the grid. Returns (labels, confidence) uint8
+    arrays of shape bins + (top_k,), ranked best first.
+    """
+    axes = grid_axes(bounds, bins)
+    shape = tuple(bins)
+    n_cells = int(np.prod(shape))
+    labels = np.zeros((n_cells, top_k), dtype=np.uint8)
+    confidence = np.zeros((n_cells, top_k), dtype=np.uint8)
+
+    known = np.array([label for label in CROP_DICT if 0 < label < 256])
+
+    for start in range(0, n_cells, chunk_size):
+        stop = min(start + chunk_size, n_cells)
+        index = np.unravel_index(np.arange(start, stop), shape)
+        points = np.stack([axis[i] for axis, i in zip(axes, index)], axis=1)
+        proba = pipeline.model.predict_proba(pipeline.transform(points))
+        # Same ranking as CropPipeline.recommend()
+        ranked = np.argsort(-proba, axis=1, kind='stable')[:, :top_k]
+        label = pipeline.model.classes_.take(ranked, axis=0)
+        score = np.take_along_axis(proba, ranked, axis=1)
+        # A positive probability never rounds down to 0, which marks an absent alternative
+        quantized = np.where(score > 0, np.maximum(np.round(score * 255), 1), 0)
+        usable = np.isin(label, known)
+        labels[start:stop] = np.where(usable, label, FALLBACK)
+        confidence[start:stop] = np.where(usable, quantized, 0)
+        # Cells whose winner is unknown or unsure are answered by the model
+        unsure = ~usable[:, 0] | (score[:, 0] < min_confidence)
+        labels[start:stop][unsure] = FALLBACK
+
+    labels = labels.reshape(shape + (top_k,))
+    confidence = confidence.reshape(shape + (top_k,))
+    fallback = mark_boundaries(labels[..., 0]) == FALLBACK
+    labels[fallback] = FALLBACK
+    confidence[fallback] = 0
+    return labels, confidence
+
+
+class CropGrid:
+
+    def __init__(self, labels, confidence, bounds, meta=None):
+        if labels.ndim == len(FEATURE_NAMES):
+            # Grids built before ranks were stored hold the winner only
+            labels, confidence = labels[..., np.newaxis], confidence[..., np.newaxis]
+        self.labels = labels
+        self.confidence = confidence
+        self.bounds = bounds
+        self.meta = meta or {}
+        self.bins = labels.shape[:-1]
+        self.depth = labels.shape[-1]
+        self._lows = [float(bounds[name][0]) for name in FEATURE_NAMES]
+        self._highs = [float(bounds[name][1]) for name in FEATURE_NAMES]
+        self._scales = [n / (high - low) for n, low, high in zip(self.bins, self._lows, self._highs)]
+        self._strides = [int(np.prod(self.bins[axis + 1:])) for axis in range(len(self.bins))]
+        self._flat_labels = labels[..., 0].ravel().tolist()
+        self._ranked_labels = labels.reshape(-1, self.depth)
+        self._ranked_confidence = confidence.reshape(-1, self.depth)
+
+    def lookup(self, feature_list, k=1):
+        """
+        Return up to k (crop, probability) pairs for one row, best first, or
+        None when the model must be used.
+        """
+        if k > self.depth:
+            return None
+        index = 0
+        for x, low, high, scale, n, stride in zip(
+                feature_list, self._lows, self._highs, self._scales, self.bins, self._strides):
+            if not low <= x <= high:
+                return None
+            i = int((x - low) * scale)
+            index += (i if i < n else n - 1) * stride
+        if self._flat_labels[index] == FALLBACK:
+            return None
+        labels = self._ranked_labels[index, :k].tolist()
+        scores = self._ranked_confidence[index, :k].tolist()
+        return [(CROP_DICT[label], score / 255) for label, score in zip(labels, scores)
+                if label != FALLBACK and score > 0]
+
+    def save(self, path):
+        path = os.fspath(path)
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path,
+            labels=self.labels,
+            confidence=self.confidence,
+            bounds=np.array([self.bounds[name] for name in FEATURE_NAMES], dtype=float),
+            meta=np.array(json.dumps(self.meta)),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            bounds = {name: tuple(row) for name, row in zip(FEATURE_NAMES, data['bounds'].tolist())}
+            meta = json.loads(data['meta'].item())
+            return cls(data['labels'], data['confidence'], bounds, meta)
+
+
+def measure_agreement(grid, pipeline, n_samples=20000, seed=0):
+    """
+    Compare fast mode (grid, falling back to the model) with the real model on
+    random points inside the grid bounds, on the winner and on the full
+    ranking of the grid's depth.
+    """
+    rng = np.random.default_rng(seed)
+    low = [grid.bounds[name][0] for name in FEATURE_NAMES]
+    high = [grid.bounds[name][1] for name in FEATURE_NAMES]
+    points = rng.uniform(low, high, size=(n_samples, len(FEATURE_NAMES)))
+    expected = [[c['crop'] for c in result['top_crops']] for result in pipeline.recommend(points, k=grid.depth)]
+
+    answered = agreed = ranked_agreed = 0
+    for row, crops in zip(points.tolist(), expected):
+        hit = grid.lookup(row, k=grid.depth)
+        if hit is not None:
+            answered += 1
+            agreed += hit[0][0] == crops[0]
+            ranked_agreed += [crop for crop, _ in hit] == crops
+    return {
+        'samples': n_samples,
+        'coverage': answered / n_samples,
+        'grid_agreement': agreed / answered if answered else 1.0,
+        'ranking_agreement': ranked_agreed / answered if answered else 1.0,
+        # Fallbacks are answered by the model itself, so they always agree
+        'overall_agreement': (agreed + n_samples - answered) / n_samples,
+    }
+
+
+class GridLoader:
+    """Lazily loads the grid file and reloads it when it changes on disk."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grid = None
+        self._key = None
+        self._last_check = 0.0
+
+    def get(self):
+        config = getattr(settings, 'CROPMATE_CROP_GRID', {})
+        if not config.get('FAST_MODE', False):
+            return None
+
+        interval = getattr(settings, 'CROPMATE_MODEL_RELOAD_INTERVAL', 2.0)
+        now = time.monotonic()
+        if self._key is not None and (interval is None or now - self._last_check < interval):
+            return self._grid
+
+        with self._lock:
+            path = config.get('PATH', DEFAULT_PATH)
+            try:
+                key = (path, os.stat(path).st_mtime_ns)
+            except OSError:
+                key = (path, None)
+            self._last_check = now
+            if key != self._key:
+                self._grid = CropGrid.load(path) if key[1] is not None else None
+                self._key = key
+            return self._grid
+
+
+loader = GridLoader()
+
+
+def fast_lookup(feature_list, k=1):
+    """
+    Answer with up to k ranked (crop, probability) pairs from the grid when
+    fast mode is on, the grid was built from the model currently loaded and
+    holds at least k ranks; otherwise None.
+    """
+    grid = loader.get()
+    if grid is None:
+        return None
+    registry.get_pipeline()
+    if grid.meta.get('model_fingerprint') != registry.fingerprint:
+        return None
+    return grid.lookup(feature_list, k)
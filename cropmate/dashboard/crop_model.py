@@ -0,0 +1,387 @@
+"""
+Process-wide registry for the crop recommendation pipeline.
+
+The MinMaxScaler -> StandardScaler -> classifier pipeline is unpickled once
+per worker and shared by every request. The pickle files are watched by
+mtime so a redeployed model is picked up without restarting the worker.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+import sys
+
+import numpy as np
+from django.conf import settings
+
+from . import compact_forest
+
+logger = logging.getLogger(__name__)
+
+ML_MODELS_DIR = os.path.join(os.path.dirname(__file__), 'ml_models')
+COMPACT_MODEL_DIRNAME = 'crop_forest'
+
+FEATURE_NAMES = ['nitrogen', 'phosphorus', 'potassium', 'temperature', 'humidity', 'ph', 'rainfall']
+
+# Plausible physical bounds used to reject bad rows in batch uploads
+FEATURE_RANGES = {
+    'nitrogen': (0, 500),
+    'phosphorus': (0, 500),
+    'potassium': (0, 500),
+    'temperature': (-30, 60),
+    'humidity': (0, 100),
+    'ph': (0, 14),
+    'rainfall': (0, 5000),
+}
+
+# Column aliases accepted in uploaded files (the public crop dataset uses N/P/K)
+FEATURE_ALIASES = {'n': 'nitrogen', 'p': 'phosphorus', 'k': 'potassium'}
+
+CROP_DICT = {
+    1: "Rice", 2: "Maize", 3: "Jute", 4: "Cotton", 5: "Coconut",
+    6: "Papaya", 7: "Orange", 8: "Apple", 9: "Muskmelon", 10: "Watermelon",
+    11: "Grapes", 12: "Mango", 13: "Banana", 14: "Pomegranate", 15: "Lentil",
+    16: "Blackgram", 17: "Mungbean", 18: "Mothbeans", 19: "Pigeonpeas",
+    20: "Kidneybeans", 21: "Chickpea", 22: "Coffee"
+}
+
+
+def _estimate_nbytes(obj, seen=None):
+    """Approximate in-memory size of a fitted estimator, dominated by its numpy arrays."""
+    if seen is None:
+        seen = {}
+    if id(obj) in seen:
+        return 0
+    # Keep a reference so temporary objects (e.g. __getstate__ dicts) can't recycle ids
+    seen[id(obj)] = obj
+
+    if isinstance(obj, np.memmap) or isinstance(getattr(obj, 'base', None), np.memmap):
+        # Memory-mapped arrays live in the shared page cache, not in this process
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_estimate_nbytes(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_estimate_nbytes(v, seen) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + _estimate_nbytes(vars(obj), seen)
+    # Cython extension types such as sklearn's Tree expose their arrays through __getstate__
+    state = obj.__getstate__() if hasattr(obj, '__getstate__') else None
+    if isinstance(state, dict):
+        return sys.getsizeof(obj) + _estimate_nbytes(state, seen)
+    return sys.getsizeof(obj)
+
+
+def _to_float(value):
+    if value is None or isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def rows_to_matrix(rows):
+    """
+    Convert rows (dicts keyed by feature name/alias, or 7-item sequences)
+    into an (N, 7) float matrix. Anything missing or unparsable becomes NaN
+    so it can be reported by validate_features() instead of raising.
+    """
+    matrix = np.full((len(rows), len(FEATURE_NAMES)), np.nan)
+    for i, row in enumerate(rows):
+        if isinstance(row, dict):
+            normalized = {}
+            for key, value in row.items():
+                key = str(key).strip().lower()
+                normalized[FEATURE_ALIASES.get(key, key)] = value
+            values = [normalized.get(name) for name in FEATURE_NAMES]
+        elif isinstance(row, (list, tuple)) and len(row) == len(FEATURE_NAMES):
+            values = row
+        else:
+            continue
+        matrix[i] = [_to_float(v) for v in values]
+    return matrix
+
+
+def validate_features(matrix):
+    """
+    Validate every row of an (N, 7) matrix in one vectorized pass.
+
+    Returns a boolean mask of valid rows and a dict mapping the index of each
+    invalid row to a list of error messages.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    low = np.array([FEATURE_RANGES[name][0] for name in FEATURE_NAMES])
+    high = np.array([FEATURE_RANGES[name][1] for name in FEATURE_NAMES])
+
+    missing = ~np.isfinite(matrix)
+    with np.errstate(invalid='ignore'):
+        out_of_range = ~missing & ((matrix < low) | (matrix > high))
+    bad = missing | out_of_range
+    valid = ~bad.any(axis=1)
+
+    errors = {}
+    for i, j in zip(*np.nonzero(bad)):
+        name = FEATURE_NAMES[j]
+        if missing[i, j]:
+            message = f'{name} is missing or not a number'
+        else:
+            message = f'{name} must be between {low[j]:g} and {high[j]:g}'
+        errors.setdefault(int(i), []).append(message)
+    return valid, errors
+
+
+def fuse_scalers(minmax_scaler, standard_scaler):
+    """
+    Compose MinMaxScaler followed by StandardScaler into a single affine map
+    x * a + b. Returns (a, b), or None when the scalers can't be fused
+    (e.g. a clipping MinMaxScaler is not affine).
+    """
+    if getattr(minmax_scaler, 'clip', False):
+        return None
+
+    mean = standard_scaler.mean_ if standard_scaler.with_mean else 0.0
+    scale = standard_scaler.scale_ if standard_scaler.with_std else 1.0
+    a = minmax_scaler.scale_ / scale
+    b = (minmax_scaler.min_ - mean) / scale
+    return np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+
+
+class CropPipeline:
+    """
+    A loaded, ready-to-use crop pipeline. Instances are immutable and shared
+    between threads; a reload swaps in a new instance instead of mutating.
+    """
+
+    def __init__(self, model, standard_scaler, minmax_scaler, version, fuse=True):
+        self.model = model
+        self.sc = standard_scaler
+        self.ms = minmax_scaler
+        self.version = version
+        self.fused = fuse_scalers(minmax_scaler, standard_scaler) if fuse else None
+        if self.fused is not None:
+            self._row_coefficients = list(zip(self.fused[0].tolist(), self.fused[1].tolist()))
+
+    def transform_unfused(self, features):
+        features = np.asarray(features, dtype=float).reshape(-1, len(FEATURE_NAMES))
+        return self.sc.transform(self.ms.transform(features))
+
+    def transform(self, features):
+        if self.fused is None:
+            return self.transform_unfused(features)
+        a, b = self.fused
+        features = np.asarray(features, dtype=float).reshape(-1, len(FEATURE_NAMES))
+        return features * a + b
+
+    def transform_row(self, feature_list):
+        """Scale a single row in pure Python, skipping numpy/sklearn call overhead."""
+        if self.fused is None:
+            return self.transform_unfused(feature_list)
+        return [[x * a + b for x, (a, b) in zip(feature_list, self._row_coefficients)]]
+
+    def predict(self, features):
+        return self.model.predict(self.transform(features))
+
+    def _recommend_scaled(self, scaled, k):
+        if not hasattr(self.model, 'predict_proba'):
+            return [{'crop': CROP_DICT.get(label), 'confidence': None, 'top_crops': []}
+                    for label in self.model.predict(scaled)]
+
+        # One predict_proba pass yields both the label (its argmax, exactly what
+        # predict() returns) and the ranked alternatives
+        proba = self.model.predict_proba(scaled)
+        ranked = np.argsort(-proba, axis=1, kind='stable')[:, :k]
+        labels = self.model.classes_.take(ranked, axis=0)
+        scores = np.take_along_axis(proba, ranked, axis=1)
+
+        results = []
+        for row_labels, row_scores in zip(labels.tolist(), scores.tolist()):
+            top_crops = [{'crop': CROP_DICT.get(label), 'probability': score}
+                         for label, score in zip(row_labels, row_scores)]
+            results.append({
+                'crop': top_crops[0]['crop'],
+                'confidence': top_crops[0]['probability'],
+                'top_crops': [c for c in top_crops if c['crop'] is not None and c['probability'] > 0],
+            })
+        return results
+
+    def recommend(self, matrix, k=3):
+        """
+        Recommend crops for every row of an (N, 7) matrix in one batched call.
+        Each result holds the crop name (None if the label is unknown), its
+        probability as confidence, and up to k ranked alternatives.
+        """
+        if len(matrix) == 0:
+            return []
+        return self._recommend_scaled(self.transform(matrix), k)
+
+    def recommend_one(self, feature_list, k=3):
+        return self._recommend_scaled(self.transform_row(feature_list), k)[0]
+
+
+def check_fused_equivalence(pipeline, points_per_feature=3, tolerance=1e-9):
+    """
+    Compare the fused affine transform against the original two-step sklearn
+    path on a regular grid spanning FEATURE_RANGES.
+    """
+    axes = [np.linspace(*FEATURE_RANGES[name], points_per_feature) for name in FEATURE_NAMES]
+    grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(FEATURE_NAMES))
+
+    if pipeline.fused is None:
+        return {'fused': False, 'points': len(grid), 'equivalent': True}
+
+    fused = pipeline.transform(grid)
+    reference = pipeline.transform_unfused(grid)
+    scale = np.maximum(np.abs(reference), 1.0)
+    max_error = float(np.max(np.abs(fused - reference) / scale))
+
+    agreement = float(np.mean(pipeline.model.predict(fused) == pipeline.model.predict(reference)))
+    return {
+        'fused': True,
+        'points': len(grid),
+        'max_relative_error': max_error,
+        'prediction_agreement': agreement,
+        'equivalent': max_error <= tolerance and agreement == 1.0,
+    }
+
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+
+    def __init__(self, model_dir=ML_MODELS_DIR):
+        self.model_dir = model_dir
+        self.paths = {
+            'model': os.path.join(model_dir, 'model.pkl'),
+            'standard_scaler': os.path.join(model_dir, 'standscaler.pkl'),
+            'minmax_scaler': os.path.join(model_dir, 'minmaxscaler.pkl'),
+        }
+        self.compact_dir = os.path.join(model_dir, COMPACT_MODEL_DIRNAME)
+        self.model_format = None
+        self._lock = threading.Lock()
+        self._pipeline = None
+        self._mtimes = None
+        self._last_check = 0.0
+        self.load_count = 0
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.loaded_at = None
+        self.equivalence = None
+        self.fingerprint = None
+
+    def _resolve_format(self):
+        model_format = getattr(settings, 'CROPMATE_MODEL_FORMAT', 'auto')
+        if model_format == 'auto':
+            return 'compact' if compact_forest.artifact_exists(self.compact_dir) else 'pickle'
+        return model_format
+
+    def _watched_paths(self, model_format):
+        paths = [self.paths['standard_scaler'], self.paths['minmax_scaler']]
+        if model_format == 'compact':
+            # meta.json is replaced last by export_crop_model, so it marks a finished export
+            paths.append(os.path.join(self.compact_dir, 'meta.json'))
+        else:
+            paths.append(self.paths['model'])
+        return paths
+
+    def _read_mtimes(self):
+        model_format = self._resolve_format()
+        return (model_format,) + tuple(os.stat(path).st_mtime_ns for path in self._watched_paths(model_format))
+
+    def _fingerprint(self, model, model_format):
+        """
+        Content hash of model.pkl and the scalers, identifying the model
+        independently of its format. Compact exports record model.pkl's digest
+        in meta.json, so loading them never reads the pickle.
+        """
+        model_digest = model.meta.get('source_sha256') if model_format == 'compact' else None
+        digest = hashlib.sha256((model_digest or file_digest(self.paths['model'])).encode())
+        for name in ('standard_scaler', 'minmax_scaler'):
+            digest.update(file_digest(self.paths[name]).encode())
+        return digest.hexdigest()[:16]
+
+    def _load(self, model_format):
+        started = time.perf_counter()
+        loaded = {}
+        for name in ('standard_scaler', 'minmax_scaler'):
+            with open(self.paths[name], 'rb') as f:
+                loaded[name] = pickle.load(f)
+        if model_format == 'compact':
+            loaded['model'] = compact_forest.CompactForest(self.compact_dir)
+        else:
+            with open(self.paths['model'], 'rb') as f:
+                loaded['model'] = pickle.load(f)
+        elapsed = time.perf_counter() - started
+        memory = sum(_estimate_nbytes(obj) for obj in loaded.values())
+
+        self.load_count += 1
+        self.load_seconds = elapsed
+        self.memory_bytes = memory
+        self.loaded_at = time.time()
+        self.model_format = model_format
+        self.fingerprint = self._fingerprint(loaded['model'], model_format)
+        logger.info(
+            'Loaded %s crop pipeline #%d in %.1f ms (~%.1f MB private memory)',
+            model_format, self.load_count, elapsed * 1000, self.memory_bytes / (1024 * 1024),
+        )
+        fuse = getattr(settings, 'CROPMATE_FUSED_SCALERS', True)
+        pipeline = CropPipeline(
+            loaded['model'], loaded['standard_scaler'], loaded['minmax_scaler'],
+            version=self.load_count, fuse=fuse,
+        )
+        if fuse:
+            self.equivalence = check_fused_equivalence(pipeline)
+            if not self.equivalence['equivalent']:
+                logger.warning('Fused scaler transform diverges from sklearn, using two-step path: %s',
+                               self.equivalence)
+                pipeline.fused = None
+        return pipeline
+
+    def get_pipeline(self):
+        """Return the shared pipeline, loading or hot-reloading it when needed."""
+        pipeline = self._pipeline
+        interval = getattr(settings, 'CROPMATE_MODEL_RELOAD_INTERVAL', 2.0)
+        now = time.monotonic()
+        if pipeline is not None and (interval is None or now - self._last_check < interval):
+            return pipeline
+
+        with self._lock:
+            mtimes = self._read_mtimes()
+            self._last_check = now
+            if self._pipeline is None or mtimes != self._mtimes:
+                if self._pipeline is not None:
+                    logger.info('Crop model files changed on disk, reloading')
+                self._pipeline = self._load(mtimes[0])
+                self._mtimes = mtimes
+            return self._pipeline
+
+    def stats(self):
+        return {
+            'loaded': self._pipeline is not None,
+            'version': self._pipeline.version if self._pipeline else None,
+            'load_count': self.load_count,
+            'load_seconds': self.load_seconds,
+            'memory_bytes': self.memory_bytes,
+            'loaded_at': self.loaded_at,
+            'model_format': self.model_format,
+            'fingerprint': self.fingerprint,
+            'fused_scalers': self._pipeline is not None and self._pipeline.fused is not None,
+            'equivalence': self.equivalence,
+        }
+
+
+registry = ModelRegistry()
+
+
+def get_pipeline():
+    return registry.get_pipeline()
@@ -0,0 +1,51 @@
+"""
+Per-connection database setup.
+
+SQLite connections get the pragmas in CROPMATE_SQLITE when they open:
+
+- WAL lets readers carry on while a batch of sensor readings is being written.
+- synchronous=NORMAL is durable in WAL mode and needs one fsync per
+  checkpoint instead of one per transaction.
+- busy_timeout makes a writer wait for the lock instead of failing with
+  "database is locked". Pair it with transaction_mode IMMEDIATE (see
+  dashboard.backends.sqlite3).
+- mmap_size, cache_size and temp_store keep hot pages and sort/temp
+  tables in memory.
+
+A pragma set to None is left at SQLite's default.
+"""
+from django.conf import settings
+
+DEFAULTS = {
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'BUSY_TIMEOUT': 5000,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'CACHE_SIZE': -20000,
+    'TEMP_STORE': 'MEMORY',
+}
+
+PRAGMAS = [
+    ('JOURNAL_MODE', 'journal_mode'),
+    ('SYNCHRONOUS', 'synchronous'),
+    ('BUSY_TIMEOUT', 'busy_timeout'),
+    ('MMAP_SIZE', 'mmap_size'),
+    ('CACHE_SIZE', 'cache_size'),
+    ('TEMP_STORE', 'temp_store'),
+]
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'CROPMATE_SQLITE', {}))
+    return config
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    config = get_config()
+    with connection.cursor() as cursor:
+        for key, pragma in PRAGMAS:
+            if config[key] is not None:
+                cursor.execute(f'PRAGMA {pragma}={config[key]}')
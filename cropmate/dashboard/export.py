@@ -0,0 +1,112 @@
+"""
+Streaming export of crop recommendations as CSV or NDJSON.
+
+Rows are read with values_list() and iterator(), so only one
+database chunk of plain tuples is in memory at a time, and encoded into
+blocks of roughly BLOCK_SIZE bytes, optionally gzip-compressed on the fly.
+Memory use stays flat however many rows are exported. Used by the export
+endpoint and the export_recommendations command.
+"""
+import csv
+import io
+import json
+import zlib
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from .crop_model import FEATURE_NAMES
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+COLUMNS = ['id', 'created_at', 'username', 'device', 'recommended_crop', 'confidence'] + FEATURE_NAMES
+FIELDS = ['id', 'created_at', 'user__username', 'device__name', 'recommended_crop', 'confidence'] + FEATURE_NAMES
+BLOCK_SIZE = 64 * 1024
+CHUNK_SIZE = 2000
+
+
+def rows(queryset):
+    return queryset.order_by('id').values_list(*FIELDS)
+
+
+class Encoder:
+    """Turns row tuples into byte blocks of the chosen format."""
+
+    def __init__(self, fmt, compress=False):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown export format {fmt!r}')
+        self.fmt = fmt
+        self.rows = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer) if fmt == 'csv' else None
+        # wbits=31 writes a gzip header, so the output is a regular .gz file
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def _drain(self):
+        data = self._buffer.getvalue().encode()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        return data
+
+    def start(self):
+        if self._writer is not None:
+            self._writer.writerow(COLUMNS)
+
+    def add(self, row):
+        """Buffer one row; returns a block once BLOCK_SIZE bytes are pending, else b''."""
+        self.rows += 1
+        created_at = row[1].isoformat()
+        if self._writer is not None:
+            self._writer.writerow((row[0], created_at) + row[2:])
+        else:
+            self._buffer.write(json.dumps(dict(zip(COLUMNS, (row[0], created_at) + row[2:]))))
+            self._buffer.write('\n')
+        if self._buffer.tell() >= BLOCK_SIZE:
+            return self._drain()
+        return b''
+
+    def finish(self):
+        data = self._drain()
+        if self._compressor is not None:
+            data += self._compressor.flush()
+        return data
+
+
+def stream(queryset, fmt, compress=False, chunk_size=CHUNK_SIZE):
+    encoder = Encoder(fmt, compress)
+    encoder.start()
+    for row in rows(queryset).iterator(chunk_size=chunk_size):
+        block = encoder.add(row)
+        if block:
+            yield block
+    yield encoder.finish()
+
+
+async def astream(queryset, fmt, compress=False, chunk_size=CHUNK_SIZE):
+    # Django 4.2's aiterator() runs values_list() queries on the event loop and
+    # fails, so pull chunks through sync_to_async the way aiterator() would
+    iterator = rows(queryset).iterator(chunk_size=chunk_size)
+    fetch = sync_to_async(lambda: list(islice(iterator, chunk_size)))
+    encoder = Encoder(fmt, compress)
+    encoder.start()
+    try:
+        while True:
+            chunk = await fetch()
+            if not chunk:
+                break
+            for row in chunk:
+                block = encoder.add(row)
+                if block:
+                    yield block
+    finally:
+        await sync_to_async(iterator.close)()
+    yield encoder.finish()
+
+
+def filename(fmt, compress):
+    extension = FORMATS[fmt][1]
+    return f'crop-recommendations.{extension}.gz' if compress else f'crop-recommendations.{extension}'
@@ -0,0 +1,63 @@
+"""
+Canned agronomist answers for when the chat backend is unavailable.
+
+The rules live in data/fallback_responses.json (or the file named by
+CROPMATE_AGRONOMIST['FALLBACK_TABLE']) and are tried in file order: the
+first rule with a keyword anywhere in the message wins. All keywords are
+compiled into one alternation ordered by rule, so each search finds the
+best keyword starting at the earliest position; resuming one character
+later keeps keywords that overlap a match from being missed.
+"""
+import json
+import os
+import re
+
+from django.conf import settings
+
+DEFAULT_TABLE = os.path.join(os.path.dirname(__file__), 'data', 'fallback_responses.json')
+
+
+def load_table(path):
+    with open(path, encoding='utf-8') as f:
+        table = json.load(f)
+    return table['rules'], table['default']
+
+
+class FallbackMatcher:
+
+    def __init__(self, rules, default):
+        self.responses = [rule['response'] for rule in rules]
+        self.default = default
+        self._rules = {}
+        for index, rule in enumerate(rules):
+            for keyword in rule['keywords']:
+                self._rules.setdefault(keyword.lower(), index)
+        # Rule order first, so the alternative tried first at any position is the best one there
+        keywords = sorted(self._rules, key=lambda keyword: (self._rules[keyword], -len(keyword)))
+        self._pattern = re.compile('|'.join(re.escape(keyword) for keyword in keywords)) if keywords else None
+
+    def match(self, message):
+        """Index of the first rule with a keyword in `message`, or None."""
+        if self._pattern is None:
+            return None
+        message = message.lower()
+        best = None
+        search = self._pattern.search
+        m = search(message)
+        while m is not None:
+            rule = self._rules[m.group()]
+            if best is None or rule < best:
+                best = rule
+                if best == 0:
+                    break
+            m = search(message, m.start() + 1)
+        return best
+
+    def respond(self, message):
+        rule = self.match(message)
+        return self.default if rule is None else self.responses[rule]
+
+
+matcher = FallbackMatcher(*load_table(
+    getattr(settings, 'CROPMATE_AGRONOMIST', {}).get('FALLBACK_TABLE', DEFAULT_TABLE)
+))
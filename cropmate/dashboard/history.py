@@ -0,0 +1,94 @@
+"""
+Recommendation history: keyset pagination and per-crop aggregates.
+
+Pages are ordered by (created_at, id) descending and continue from an
+opaque cursor holding the last row's key, so every page is an index range
+scan on croprec_user_created_idx no matter how deep the user pages; OFFSET
+would re-read every skipped row. The id tie-breaker keeps rows created in
+the same instant from being skipped or repeated.
+"""
+import base64
+import binascii
+
+from django.db.models import Avg, Count, Q
+from django.utils.dateparse import parse_datetime
+
+from .models import CropRecommendation
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(recommendation):
+    key = f'{recommendation.created_at.isoformat()}|{recommendation.pk}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, pk = key.rsplit('|', 1)
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor')
+    if created_at is None:
+        raise InvalidCursor('Invalid cursor')
+    return created_at, pk
+
+
+def page(user, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """One page of the user's recommendations, newest first. Returns (rows, next cursor or None)."""
+    queryset = CropRecommendation.objects.filter(user=user).order_by('-created_at', '-id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        # The redundant created_at <= bound lets the planner seek into the index instead
+        # of filtering every newer row, which it can't do from the OR alone
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(id__lt=pk), created_at__lte=created_at)
+
+    # One extra row tells us whether there is a next page without a COUNT
+    rows = list(queryset.select_related('device')[:limit + 1])
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1])
+    return rows, None
+
+
+def aggregates(user):
+    """Per-crop counts and average inputs, computed by the database in one GROUP BY."""
+    crops = list(
+        CropRecommendation.objects.filter(user=user)
+        .values('recommended_crop')
+        .annotate(
+            count=Count('id'),
+            avg_nitrogen=Avg('nitrogen'),
+            avg_phosphorus=Avg('phosphorus'),
+            avg_potassium=Avg('potassium'),
+            avg_confidence=Avg('confidence'),
+        )
+        .order_by('-count', 'recommended_crop')
+    )
+    total = sum(crop['count'] for crop in crops)
+    for crop in crops:
+        crop['share'] = crop['count'] / total
+    return {'total': total, 'crops': crops}
+
+
+def serialize(recommendation):
+    return {
+        'id': recommendation.pk,
+        'created_at': recommendation.created_at.isoformat(),
+        'recommended_crop': recommendation.recommended_crop,
+        'confidence': recommendation.confidence,
+        'nitrogen': recommendation.nitrogen,
+        'phosphorus': recommendation.phosphorus,
+        'potassium': recommendation.potassium,
+        'temperature': recommendation.temperature,
+        'humidity': recommendation.humidity,
+        'ph': recommendation.ph,
+        'rainfall': recommendation.rainfall,
+        'device': recommendation.device.name if recommendation.device_id else None,
+    }
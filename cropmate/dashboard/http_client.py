@@ -0,0 +1,269 @@
+"""
+Shared outbound HTTP client.
+
+One pooled requests.Session per process (keep-alive, bounded connection
+pool, retries with jittered exponential backoff) plus a circuit breaker per
+upstream. When an upstream keeps failing the breaker opens and calls fail
+immediately with CircuitOpenError instead of waiting out a timeout, so
+callers can fall back to cached or degraded data.
+
+Views served over ASGI get the same behaviour from one httpx.AsyncClient
+per event loop, with a semaphore per upstream bounding in-flight calls.
+Under WSGI each async view runs on a new, short-lived loop, so callers
+there must stay on the blocking session. Async transport errors are
+re-raised as the matching requests exceptions so callers handle a single
+exception family.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'POOL_CONNECTIONS': 10,
+    'POOL_MAXSIZE': 20,
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 5,
+    'RETRIES': 2,
+    'BACKOFF_FACTOR': 0.3,
+    'BACKOFF_JITTER': 0.3,
+    'RETRY_STATUSES': (429, 500, 502, 503, 504),
+    'CIRCUIT_FAILURE_THRESHOLD': 5,
+    'CIRCUIT_RESET_TIMEOUT': 30,
+    'MAX_CONCURRENCY_PER_UPSTREAM': 100,
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'CROPMATE_HTTP', {}))
+    return config
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without touching the network while an upstream's circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through and consecutive failures are counted.
+    Open: calls fail fast until reset_timeout has passed.
+    Half-open: one trial call decides whether to close or re-open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f'{self.name} is unavailable (circuit open)')
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    raise CircuitOpenError(f'{self.name} is unavailable (circuit half-open)')
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning('Opening circuit for %s after %d failures', self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures}
+
+
+def _build_retry(config):
+    kwargs = dict(
+        total=config['RETRIES'],
+        connect=config['RETRIES'],
+        read=config['RETRIES'],
+        status=config['RETRIES'],
+        backoff_factor=config['BACKOFF_FACTOR'],
+        status_forcelist=config['RETRY_STATUSES'],
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        raise_on_status=False,
+    )
+    try:
+        return Retry(backoff_jitter=config['BACKOFF_JITTER'], **kwargs)
+    except TypeError:
+        # urllib3 < 2 has no jitter support
+        return Retry(**kwargs)
+
+
+class HttpClient:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._breakers = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def session(self):
+        # Sessions hold sockets, so never reuse one inherited across a fork
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    config = get_config()
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=config['POOL_CONNECTIONS'],
+                        pool_maxsize=config['POOL_MAXSIZE'],
+                        max_retries=_build_retry(config),
+                    )
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = pid
+                    self._breakers = {}
+        return self._session
+
+    def breaker(self, upstream):
+        breaker = self._breakers.get(upstream)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(upstream)
+                if breaker is None:
+                    config = get_config()
+                    breaker = self._breakers[upstream] = CircuitBreaker(
+                        upstream, config['CIRCUIT_FAILURE_THRESHOLD'], config['CIRCUIT_RESET_TIMEOUT'],
+                    )
+        return breaker
+
+    def request(self, upstream, method, url, **kwargs):
+        """
+        Send a request through the pooled session, guarded by the circuit
+        breaker named `upstream`. Connection errors, timeouts and 5xx
+        responses count as failures.
+        """
+        config = get_config()
+        kwargs.setdefault('timeout', (config['CONNECT_TIMEOUT'], config['READ_TIMEOUT']))
+        session = self.session()
+        breaker = self.breaker(upstream)
+        breaker.before_call()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Not the upstream's fault, but a half-open breaker must not keep waiting for this trial
+            breaker.release_trial()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    def get(self, upstream, url, **kwargs):
+        return self.request(upstream, 'GET', url, **kwargs)
+
+    def async_client(self):
+        """The httpx.AsyncClient for the running event loop (clients can't be shared across loops)."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            config = get_config()
+            # In-flight calls are bounded per upstream by semaphore(), not by the pool
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=config['POOL_MAXSIZE']),
+                timeout=httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+            )
+            self._async_clients[loop] = client
+        return client
+
+    def semaphore(self, upstream):
+        """Per-loop semaphore bounding concurrent async calls to one upstream."""
+        loop = asyncio.get_running_loop()
+        semaphores = self._semaphores.setdefault(loop, {})
+        if upstream not in semaphores:
+            semaphores[upstream] = asyncio.Semaphore(get_config()['MAX_CONCURRENCY_PER_UPSTREAM'])
+        return semaphores[upstream]
+
+    async def arequest(self, upstream, method, url, **kwargs):
+        """Async counterpart of request(); retries idempotent methods with jittered backoff."""
+        config = get_config()
+        retries = config['RETRIES'] if method in ('GET', 'HEAD', 'OPTIONS') else 0
+        breaker = self.breaker(upstream)
+        breaker.before_call()
+
+        try:
+            attempt = 0
+            while True:
+                try:
+                    async with self.semaphore(upstream):
+                        response = await self.async_client().request(method, url, **kwargs)
+                    if response.status_code not in config['RETRY_STATUSES'] or attempt >= retries:
+                        break
+                except httpx.TransportError as e:
+                    if attempt >= retries:
+                        breaker.record_failure()
+                        if isinstance(e, httpx.TimeoutException):
+                            raise requests.exceptions.Timeout(str(e)) from e
+                        raise requests.exceptions.ConnectionError(str(e)) from e
+                delay = config['BACKOFF_FACTOR'] * (2 ** attempt) + random.uniform(0, config['BACKOFF_JITTER'])
+                attempt += 1
+                await asyncio.sleep(delay)
+        except requests.exceptions.RequestException:
+            raise
+        except BaseException:
+            # Cancellation (e.g. the client went away) must not wedge a half-open breaker
+            breaker.release_trial()
+            raise
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    async def aget(self, upstream, url, **kwargs):
+        return await self.arequest(upstream, 'GET', url, **kwargs)
+
+    def stats(self):
+        return {name: breaker.stats() for name, breaker in self._breakers.items()}
+
+
+client = HttpClient()
@@ -0,0 +1,138 @@
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connections, transaction
+from django.test import override_settings
+from django.utils import timezone
+
+from dashboard.models import CropRecommendation
+
+ALIAS = 'benchmark'
+
+# Stock Django SQLite (rollback journal, deferred BEGIN, per-request
+# connections) against this project's configuration
+SQLITE_PROFILES = {
+    'baseline': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'OPTIONS': {},
+        'CONN_MAX_AGE': 0,
+        'PRAGMAS': {key: None for key in ('JOURNAL_MODE', 'SYNCHRONOUS', 'BUSY_TIMEOUT',
+                                          'MMAP_SIZE', 'CACHE_SIZE', 'TEMP_STORE')},
+    },
+    'tuned': {
+        'ENGINE': 'dashboard.backends.sqlite3',
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        'CONN_MAX_AGE': 60,
+        'PRAGMAS': {},
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Concurrent write benchmark: threads that each run request-like transactions (read the user, '
+        'insert a recommendation, update last_login) and report throughput, latency and lock errors. '
+        'By default compares stock SQLite with the tuned configuration on a scratch database; '
+        '--database benchmarks a configured alias (e.g. PostgreSQL) instead.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--writes', type=int, default=200, help='Transactions per thread')
+        parser.add_argument('--profile', action='append', choices=sorted(SQLITE_PROFILES),
+                            help='SQLite profile to run (repeatable; default all)')
+        parser.add_argument('--database', help='Benchmark this DATABASES alias as configured')
+
+    def handle(self, *args, **options):
+        if options['database']:
+            if options['database'] not in settings.DATABASES:
+                raise CommandError(f"Unknown database alias {options['database']!r}")
+            self.report(options['database'], self.run(options['database'], options, cleanup=True))
+            return
+
+        for name in options['profile'] or sorted(SQLITE_PROFILES):
+            profile = SQLITE_PROFILES[name]
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'benchmark.sqlite3')
+                connections.settings[ALIAS] = connections.configure_settings({
+                    'default': settings.DATABASES['default'],
+                    ALIAS: {
+                        'ENGINE': profile['ENGINE'],
+                        'NAME': path,
+                        'OPTIONS': profile['OPTIONS'],
+                        'CONN_MAX_AGE': profile['CONN_MAX_AGE'],
+                        'CONN_HEALTH_CHECKS': True,
+                    },
+                })[ALIAS]
+                try:
+                    with override_settings(CROPMATE_SQLITE={**getattr(settings, 'CROPMATE_SQLITE', {}),
+                                                            **profile['PRAGMAS']}):
+                        call_command('migrate', database=ALIAS, verbosity=0)
+                        results = self.run(ALIAS, options, cleanup=False)
+                finally:
+                    connections[ALIAS].close()
+                    del connections[ALIAS]
+                    del connections.settings[ALIAS]
+            self.report(name, results)
+
+    def run(self, alias, options, cleanup):
+        user = User.objects.db_manager(alias).create_user(f'benchmark-{time.time_ns()}')
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        start = threading.Barrier(options['threads'])
+
+        def worker():
+            start.wait()
+            for _ in range(options['writes']):
+                began = time.perf_counter()
+                try:
+                    with transaction.atomic(using=alias):
+                        # Read before writing, like a view would; this is what deadlocks a deferred BEGIN
+                        member = User.objects.using(alias).get(pk=user.pk)
+                        CropRecommendation.objects.using(alias).create(
+                            user=member, nitrogen=90, phosphorus=42, potassium=43, temperature=21,
+                            humidity=82, ph=6.5, rainfall=203, recommended_crop='Rice', confidence=0.9,
+                        )
+                        User.objects.using(alias).filter(pk=user.pk).update(last_login=timezone.now())
+                except OperationalError as e:
+                    with lock:
+                        errors.append(str(e))
+                else:
+                    with lock:
+                        latencies.append(time.perf_counter() - began)
+                # End of "request": drops the connection unless CONN_MAX_AGE keeps it
+                close_old_connections()
+            connections[alias].close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        if cleanup:
+            User.objects.using(alias).filter(pk=user.pk).delete()
+        return {'elapsed': elapsed, 'latencies': latencies, 'errors': errors}
+
+    def report(self, name, results):
+        latencies = sorted(results['latencies'])
+        ok = len(latencies)
+        line = f"{name}: {ok} commits, {len(results['errors'])} failed, {ok / results['elapsed']:,.0f} commits/s"
+        if latencies:
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            line += (f'; latency p50 {statistics.median(latencies) * 1000:.1f} ms, '
+                     f'p95 {p95 * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms')
+        style = self.style.SUCCESS if not results['errors'] else self.style.WARNING
+        self.stdout.write(style(line))
+        if results['errors']:
+            self.stdout.write(f"  first error: {results['errors'][0]}")
@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.crop_grid import DEFAULT_BOUNDS, DEFAULT_PATH, CropGrid, build_grid, measure_agreement
+from dashboard.crop_model import FEATURE_NAMES, registry
+
+
+class Command(BaseCommand):
+    help = 'Precompute the crop lookup grid used by fast mode and report its agreement with the model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bins', default='8',
+                            help='Cells per feature: one number for all, or 7 comma-separated values')
+        parser.add_argument('--min-confidence', type=float, default=0.0,
+                            help='Cells whose top probability is below this fall back to the model')
+        parser.add_argument('--top-k', type=int, default=None,
+                            help='Ranked crops stored per cell (defaults to CROPMATE_TOP_K); '
+                                 'requests for more fall back to the model')
+        parser.add_argument('--samples', type=int, default=20000,
+                            help='Random points used to measure agreement with the model')
+        parser.add_argument('--output', default=None,
+                            help='Output .npz path (defaults to CROPMATE_CROP_GRID["PATH"])')
+
+    def handle(self, *args, **options):
+        try:
+            bins = [int(b) for b in options['bins'].split(',')]
+        except ValueError:
+            raise CommandError('--bins must be integers')
+        if len(bins) == 1:
+            bins = bins * len(FEATURE_NAMES)
+        if len(bins) != len(FEATURE_NAMES) or min(bins) < 1:
+            raise CommandError(f'--bins needs 1 or {len(FEATURE_NAMES)} positive values')
+
+        top_k = options['top_k'] or getattr(settings, 'CROPMATE_TOP_K', 3)
+        if top_k < 1:
+            raise CommandError('--top-k must be positive')
+
+        config = getattr(settings, 'CROPMATE_CROP_GRID', {})
+        bounds = {**DEFAULT_BOUNDS, **config.get('BOUNDS', {})}
+        path = options['output'] or config.get('PATH', DEFAULT_PATH)
+        pipeline = registry.get_pipeline()
+
+        n_cells = int(np.prod(bins))
+        self.stdout.write(f'Evaluating the model on {n_cells} grid cells...')
+        started = time.perf_counter()
+        labels, confidence = build_grid(pipeline, bounds, bins, options['min_confidence'], top_k)
+        build_seconds = time.perf_counter() - started
+
+        grid = CropGrid(labels, confidence, bounds)
+        agreement = measure_agreement(grid, pipeline, n_samples=options['samples'])
+        grid.meta = {
+            'model_fingerprint': registry.fingerprint,
+            'top_k': top_k,
+            'build_seconds': build_seconds,
+            'fallback_cells': float(np.mean(labels[..., 0] == 0)),
+            **agreement,
+        }
+        grid.save(path)
+
+        self.stdout.write(
+            f'Built {labels.shape} grid ({labels.nbytes + confidence.nbytes} bytes) in {build_seconds:.1f}s; '
+            f"{grid.meta['fallback_cells']:.1%} of cells fall back to the model"
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Agreement over {agreement['samples']} random points: "
+            f"grid answers {agreement['coverage']:.1%} of them and agrees with the model on "
+            f"{agreement['grid_agreement']:.2%} (full top-{top_k} ranking on {agreement['ranking_agreement']:.2%}); "
+            f"overall fast-mode agreement {agreement['overall_agreement']:.2%}"
+        ))
+        self.stdout.write(f'Saved to {path}. Enable with CROPMATE_CROP_GRID["FAST_MODE"] = True')
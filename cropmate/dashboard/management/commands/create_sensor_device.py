@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.models import SensorDevice
+from dashboard.weather import CITY_COORDINATES
+
+
+class Command(BaseCommand):
+    help = 'Register a sensor device for a user and print its key (shown only once)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('name', help='Device name shown on the sensors page')
+        parser.add_argument('--city', default='', choices=sorted(CITY_COORDINATES),
+                            help='Nearest forecast city, for automatic recommendations')
+        parser.add_argument('--ph', type=float, help='Soil pH, for automatic recommendations')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['username']!r}")
+
+        device = SensorDevice(user=user, name=options['name'], city=options['city'], soil_ph=options['ph'])
+        key = device.set_new_key()
+        device.save()
+        self.stdout.write(self.style.SUCCESS(f'Created device {device.name} (id {device.pk})'))
+        self.stdout.write(f'X-Device-Key: {key}')
@@ -0,0 +1,102 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import compact_forest
+from dashboard.crop_model import (
+    ML_MODELS_DIR, COMPACT_MODEL_DIRNAME, FEATURE_NAMES, FEATURE_RANGES, CropPipeline, file_digest,
+)
+
+
+class Command(BaseCommand):
+    help = 'Export ml_models/model.pkl into the compact memory-mapped crop model format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=os.path.join(ML_MODELS_DIR, COMPACT_MODEL_DIRNAME),
+                            help='Directory to write the .npy arrays and meta.json into')
+        parser.add_argument('--verify-samples', type=int, default=20000,
+                            help='Random samples used to check predictions match model.predict exactly')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        def load(name):
+            with open(os.path.join(ML_MODELS_DIR, name), 'rb') as f:
+                return pickle.load(f)
+
+        model = load('model.pkl')
+        pipeline = CropPipeline(model, load('standscaler.pkl'), load('minmaxscaler.pkl'), version=0)
+
+        # Build and verify next to the destination, then swap it in, so a model that
+        # fails verification never lands where the registry would load it
+        output = os.path.abspath(options['output'])
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f'.{os.path.basename(output)}-', dir=os.path.dirname(output))
+        try:
+            # mkdtemp() creates the directory private to this user
+            os.chmod(staging, 0o755)
+            meta = self.export(model, pipeline, staging, options)
+            self.install(staging, output)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.stdout.write(self.style.SUCCESS(f'Installed the compact model in {output}'))
+
+    def export(self, model, pipeline, directory, options):
+        # The registry fingerprints a compact model by its source pickle's digest
+        source_sha256 = file_digest(os.path.join(ML_MODELS_DIR, 'model.pkl'))
+        try:
+            meta = compact_forest.export_forest(model, directory, source_sha256)
+        except (ValueError, AttributeError) as e:
+            raise CommandError(f'Cannot export this model: {e}')
+
+        size = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory) if not name.startswith('.')
+        )
+        self.stdout.write(
+            f"Exported {meta['n_trees']} trees, {meta['n_nodes']} nodes ({size / (1024 * 1024):.2f} MB)"
+        )
+
+        started = time.perf_counter()
+        compact = compact_forest.CompactForest(directory)
+        load_ms = (time.perf_counter() - started) * 1000
+
+        n = options['verify_samples']
+        if n <= 0:
+            return meta
+        rng = np.random.default_rng(options['seed'])
+        low = [FEATURE_RANGES[name][0] for name in FEATURE_NAMES]
+        high = [FEATURE_RANGES[name][1] for name in FEATURE_NAMES]
+        features = pipeline.transform(rng.uniform(low, high, size=(n, len(FEATURE_NAMES))))
+
+        expected = model.predict_proba(features)
+        actual = compact.predict_proba(features)
+        if not np.array_equal(model.predict(features), compact.predict(features)) \
+                or not np.array_equal(expected, actual):
+            mismatches = int((np.argmax(expected, axis=1) != np.argmax(actual, axis=1)).sum())
+            raise CommandError(
+                f'Compact model diverges from model.predict ({mismatches} of {n} labels differ); '
+                f'nothing was installed'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Verified {n} samples: predictions and probabilities match exactly '
+            f'(compact load {load_ms:.1f} ms)'
+        ))
+        return meta
+
+    def install(self, staging, output):
+        # Directories can't be os.replace()d over a non-empty one: move the old export
+        # aside first. Processes that already mapped its arrays keep their mappings
+        previous = None
+        if os.path.exists(output):
+            previous = tempfile.mkdtemp(prefix=f'.{os.path.basename(output)}-old-', dir=os.path.dirname(output))
+            os.replace(output, os.path.join(previous, 'export'))
+        os.replace(staging, output)
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors=True)
@@ -0,0 +1,48 @@
+import sys
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import export
+from dashboard.models import CropRecommendation
+
+
+class Command(BaseCommand):
+    help = 'Stream crop recommendations to a CSV or NDJSON file without loading them into memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-', help="Output file, '-' for stdout (default)")
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument('--user', help='Only this username')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE,
+                            help='Rows fetched from the database per round trip')
+
+    def handle(self, *args, **options):
+        queryset = CropRecommendation.objects.all()
+        if options['user']:
+            try:
+                queryset = queryset.filter(user=User.objects.get(username=options['user']))
+            except User.DoesNotExist:
+                raise CommandError(f"No user named {options['user']!r}")
+
+        to_stdout = options['output'] == '-'
+        out = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        started = time.perf_counter()
+        written = 0
+        try:
+            for block in export.stream(queryset, options['format'], options['gzip'], options['chunk_size']):
+                out.write(block)
+                written += len(block)
+        finally:
+            if to_stdout:
+                out.flush()
+            else:
+                out.close()
+
+        if not to_stdout:
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written / 1e6:.1f} MB to {options['output']} in {elapsed:.1f}s"
+            ))
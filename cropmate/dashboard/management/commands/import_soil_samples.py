@@ -0,0 +1,192 @@
+import csv
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from dashboard.crop_model import FEATURE_ALIASES, FEATURE_NAMES, get_pipeline, validate_features
+from dashboard.models import CropRecommendation, SoilImport
+
+
+class OffsetLines:
+    """Decoded lines of a binary file, tracking the byte offset after the last line read."""
+
+    def __init__(self, f, offset):
+        self.f = f
+        self.offset = offset
+
+    def __iter__(self):
+        for line in self.f:
+            self.offset += len(line)
+            yield line.decode('utf-8')
+
+
+def parse_columns(records, indices):
+    """
+    Build an (N, 7) float matrix from string records. Each column is parsed
+    in one numpy call; only a column containing a bad value falls back to
+    per-cell parsing, leaving NaN for validate_features() to report.
+    """
+    matrix = np.empty((len(records), len(indices)))
+    for j, index in enumerate(indices):
+        column = [record[index].strip() if index < len(record) else '' for record in records]
+        try:
+            matrix[:, j] = np.asarray(column, dtype=float)
+        except ValueError:
+            for i, value in enumerate(column):
+                try:
+                    matrix[i, j] = float(value)
+                except ValueError:
+                    matrix[i, j] = np.nan
+    return matrix
+
+
+class Command(BaseCommand):
+    help = (
+        'Import lab soil samples from a CSV file (N/P/K, temperature, humidity, ph, rainfall columns) '
+        'as crop recommendations. Streams the file in chunks, so it works for files larger than RAM, '
+        'and records its position with every committed chunk so an interrupted import resumes '
+        'where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', required=True, help='Username the samples belong to')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Rows validated, predicted and committed together')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT statement')
+        parser.add_argument('--restart', action='store_true', help='Import the file from the start again')
+        parser.add_argument('--rejects', help='Write rejected rows and their errors to this CSV file')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user named {options['user']!r}")
+        if options['chunk_size'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--chunk-size and --batch-size must be positive')
+
+        path = os.path.abspath(options['path'])
+        progress = self.load_progress(path, options['restart'])
+        if progress.done:
+            self.stdout.write(f'{path} was already imported (use --restart to import it again)')
+            return
+
+        pipeline = get_pipeline()
+        k = getattr(settings, 'CROPMATE_TOP_K', 3)
+        rejects = open(options['rejects'], 'a', newline='', encoding='utf-8') if options['rejects'] else None
+        reject_writer = csv.writer(rejects) if rejects else None
+
+        started = time.perf_counter()
+        read_this_run = 0
+        with open(path, 'rb') as f:
+            f.seek(progress.offset)
+            lines = OffsetLines(f, progress.offset)
+            reader = csv.reader(lines)
+            first_line = progress.line
+
+            if progress.header is None:
+                try:
+                    header = next(reader)
+                except StopIteration:
+                    raise CommandError(f'{path} is empty')
+                progress.header = [column.lstrip('\ufeff') for column in header]
+            else:
+                self.stdout.write(f'Resuming at line {first_line + 1} ({progress.imported} rows already imported)')
+            indices = self.feature_indices(progress.header)
+
+            try:
+                while True:
+                    records = []
+                    line_numbers = []
+                    for record in reader:
+                        if record:
+                            records.append(record)
+                            line_numbers.append(first_line + reader.line_num)
+                        if len(records) >= options['chunk_size']:
+                            break
+                    if not records:
+                        break
+
+                    self.import_chunk(
+                        user, progress, lines.offset, first_line + reader.line_num,
+                        records, line_numbers, indices, pipeline, k, options['batch_size'], reject_writer,
+                    )
+                    read_this_run += len(records)
+
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(
+                        f'{progress.imported + progress.rejected} rows '
+                        f'({progress.imported} imported, {progress.rejected} rejected), '
+                        f'{read_this_run / elapsed:,.0f} rows/s'
+                    )
+            finally:
+                if rejects:
+                    rejects.close()
+
+        progress.done = True
+        progress.save()
+        elapsed = time.perf_counter() - started
+        rate = read_this_run / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {progress.imported} rows, rejected {progress.rejected}; '
+            f'{read_this_run} rows in {elapsed:.1f}s ({rate:,.0f} rows/s)'
+        ))
+
+    def feature_indices(self, header):
+        positions = {}
+        for i, column in enumerate(header):
+            name = column.strip().lower()
+            positions.setdefault(FEATURE_ALIASES.get(name, name), i)
+        missing = [name for name in FEATURE_NAMES if name not in positions]
+        if missing:
+            raise CommandError(f"CSV header is missing columns: {', '.join(missing)}")
+        return [positions[name] for name in FEATURE_NAMES]
+
+    def import_chunk(self, user, progress, offset, line, records, line_numbers, indices, pipeline, k,
+                     batch_size, reject_writer):
+        matrix = parse_columns(records, indices)
+        valid, errors = validate_features(matrix)
+        valid_indices = valid.nonzero()[0]
+        recommendations = pipeline.recommend(matrix[valid_indices], k=k)
+
+        to_create = []
+        for i, recommendation in zip(valid_indices.tolist(), recommendations):
+            if recommendation['crop'] is None:
+                errors[i] = ['Could not determine the best crop']
+                continue
+            to_create.append(CropRecommendation(
+                user=user,
+                recommended_crop=recommendation['crop'],
+                confidence=recommendation['confidence'],
+                **dict(zip(FEATURE_NAMES, matrix[i].tolist()))
+            ))
+
+        # The position after this chunk commits with its rows: either both are
+        # stored or neither is, so a crash can't make a resume import it again
+        progress.offset = offset
+        progress.line = line
+        progress.imported += len(to_create)
+        progress.rejected += len(errors)
+        with transaction.atomic():
+            CropRecommendation.objects.bulk_create(to_create, batch_size=batch_size)
+            progress.save()
+
+        if reject_writer is not None:
+            for i in sorted(errors):
+                reject_writer.writerow([line_numbers[i], '; '.join(errors[i])] + records[i])
+
+    def load_progress(self, path, restart):
+        if not os.path.isfile(path):
+            raise CommandError(f'{path} does not exist or is not a file')
+        progress, created = SoilImport.objects.get_or_create(source=path)
+        if restart and not created:
+            SoilImport.objects.filter(pk=progress.pk).delete()
+            progress = SoilImport.objects.create(source=path)
+        if os.path.getsize(path) < progress.offset:
+            raise CommandError(f'{path} is shorter than the recorded import position; use --restart')
+        return progress
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import weather
+
+
+class Command(BaseCommand):
+    help = (
+        'Refresh the cached forecast of every city in weather.CITY_COORDINATES, once or on an interval. '
+        'Web workers only see the results through a shared cache backend (CROPMATE_REDIS_URL); '
+        'with the default locmem cache set CROPMATE_WEATHER_CACHE["PREFETCH_INTERVAL"] instead.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between refreshes; 0 runs once and exits')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Thread pool size when falling back to per-city requests')
+        parser.add_argument('--no-multi', action='store_true',
+                            help='Skip the single multi-location request and fetch cities in parallel')
+        parser.add_argument('--force', action='store_true',
+                            help='Run even though the cache is local to this process')
+
+    def handle(self, *args, **options):
+        if not weather.cache_is_shared() and not options['force']:
+            raise CommandError(
+                'The weather cache is local to this process, so web workers would never see the prefetched '
+                'forecasts. Set CROPMATE_REDIS_URL for a shared cache, or set '
+                'CROPMATE_WEATHER_CACHE["PREFETCH_INTERVAL"] to refresh inside each worker.'
+            )
+
+        while True:
+            started = time.monotonic()
+            status = weather.prefetch(workers=options['workers'], multi_location=not options['no_multi'])
+            ages = [age for age in weather.prefetch_status()['ages'].values() if age is not None]
+
+            message = (
+                f"Refreshed {status['refreshed']}/{len(weather.CITY_COORDINATES)} cities "
+                f"in {status['latency'] * 1000:.0f} ms ({status['mode']})"
+            )
+            if ages:
+                message += f'; oldest cached forecast {max(ages):.0f}s'
+            if status['failures']:
+                self.stderr.write(message)
+                for city, error in status['failures'].items():
+                    self.stderr.write(f'  {city}: {error}')
+            else:
+                self.stdout.write(self.style.SUCCESS(message))
+
+            if not options['interval']:
+                break
+            time.sleep(max(0.0, options['interval'] - (time.monotonic() - started)))
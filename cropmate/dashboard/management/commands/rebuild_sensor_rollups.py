@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dashboard import sensors
+from dashboard.models import SensorDevice, SensorReading, SensorRollup
+
+
+class Command(BaseCommand):
+    help = 'Recompute sensor rollups from the raw readings (e.g. after changing ROLLUPS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', type=int, action='append', help='Only this device id (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        resolutions = sensors.get_config()['ROLLUPS']
+        devices = SensorDevice.objects.order_by('pk')
+        if options['device']:
+            devices = devices.filter(pk__in=options['device'])
+
+        for device in devices:
+            total = 0
+            with transaction.atomic():
+                SensorRollup.objects.filter(device=device).delete()
+                readings = SensorReading.objects.filter(device=device).order_by('timestamp')
+                chunk = []
+                for reading in readings.iterator(chunk_size=options['chunk_size']):
+                    chunk.append(reading)
+                    if len(chunk) >= options['chunk_size']:
+                        sensors.update_rollups(device.pk, chunk, resolutions)
+                        total += len(chunk)
+                        chunk = []
+                if chunk:
+                    sensors.update_rollups(device.pk, chunk, resolutions)
+                    total += len(chunk)
+            self.stdout.write(f'{device.name} (id {device.pk}): {total} readings')
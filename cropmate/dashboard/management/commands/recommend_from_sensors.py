@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from dashboard import auto_recommend
+
+
+class Command(BaseCommand):
+    help = 'Recommend crops for every sensor device with new readings (for cron when the background worker is off)'
+
+    def handle(self, *args, **options):
+        created = auto_recommend.recommend_changed()
+        self.stdout.write(self.style.SUCCESS(f'Stored {len(created)} recommendations'))
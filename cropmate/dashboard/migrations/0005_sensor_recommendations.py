@@ -0,0 +1,34 @@
+# Generated by Django 4.2.24 on 2026-10-18 19:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_sensor_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='croprecommendation',
+            name='device',
+            field=models.ForeignKey(blank=True, help_text='Sensor device the inputs came from, for automatic recommendations', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='recommendations', to='dashboard.sensordevice'),
+        ),
+        migrations.AddField(
+            model_name='sensordevice',
+            name='city',
+            field=models.CharField(blank=True, help_text='Forecast city used for rainfall', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='sensordevice',
+            name='recommended_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordevice',
+            name='soil_ph',
+            field=models.FloatField(blank=True, help_text='Soil pH from the latest lab test', null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.24 on 2026-10-18 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0005_sensor_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='croprecommendation',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='croprec_user_created_idx'),
+        ),
+    ]
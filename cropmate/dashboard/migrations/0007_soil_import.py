@@ -0,0 +1,27 @@
+# Generated by Django 4.2.24 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0006_recommendation_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SoilImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='Absolute path of the imported file', max_length=500, unique=True)),
+                ('offset', models.BigIntegerField(default=0, help_text='Byte offset just after the last committed row')),
+                ('line', models.PositiveIntegerField(default=0)),
+                ('header', models.JSONField(blank=True, null=True)),
+                ('imported', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('done', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,6 @@
+import hashlib
+import secrets
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -21,6 +24,10 @@ class CropRecommendation(models.Model):
     # Output
     recommended_crop = models.CharField(max_length=100, help_text="Recommended crop")
     confidence = models.FloatField(null=True, blank=True, help_text="Prediction confidence")
+    device = models.ForeignKey(
+        'SensorDevice', on_delete=models.SET_NULL, null=True, blank=True, related_name='recommendations',
+        help_text="Sensor device the inputs came from, for automatic recommendations"
+    )
     
     # Metadata
     created_at = models.DateTimeField(auto_now_add=True)
@@ -30,6 +37,154 @@ class CropRecommendation(models.Model):
         ordering = ['-created_at']
         verbose_name = 'Crop Recommendation'
         verbose_name_plural = 'Crop Recommendations'
+        indexes = [
+            # Serves per-user history pages newest first (see dashboard.history)
+            models.Index(fields=['user', '-created_at', '-id'], name='croprec_user_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} - {self.recommended_crop} ({self.created_at.strftime('%Y-%m-%d')})"
+
+
+class Conversation(models.Model):
+    """
+    An agronomist chat thread. Turns that have scrolled out of the context
+    window are folded into `summary`.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations')
+    summary = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-updated_at']
+
+    def __str__(self):
+        return f"{self.user.username} - conversation {self.pk}"
+
+
+class ChatMessage(models.Model):
+    ROLE_CHOICES = [
+        ('user', 'User'),
+        ('assistant', 'Assistant'),
+    ]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
+    content = models.TextField()
+    # Estimated once on save so context assembly never re-counts history
+    token_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['conversation', '-id'], name='chatmessage_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}"
+
+
+class SensorDevice(models.Model):
+    """
+    A field sensor that pushes readings with its key in the X-Device-Key
+    header. Only a SHA-256 hash of the key is stored.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sensor_devices')
+    name = models.CharField(max_length=100)
+    key_hash = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_seen_at = models.DateTimeField(null=True, blank=True)
+    # Inputs the sensors don't measure, needed for automatic recommendations
+    city = models.CharField(max_length=50, blank=True, help_text="Forecast city used for rainfall")
+    soil_ph = models.FloatField(null=True, blank=True, help_text="Soil pH from the latest lab test")
+    recommended_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.name}"
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def set_new_key(self):
+        """Generate a new device key, store its hash and return the key itself."""
+        key = secrets.token_urlsafe(32)
+        self.key_hash = self.hash_key(key)
+        return key
+
+
+class SensorReading(models.Model):
+    METRICS = ['nitrogen', 'phosphorus', 'potassium', 'temperature', 'humidity', 'soil_moisture']
+
+    # The (device, timestamp) index also serves device lookups, so no separate FK index
+    device = models.ForeignKey(SensorDevice, on_delete=models.CASCADE, related_name='readings', db_index=False)
+    timestamp = models.DateTimeField()
+    nitrogen = models.FloatField(null=True, blank=True)
+    phosphorus = models.FloatField(null=True, blank=True)
+    potassium = models.FloatField(null=True, blank=True)
+    temperature = models.FloatField(null=True, blank=True)
+    humidity = models.FloatField(null=True, blank=True)
+    soil_moisture = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['device', 'timestamp'], name='sensorreading_device_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.device.name} @ {self.timestamp:%Y-%m-%d %H:%M:%S}"
+
+
+class SensorRollup(models.Model):
+    """
+    Per-device, per-metric aggregate of the readings in one time bucket.
+    Kept up to date by dashboard.sensors.ingest() for every resolution in
+    CROPMATE_SENSORS['ROLLUPS'].
+    """
+    device = models.ForeignKey(SensorDevice, on_delete=models.CASCADE, related_name='rollups', db_index=False)
+    resolution = models.PositiveIntegerField(help_text="Bucket width in seconds")
+    metric = models.CharField(max_length=20)
+    bucket_start = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    total = models.FloatField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+
+    class Meta:
+        constraints = [
+            # Also the index behind range queries
+            models.UniqueConstraint(
+                fields=['device', 'resolution', 'metric', 'bucket_start'], name='sensorrollup_bucket_unique',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.device.name} {self.metric} {self.resolution}s @ {self.bucket_start:%Y-%m-%d %H:%M}"
+
+    @property
+    def average(self):
+        return self.total / self.count
+
+
+class SoilImport(models.Model):
+    """
+    Progress of import_soil_samples for one source file. Saved in the same
+    transaction as each chunk of recommendations, so resuming never inserts
+    a committed chunk twice.
+    """
+    source = models.CharField(max_length=500, unique=True, help_text="Absolute path of the imported file")
+    offset = models.BigIntegerField(default=0, help_text="Byte offset just after the last committed row")
+    line = models.PositiveIntegerField(default=0)
+    header = models.JSONField(null=True, blank=True)
+    imported = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    done = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source} ({self.imported} imported, {self.rejected} rejected)"
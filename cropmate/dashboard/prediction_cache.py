@@ -0,0 +1,139 @@
+"""
+Quantized LRU cache in front of the crop recommendation pipeline.
+
+Sensor readings cluster heavily, so requests that only differ in
+insignificant decimals are snapped to the same bucket of a per-feature grid
+and answered from memory. Misses are predicted on the bucket's own
+coordinates, so every request in a bucket gets the same answer regardless of
+which one arrived first. Entries are dropped when the registry reloads the
+model.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .crop_grid import fast_lookup
+from .crop_model import FEATURE_NAMES, registry
+
+DEFAULT_RESOLUTIONS = {
+    'nitrogen': 1.0,
+    'phosphorus': 1.0,
+    'potassium': 1.0,
+    'temperature': 0.1,
+    'humidity': 0.1,
+    'ph': 0.01,
+    'rainfall': 0.5,
+}
+
+
+class PredictionCache:
+
+    def __init__(self, max_size=10000, ttl=3600, resolutions=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        resolutions = {**DEFAULT_RESOLUTIONS, **(resolutions or {})}
+        self.resolutions = [float(resolutions[name]) for name in FEATURE_NAMES]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._model_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def quantize(self, feature_list):
+        """Return the bucket key and the bucket's representative feature values."""
+        key = tuple(round(x / res) for x, res in zip(feature_list, self.resolutions))
+        values = [k * res for k, res in zip(key, self.resolutions)]
+        return key, values
+
+    def _check_version(self, version):
+        # Called with the lock held
+        if version != self._model_version:
+            self._entries.clear()
+            self._model_version = version
+
+    def get_or_compute(self, pipeline, feature_list, k):
+        key, values = self.quantize(feature_list)
+        key = key + (k,)
+        now = time.monotonic()
+
+        with self._lock:
+            self._check_version(pipeline.version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        result = pipeline.recommend_one(values, k=k)
+
+        with self._lock:
+            # The model may have been reloaded while we were predicting
+            if pipeline.version == self._model_version:
+                self._entries[key] = (now + self.ttl, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'model_version': self._model_version,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_prediction_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = getattr(settings, 'CROPMATE_PREDICTION_CACHE', {})
+                _cache = PredictionCache(
+                    max_size=config.get('MAX_SIZE', 10000),
+                    ttl=config.get('TTL', 3600),
+                    resolutions=config.get('RESOLUTIONS'),
+                )
+    return _cache
+
+
+def recommend_one(feature_list, k=3):
+    """
+    Recommend crops for one row: from the precomputed grid in fast mode, else
+    through the quantized cache when it is enabled, else straight from the model.
+    """
+    hit = fast_lookup(feature_list, k)
+    if hit is not None:
+        top_crops = [{'crop': crop, 'probability': probability} for crop, probability in hit]
+        return {'crop': top_crops[0]['crop'], 'confidence': top_crops[0]['probability'], 'top_crops': top_crops}
+
+    pipeline = registry.get_pipeline()
+    if not getattr(settings, 'CROPMATE_PREDICTION_CACHE', {}).get('ENABLED', True):
+        return pipeline.recommend_one(feature_list, k=k)
+    return get_prediction_cache().get_or_compute(pipeline, feature_list, k)
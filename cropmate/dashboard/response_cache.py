@@ -0,0 +1,192 @@
+"""
+Response cache for agronomist answers.
+
+Questions are normalized (case, punctuation, filler words, plurals) and
+answered from memory when the normalized text was seen before. With
+similarity enabled, a miss is also compared against the cached questions by
+TF-IDF cosine similarity, so "What fertilizer should I use for wheat?" and
+"which fertilizers for wheat" share one answer. Candidates come from an
+inverted index over terms, so a lookup only scores questions that share a
+word with it.
+"""
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+STOPWORDS = frozenset([
+    'a', 'an', 'the', 'i', 'me', 'my', 'we', 'our', 'you', 'your', 'is', 'are', 'am', 'be',
+    'do', 'does', 'can', 'could', 'would', 'should', 'will', 'please', 'tell', 'to', 'of',
+    'for', 'in', 'on', 'at', 'it', 'and', 'or', 'about', 'some', 'any', 'what', 'which',
+    'use', 'using',
+])
+
+_token_re = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    tokens = []
+    for token in _token_re.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def normalize_question(text):
+    return ' '.join(tokenize(text))
+
+
+class ResponseCache:
+
+    def __init__(self, max_size=1000, ttl=86400, similarity=True, threshold=0.85):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.threshold = threshold
+        # normalized question -> (expires_at, term counts, answer)
+        self._entries = OrderedDict()
+        self._index = {}
+        self._df = Counter()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        # Called with the lock held
+        _, terms, _ = self._entries.pop(key)
+        for term in terms:
+            self._df[term] -= 1
+            if not self._df[term]:
+                del self._df[term]
+            keys = self._index[term]
+            keys.discard(key)
+            if not keys:
+                del self._index[term]
+
+    def _weights(self, terms, idf):
+        weights = {}
+        for term, count in terms.items():
+            if term not in idf:
+                idf[term] = math.log((1 + len(self._entries)) / (1 + self._df.get(term, 0))) + 1
+            weights[term] = count * idf[term]
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        return weights, norm
+
+    def _most_similar(self, terms, now):
+        # Called with the lock held
+        candidates = set()
+        for term in terms:
+            candidates.update(self._index.get(term, ()))
+        if not candidates:
+            return None, 0.0
+
+        idf = {}
+        query, query_norm = self._weights(terms, idf)
+        best_key, best_score = None, 0.0
+        for key in candidates:
+            expires_at, entry_terms, _ = self._entries[key]
+            if expires_at <= now:
+                continue
+            weights, norm = self._weights(entry_terms, idf)
+            dot = sum(w * weights.get(term, 0.0) for term, w in query.items())
+            score = dot / (query_norm * norm) if query_norm and norm else 0.0
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+    def get(self, question):
+        """Return the cached answer for `question`, or None."""
+        key = normalize_question(question)
+        if not key:
+            return None
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._remove(key)
+                self.expirations += 1
+
+            if self.similarity:
+                match, score = self._most_similar(Counter(key.split()), now)
+                if match is not None and score >= self.threshold:
+                    self._entries.move_to_end(match)
+                    self.similar_hits += 1
+                    return self._entries[match][2]
+
+            self.misses += 1
+            return None
+
+    def put(self, question, answer):
+        key = normalize_question(question)
+        if not key:
+            return
+        terms = Counter(key.split())
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, terms, answer)
+            for term in terms:
+                self._df[term] += 1
+                self._index.setdefault(term, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._df.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'threshold': self.threshold if self.similarity else None,
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.similar_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The process-wide cache, or None when CROPMATE_AGRONOMIST_CACHE['ENABLED'] is off."""
+    global _cache
+    config = getattr(settings, 'CROPMATE_AGRONOMIST_CACHE', {})
+    if not config.get('ENABLED', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    max_size=config.get('MAX_SIZE', 1000),
+                    ttl=config.get('TTL', 86400),
+                    similarity=config.get('SIMILARITY', True),
+                    threshold=config.get('SIMILARITY_THRESHOLD', 0.85),
+                )
+    return _cache
@@ -0,0 +1,246 @@
+"""
+Live sensor readings for the sensors page.
+
+One broadcaster thread per process looks up the newest reading (by timestamp,
+then pk) of every device whose owner has a viewer, and pushes the devices
+whose newest reading changed since the last tick to every subscribed viewer
+of that owner. Comparing the newest reading rather than following a pk
+cursor keeps the feed in line with snapshot() when readings arrive
+out of order or commit out of pk order. The database cost is a couple of
+queries per tick however many tabs are open, and the thread only runs while
+someone is subscribed.
+
+Subscribers hold at most one pending update per device: when a client reads
+slower than updates arrive, newer readings replace older unsent ones instead
+of queueing. A subscriber that hasn't drained its updates for
+STREAM_STALE_AFTER seconds is dropped so a stuck connection can't pin
+memory or a worker forever.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+from django.db.models import Count, Max, OuterRef, Subquery
+
+from .models import SensorDevice, SensorReading
+from .sensors import get_config
+
+logger = logging.getLogger(__name__)
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+def serialize(reading, name, count=1):
+    update = {
+        'device': reading['device_id'],
+        'name': name,
+        'timestamp': reading['timestamp'].isoformat(),
+        'readings': count,
+    }
+    for metric in SensorReading.METRICS:
+        update[metric] = reading[metric]
+    return update
+
+
+def newest_readings():
+    """Readings of OuterRef('pk')'s device, newest first; ties on timestamp go to the later pk."""
+    return SensorReading.objects.filter(device=OuterRef('pk')).order_by('-timestamp', '-pk')
+
+
+def latest_readings(user_ids):
+    """{device_id: (user_id, name, pk of the newest reading)} for the users' devices that have readings."""
+    devices = (
+        SensorDevice.objects.filter(user_id__in=user_ids)
+        .annotate(latest=Subquery(newest_readings().values('pk')[:1]))
+        .filter(latest__isnull=False)
+        .values_list('pk', 'user_id', 'name', 'latest')
+    )
+    return {pk: (user_id, name, latest) for pk, user_id, name, latest in devices}
+
+
+def snapshot(user_id):
+    """The latest reading of each of the user's devices (one indexed lookup per device)."""
+    updates = []
+    for device in SensorDevice.objects.filter(user_id=user_id).order_by('name'):
+        reading = (
+            SensorReading.objects.filter(device=device).order_by('-timestamp', '-pk')
+            .values('device_id', 'timestamp', *SensorReading.METRICS).first()
+        )
+        if reading is not None:
+            updates.append(serialize(reading, device.name))
+    return updates
+
+
+class Subscription:
+
+    def __init__(self, user_id, loop=None):
+        self.user_id = user_id
+        self.closed = False
+        self.coalesced = 0
+        self.last_read = time.monotonic()
+        self._pending = {}
+        self._cond = threading.Condition()
+        # Set for subscribers consumed by an async generator on that loop
+        self._loop = loop
+        self._event = asyncio.Event() if loop is not None else None
+
+    def _wake(self):
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._event.set)
+            except RuntimeError:
+                # The loop has closed; the subscriber is gone
+                self.closed = True
+
+    def push(self, updates):
+        with self._cond:
+            for update in updates:
+                if update['device'] in self._pending:
+                    self.coalesced += 1
+                self._pending[update['device']] = update
+            self._cond.notify()
+        self._wake()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self._wake()
+
+    def _take(self):
+        updates = list(self._pending.values())
+        self._pending = {}
+        self.last_read = time.monotonic()
+        return updates
+
+    def get(self, timeout):
+        """Block until updates arrive, the subscription closes or `timeout` passes."""
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            return self._take()
+
+    async def aget(self, timeout):
+        with self._cond:
+            if self._pending or self.closed:
+                return self._take()
+            self._event.clear()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            return self._take()
+
+
+class SensorFeed:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._thread = None
+        self._cursor = None
+        # {user_id: {device_id: pk of the newest reading already sent}}
+        self._sent = {}
+
+    def subscribe(self, user_id, loop=None):
+        config = get_config()
+        with self._lock:
+            if sum(len(subs) for subs in self._subscribers.values()) >= config['STREAM_MAX_SUBSCRIBERS']:
+                raise TooManySubscribers()
+            subscription = Subscription(user_id, loop)
+            if user_id not in self._subscribers:
+                # The caller's snapshot covers what is there now; later ticks send what changes
+                self._sent[user_id] = {
+                    device: latest for device, (_, _, latest) in latest_readings([user_id]).items()
+                }
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            if self._thread is None:
+                # Start from the current end of the table; the caller sends a snapshot
+                self._cursor = SensorReading.objects.aggregate(last=Max('pk'))['last'] or 0
+                self._thread = threading.Thread(target=self._run, name='sensor-feed', daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self._lock:
+            subs = self._subscribers.get(subscription.user_id)
+            if subs is not None:
+                subs.discard(subscription)
+                if not subs:
+                    del self._subscribers[subscription.user_id]
+                    self._sent.pop(subscription.user_id, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
+
+    def _run(self):
+        while True:
+            config = get_config()
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+                user_ids = list(self._subscribers)
+            try:
+                self.tick(user_ids, config)
+            except Exception:
+                logger.exception('Sensor feed tick failed')
+            finally:
+                close_old_connections()
+            time.sleep(config['STREAM_INTERVAL'])
+
+    def tick(self, user_ids, config):
+        self._drop_stale(config['STREAM_STALE_AFTER'])
+
+        # The pk cursor only counts the readings each update stands for
+        last = SensorReading.objects.aggregate(last=Max('pk'))['last'] or 0
+        counts = {}
+        if last > self._cursor:
+            counts = dict(
+                SensorReading.objects.filter(pk__gt=self._cursor, pk__lte=last, device__user_id__in=user_ids)
+                .values_list('device_id').annotate(count=Count('pk'))
+            )
+            self._cursor = last
+
+        latest = latest_readings(user_ids)
+        with self._lock:
+            changed = {
+                device: (user_id, name, pk) for device, (user_id, name, pk) in latest.items()
+                if user_id in self._sent and self._sent[user_id].get(device) != pk
+            }
+            for device, (user_id, _, pk) in changed.items():
+                self._sent[user_id][device] = pk
+        if not changed:
+            return
+
+        readings = SensorReading.objects.filter(pk__in=[pk for _, _, pk in changed.values()])
+        by_user = {}
+        for reading in readings.values('device_id', 'timestamp', *SensorReading.METRICS):
+            user_id, name, _ = changed[reading['device_id']]
+            update = serialize(reading, name, counts.get(reading['device_id'], 1))
+            by_user.setdefault(user_id, []).append(update)
+
+        with self._lock:
+            targets = [(sub, by_user[user_id]) for user_id, subs in self._subscribers.items()
+                       if user_id in by_user for sub in subs]
+        for subscription, updates in targets:
+            subscription.push(updates)
+
+    def _drop_stale(self, stale_after):
+        cutoff = time.monotonic() - stale_after
+        with self._lock:
+            stale = [sub for subs in self._subscribers.values() for sub in subs
+                     if sub.closed or sub.last_read < cutoff]
+        for subscription in stale:
+            logger.info('Dropping sensor feed subscriber for user %s', subscription.user_id)
+            self.unsubscribe(subscription)
+
+
+feed = SensorFeed()
@@ -0,0 +1,246 @@
+"""
+Sensor reading ingestion.
+
+Devices POST batches of readings. ingest() validates every row, stores the
+valid ones with a single bulk insert and reports the rest individually, so
+one bad reading never costs the device its whole batch.
+
+Each batch is also folded into SensorRollup buckets (1 minute, 1 hour and
+1 day by default) with one upsert per batch, so history queries read
+pre-aggregated rows instead of raw readings. Committed batches also wake
+the automatic crop recommender (see auto_recommend).
+"""
+import datetime
+import math
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, Func, Max, Min, Sum, Value
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import auto_recommend
+from .crop_model import FEATURE_RANGES
+from .models import SensorDevice, SensorReading, SensorRollup
+
+METRIC_RANGES = {
+    'nitrogen': FEATURE_RANGES['nitrogen'],
+    'phosphorus': FEATURE_RANGES['phosphorus'],
+    'potassium': FEATURE_RANGES['potassium'],
+    'temperature': FEATURE_RANGES['temperature'],
+    'humidity': FEATURE_RANGES['humidity'],
+    'soil_moisture': (0, 100),
+}
+
+DEFAULTS = {
+    'MAX_BATCH': 5000,
+    'MAX_CLOCK_SKEW': 300,
+    'BULK_BATCH_SIZE': 1000,
+    'ROLLUPS': [60, 3600, 86400],
+    'STREAM_INTERVAL': 2,
+    'STREAM_HEARTBEAT': 15,
+    'STREAM_MAX_AGE': 600,
+    'STREAM_STALE_AFTER': 60,
+    'STREAM_MAX_SUBSCRIBERS': 200,
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'CROPMATE_SENSORS', {}))
+    return config
+
+
+def authenticate_device(key):
+    if not key:
+        return None
+    return SensorDevice.objects.filter(key_hash=SensorDevice.hash_key(key)).first()
+
+
+def parse_timestamp(value, now):
+    """Readings carry an ISO 8601 string or Unix seconds; a missing timestamp means now."""
+    if value is None:
+        return now
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromtimestamp(float(value), tz=datetime.timezone.utc)
+        except ValueError:
+            pass
+        parsed = parse_datetime(value)
+        if parsed is not None:
+            return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed, datetime.timezone.utc)
+    raise ValueError('timestamp must be ISO 8601 or Unix seconds')
+
+
+def validate_reading(row, now, max_skew):
+    """Return (field values, errors) for one reading."""
+    if not isinstance(row, dict):
+        return None, ['Reading must be an object']
+
+    errors = []
+    values = {}
+    try:
+        values['timestamp'] = parse_timestamp(row.get('timestamp'), now)
+        if values['timestamp'] > now + datetime.timedelta(seconds=max_skew):
+            errors.append('timestamp is in the future')
+    except (ValueError, OverflowError, OSError) as e:
+        errors.append(str(e))
+
+    for metric, (low, high) in METRIC_RANGES.items():
+        value = row.get(metric)
+        if value is None:
+            values[metric] = None
+            continue
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            errors.append(f'{metric} must be a number')
+            continue
+        if not low <= value <= high:
+            errors.append(f'{metric} must be between {low} and {high}')
+        values[metric] = value
+
+    if all(values.get(metric) is None for metric in METRIC_RANGES) and not errors:
+        errors.append('Reading has no measurements')
+    return values, errors
+
+
+def ingest(device, rows):
+    """Store a batch of readings for `device`. Returns (readings saved, [{'row', 'errors'}])."""
+    config = get_config()
+    now = timezone.now()
+    readings = []
+    rejected = []
+    for i, row in enumerate(rows):
+        values, errors = validate_reading(row, now, config['MAX_CLOCK_SKEW'])
+        if errors:
+            rejected.append({'row': i, 'errors': errors})
+        else:
+            readings.append(SensorReading(device=device, **values))
+
+    with transaction.atomic():
+        SensorReading.objects.bulk_create(readings, batch_size=config['BULK_BATCH_SIZE'])
+        update_rollups(device.pk, readings, config['ROLLUPS'])
+        SensorDevice.objects.filter(pk=device.pk).update(last_seen_at=now)
+        if readings:
+            transaction.on_commit(auto_recommend.notify)
+    return readings, rejected
+
+
+def bucket_start(timestamp, resolution):
+    seconds = int(timestamp.timestamp()) // resolution * resolution
+    return datetime.datetime.fromtimestamp(seconds, tz=datetime.timezone.utc)
+
+
+def aggregate(readings, resolutions):
+    """{(resolution, metric, bucket_start): [count, total, minimum, maximum]} over `readings`."""
+    buckets = {}
+    for reading in readings:
+        seconds = int(reading.timestamp.timestamp())
+        for resolution in resolutions:
+            start = seconds - seconds % resolution
+            for metric in SensorReading.METRICS:
+                value = getattr(reading, metric)
+                if value is None:
+                    continue
+                bucket = buckets.get((resolution, metric, start))
+                if bucket is None:
+                    buckets[(resolution, metric, start)] = [1, value, value, value]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += value
+                    if value < bucket[2]:
+                        bucket[2] = value
+                    if value > bucket[3]:
+                        bucket[3] = value
+    return {
+        (resolution, metric, datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc)): bucket
+        for (resolution, metric, start), bucket in buckets.items()
+    }
+
+
+def update_rollups(device_id, readings, resolutions):
+    """
+    Merge a batch into the rollup tables. The merge happens in the database
+    (INSERT ... ON CONFLICT DO UPDATE), so concurrent batches for the same
+    bucket add up instead of overwriting each other.
+    """
+    buckets = aggregate(readings, resolutions)
+    if not buckets:
+        return
+    qn = connection.ops.quote_name
+    table = qn(SensorRollup._meta.db_table)
+    least, greatest = ('LEAST', 'GREATEST') if connection.vendor == 'postgresql' else ('MIN', 'MAX')
+    sql = (
+        f'INSERT INTO {table} ({qn("device_id")}, {qn("resolution")}, {qn("metric")}, {qn("bucket_start")}, '
+        f'{qn("count")}, {qn("total")}, {qn("minimum")}, {qn("maximum")}) '
+        f'VALUES (%s, %s, %s, %s, %s, %s, %s, %s) '
+        f'ON CONFLICT ({qn("device_id")}, {qn("resolution")}, {qn("metric")}, {qn("bucket_start")}) DO UPDATE SET '
+        f'{qn("count")} = {table}.{qn("count")} + excluded.{qn("count")}, '
+        f'{qn("total")} = {table}.{qn("total")} + excluded.{qn("total")}, '
+        f'{qn("minimum")} = {least}({table}.{qn("minimum")}, excluded.{qn("minimum")}), '
+        f'{qn("maximum")} = {greatest}({table}.{qn("maximum")}, excluded.{qn("maximum")})'
+    )
+    adapt = connection.ops.adapt_datetimefield_value
+    params = [
+        (device_id, resolution, metric, adapt(start), count, total, minimum, maximum)
+        for (resolution, metric, start), (count, total, minimum, maximum) in buckets.items()
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+class Epoch(Func):
+    """Unix seconds of a datetime column, as an integer."""
+    template = 'CAST(EXTRACT(EPOCH FROM %(expressions)s) AS BIGINT)'
+    output_field = BigIntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # %%%% survives both the template and the query's own % formatting
+        return self.as_sql(
+            compiler, connection, template="CAST(strftime('%%%%s', %(expressions)s) AS INTEGER)", **extra_context
+        )
+
+
+def choose_resolution(start, end, points, resolutions):
+    """
+    The coarsest rollup resolution that still yields at least `points`
+    buckets over [start, end), and the step (a multiple of it) its buckets
+    are merged into so that at most `points` are returned.
+    """
+    span = (end - start).total_seconds()
+    resolution = min(resolutions)
+    for candidate in sorted(resolutions, reverse=True):
+        if span / candidate >= points:
+            resolution = candidate
+            break
+    return resolution, resolution * max(1, math.ceil(span / (resolution * points)))
+
+
+def history(device, metrics, start, end, points):
+    """Rollup series for each metric: (step, {metric: [{'t', 'min', 'max', 'avg', 'count'}]})."""
+    resolution, step = choose_resolution(start, end, points, get_config()['ROLLUPS'])
+    # Buckets are merged into step-wide slots by the database, so the response
+    # stays around `points` rows per metric however long the range is
+    rows = (
+        SensorRollup.objects
+        .filter(device=device, resolution=resolution, metric__in=metrics,
+                bucket_start__gte=bucket_start(start, step), bucket_start__lt=end)
+        .annotate(slot=Epoch('bucket_start') / Value(step))
+        .values('metric', 'slot')
+        .annotate(n=Sum('count'), sum=Sum('total'), low=Min('minimum'), high=Max('maximum'))
+        .order_by('metric', 'slot')
+        .values_list('metric', 'slot', 'n', 'sum', 'low', 'high')
+    )
+    series = {metric: [] for metric in metrics}
+    for metric, slot, count, total, minimum, maximum in rows:
+        series[metric].append({
+            't': datetime.datetime.fromtimestamp(slot * step, tz=datetime.timezone.utc).isoformat(),
+            'min': minimum,
+            'max': maximum,
+            'avg': total / count,
+            'count': count,
+        })
+    return step, series
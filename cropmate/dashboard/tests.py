@@ -1,3 +1,1518 @@
-from django.test import TestCase
+import asyncio
+import base64
+import copy
+import csv
+import datetime
+import gzip
+import http.server
+import io
+import json
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+import requests
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from cropmate.asgi import application
+
+from . import (
+    agronomist, auto_recommend, compact_forest, export, fallback, history, http_client, prediction_cache, sensor_feed,
+    sensors, views, weather,
+)
+from .crop_grid import DEFAULT_BOUNDS, CropGrid, build_grid
+from .crop_model import (
+    COMPACT_MODEL_DIRNAME, FEATURE_NAMES, FEATURE_RANGES, ML_MODELS_DIR, ModelRegistry, check_fused_equivalence,
+    file_digest, fuse_scalers, get_pipeline,
+)
+from .models import ChatMessage, Conversation, CropRecommendation, SensorDevice, SensorReading, SensorRollup, SoilImport
+from .prediction_cache import PredictionCache
+from .response_cache import ResponseCache, normalize_question
+from .views import StreamingCleaner, clean_ai_response, get_expert_fallback
+
+SAMPLE = {'N': 90, 'P': 42, 'K': 43, 'temperature': 20.8, 'humidity': 82, 'ph': 6.5, 'rainfall': 202.9}
+CSV_HEADER = 'N,P,K,temperature,humidity,ph,rainfall\n'
+CSV_ROW = '90,42,43,20.8,82,6.5,202.9\n'
+
+
+def random_features(n, seed=0):
+    rng = np.random.default_rng(seed)
+    low = [FEATURE_RANGES[name][0] for name in FEATURE_NAMES]
+    high = [FEATURE_RANGES[name][1] for name in FEATURE_NAMES]
+    return rng.uniform(low, high, size=(n, len(FEATURE_NAMES)))
+
+
+class RecommendationFormTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+
+    def post(self, **fields):
+        data = {'nitrogen': '90', 'phosphorus': '42', 'potassium': '43', 'temperature': '20.8', 'humidity': '82',
+                'ph': '6.5', 'rainfall': '202.9'}
+        data.update(fields)
+        response = self.client.post(reverse('dashboard:recommendations'), data, follow=True)
+        return [str(message) for message in response.context['messages']]
+
+    def test_valid_sample_is_saved(self):
+        self.assertTrue(self.post()[0].startswith('Recommendation: '))
+        self.assertEqual(CropRecommendation.objects.filter(user=self.user).count(), 1)
+
+    def test_non_finite_numbers_are_rejected(self):
+        for value in ('inf', '-Infinity', 'nan', '1e999'):
+            self.assertEqual(self.post(rainfall=value), ['Please fill in all fields with valid numbers.'])
+        self.assertFalse(CropRecommendation.objects.exists())
+
+
+class BatchRecommendationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+
+    def post_json(self, data):
+        return self.client.post(
+            reverse('dashboard:recommendations_batch_api'), json.dumps(data), content_type='application/json',
+        )
+
+    def post_csv(self, text):
+        upload = SimpleUploadedFile('samples.csv', text.encode(), content_type='text/csv')
+        return self.client.post(reverse('dashboard:recommendations_batch_csv'), {'file': upload})
+
+    def test_invalid_rows_are_reported_without_failing_the_batch(self):
+        response = self.post_json({'samples': [
+            SAMPLE,
+            dict(SAMPLE, ph=20),
+            dict(SAMPLE, humidity='wet'),
+            [90, 42, 43, 20.8, 82, 6.5, 202.9],
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['total'], data['saved'], data['failed']), (4, 2, 2))
+        results = data['results']
+        self.assertTrue(results[0]['success'])
+        self.assertTrue(results[0]['recommended_crop'])
+        self.assertEqual(results[0]['input']['nitrogen'], 90)
+        self.assertEqual(results[1], {'row': 1, 'success': False, 'errors': ['ph must be between 0 and 14']})
+        self.assertEqual(results[2]['errors'], ['humidity is missing or not a number'])
+        self.assertTrue(results[3]['success'])
+        self.assertEqual(CropRecommendation.objects.filter(user=self.user).count(), 2)
+
+    def test_csv_upload(self):
+        response = self.post_csv(CSV_HEADER + CSV_ROW + '90,42,,20.8,82,6.5,202.9\n')
+
+        data = response.json()
+        self.assertEqual((data['saved'], data['failed']), (1, 1))
+        self.assertEqual(data['results'][1]['errors'], ['potassium is missing or not a number'])
+
+    @override_settings(CROPMATE_BATCH_MAX_ROWS=3)
+    def test_batches_over_max_rows_are_rejected(self):
+        self.assertEqual(self.post_json([SAMPLE] * 3).status_code, 200)
+
+        for response in (self.post_json([SAMPLE] * 4), self.post_csv(CSV_HEADER + CSV_ROW * 1000)):
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error'], 'Too many rows: at most 3 samples per batch.')
+        self.assertEqual(CropRecommendation.objects.count(), 3)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post_json([]).status_code, 400)
+        response = self.client.post(
+            reverse('dashboard:recommendations_batch_api'), 'not json', content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.post_csv(CSV_HEADER).json()['error'], 'CSV file has no data rows')
+
+
+class SoilImportTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_user('lab', password='password')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'samples.csv')
+        self.rejects = os.path.join(self.directory, 'rejects.csv')
+        rows = [f'{nitrogen},42,43,20.8,82,6.5,202.9\n' for nitrogen in range(23)]
+        # Lines 6 and 15 (counting the header as line 1) are rejected
+        rows[4] = 'abc,42,43,20.8,82,6.5,202.9\n'
+        rows[13] = '13,42,43,20.8,182,6.5,202.9\n'
+        with open(self.path, 'w') as f:
+            f.write(CSV_HEADER + ''.join(rows))
+
+    def run_import(self, **options):
+        call_command('import_soil_samples', self.path, user='lab', chunk_size=5, rejects=self.rejects,
+                     stdout=io.StringIO(), **options)
+
+    def test_resume_after_a_crash_neither_duplicates_nor_loses_rows(self):
+        bulk_create = CropRecommendation.objects.bulk_create
+        calls = []
+
+        def crash_on_third_chunk(objs, **kwargs):
+            calls.append(len(objs))
+            if len(calls) == 3:
+                raise RuntimeError('killed')
+            return bulk_create(objs, **kwargs)
+
+        with mock.patch.object(CropRecommendation.objects, 'bulk_create', side_effect=crash_on_third_chunk):
+            with self.assertRaisesMessage(RuntimeError, 'killed'):
+                self.run_import()
+        progress = SoilImport.objects.get(source=self.path)
+        self.assertEqual((progress.imported, progress.rejected, progress.done), (9, 1, False))
+        self.assertEqual(CropRecommendation.objects.count(), 9)
+
+        self.run_import()
+        nitrogen = sorted(CropRecommendation.objects.values_list('nitrogen', flat=True))
+        self.assertEqual(nitrogen, [n for n in range(23) if n not in (4, 13)])
+        progress.refresh_from_db()
+        self.assertEqual((progress.imported, progress.rejected, progress.done), (21, 2, True))
+        with open(self.rejects) as f:
+            self.assertEqual([row[0] for row in csv.reader(f)], ['6', '15'])
+
+        # A finished import isn't repeated
+        self.run_import()
+        self.assertEqual(CropRecommendation.objects.count(), 21)
+
+    def test_missing_file(self):
+        with self.assertRaisesMessage(CommandError, 'does not exist'):
+            call_command('import_soil_samples', self.path + '.missing', user='lab')
+        self.assertFalse(SoilImport.objects.exists())
+
+
+class FusedScalerTests(SimpleTestCase):
+
+    def test_fused_transform_matches_sklearn(self):
+        pipeline = get_pipeline()
+        self.assertIsNotNone(pipeline.fused)
+        features = random_features(5000)
+
+        fused = pipeline.transform(features)
+        np.testing.assert_allclose(fused, pipeline.transform_unfused(features), rtol=1e-12, atol=1e-12)
+        np.testing.assert_array_equal(
+            pipeline.model.predict(fused), pipeline.model.predict(pipeline.transform_unfused(features)),
+        )
+
+    def test_single_row_transform_matches_batch(self):
+        pipeline = get_pipeline()
+        for row in random_features(50, seed=1).tolist():
+            np.testing.assert_allclose(pipeline.transform_row(row), pipeline.transform([row]), rtol=1e-12)
+
+    def test_equivalence_check(self):
+        self.assertTrue(check_fused_equivalence(get_pipeline())['equivalent'])
+
+    def test_clipping_minmax_scaler_is_not_fused(self):
+        pipeline = get_pipeline()
+        clipping = copy.copy(pipeline.ms)
+        clipping.clip = True
+        self.assertIsNone(fuse_scalers(clipping, pipeline.sc))
+
+
+def copy_model_dir(files=('model.pkl', 'standscaler.pkl', 'minmaxscaler.pkl')):
+    """A temporary ml_models directory holding copies of `files`; removed after the test."""
+    directory = tempfile.mkdtemp()
+    for name in files:
+        shutil.copy2(os.path.join(ML_MODELS_DIR, name), directory)
+    return directory
+
+
+@override_settings(CROPMATE_MODEL_FORMAT='pickle', CROPMATE_MODEL_RELOAD_INTERVAL=0)
+class ModelRegistryTests(SimpleTestCase):
+
+    def test_swapped_artifact_is_reloaded(self):
+        directory = copy_model_dir()
+        self.addCleanup(shutil.rmtree, directory)
+        registry = ModelRegistry(directory)
+        self.assertFalse(registry.stats()['loaded'])
+
+        pipeline = registry.get_pipeline()
+        self.assertIs(registry.get_pipeline(), pipeline)
+        before = registry.stats()
+        self.assertEqual((before['loaded'], before['version'], before['load_count']), (True, 1, 1))
+        self.assertEqual(before['model_format'], 'pickle')
+
+        # Deploy the same model pickled differently, as a redeploy would write new bytes
+        path = os.path.join(directory, 'model.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(pipeline.model, f, protocol=2)
+        os.replace(path + '.tmp', path)
+        mtime = os.stat(path).st_mtime_ns + 10 ** 9
+        os.utime(path, ns=(mtime, mtime))
+
+        reloaded = registry.get_pipeline()
+        after = registry.stats()
+        self.assertIsNot(reloaded, pipeline)
+        self.assertEqual((after['version'], after['load_count']), (2, 2))
+        self.assertNotEqual(after['fingerprint'], before['fingerprint'])
+        self.assertGreaterEqual(after['loaded_at'], before['loaded_at'])
+        row = random_features(1, seed=5)[0].tolist()
+        self.assertEqual(reloaded.recommend_one(row), pipeline.recommend_one(row))
+
+    def test_reload_interval_skips_the_stat(self):
+        registry = ModelRegistry()
+        registry.get_pipeline()
+        with override_settings(CROPMATE_MODEL_RELOAD_INTERVAL=60), mock.patch.object(os, 'stat') as stat:
+            registry.get_pipeline()
+        stat.assert_not_called()
+
+
+class CompactForestTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pipeline = get_pipeline()
+        cls.directory = copy_model_dir(('standscaler.pkl', 'minmaxscaler.pkl'))
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+        compact_forest.export_forest(
+            cls.pipeline.model, os.path.join(cls.directory, COMPACT_MODEL_DIRNAME),
+            file_digest(os.path.join(ML_MODELS_DIR, 'model.pkl')),
+        )
+
+    def test_predictions_match_the_sklearn_forest(self):
+        compact = compact_forest.CompactForest(os.path.join(self.directory, COMPACT_MODEL_DIRNAME))
+        features = self.pipeline.transform(random_features(5000, seed=3))
+
+        np.testing.assert_array_equal(compact.classes_, self.pipeline.model.classes_)
+        np.testing.assert_array_equal(compact.predict_proba(features), self.pipeline.model.predict_proba(features))
+        np.testing.assert_array_equal(compact.predict(features), self.pipeline.model.predict(features))
+
+    @override_settings(CROPMATE_MODEL_FORMAT='auto')
+    def test_compact_mode_loads_without_the_pickle(self):
+        registry = ModelRegistry(self.directory)
+        pipeline = registry.get_pipeline()
+
+        self.assertEqual(registry.model_format, 'compact')
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'model.pkl')))
+        # Same fingerprint as the pickle it was exported from, so grids built on either still apply
+        reference = ModelRegistry()
+        reference.get_pipeline()
+        self.assertEqual(registry.fingerprint, reference.fingerprint)
+        row = random_features(1, seed=4)[0].tolist()
+        self.assertEqual(pipeline.recommend_one(row), self.pipeline.recommend_one(row))
+
+
+def make_recommendation(user, crop='rice', created_at=None, **values):
+    fields = dict(nitrogen=90, phosphorus=42, potassium=43, temperature=20.8, humidity=82, ph=6.5, rainfall=202.9,
+                  confidence=0.9)
+    fields.update(values)
+    recommendation = CropRecommendation.objects.create(user=user, recommended_crop=crop, **fields)
+    if created_at is not None:
+        # auto_now_add ignores a value passed to create()
+        CropRecommendation.objects.filter(pk=recommendation.pk).update(created_at=created_at)
+        recommendation.created_at = created_at
+    return recommendation
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+        crops = ['rice', 'maize', 'cotton']
+        # Enough rows for several BLOCK_SIZE blocks
+        CropRecommendation.objects.bulk_create([
+            CropRecommendation(user=self.user, recommended_crop=crops[i % 3], confidence=i / 3000, nitrogen=i,
+                               phosphorus=42, potassium=43, temperature=20.8, humidity=82, ph=6.5, rainfall=202.9)
+            for i in range(3000)
+        ])
+        make_recommendation(User.objects.create_user('neighbour'), crop='jute')
+
+    def expected(self, user=None):
+        queryset = CropRecommendation.objects.order_by('id')
+        if user is not None:
+            queryset = queryset.filter(user=user)
+        return [(r.pk, r.recommended_crop, r.nitrogen) for r in queryset]
+
+    def from_csv(self, data):
+        reader = csv.DictReader(io.StringIO(data.decode()))
+        self.assertEqual(reader.fieldnames, export.COLUMNS)
+        return [(int(row['id']), row['recommended_crop'], float(row['nitrogen'])) for row in reader]
+
+    def from_ndjson(self, data):
+        rows = [json.loads(line) for line in data.decode().splitlines()]
+        return [(row['id'], row['recommended_crop'], row['nitrogen']) for row in rows]
+
+    def test_gzipped_csv_stream(self):
+        response = self.client.get(reverse('dashboard:recommendations_export'), {'gzip': '1'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('crop-recommendations.csv.gz', response['Content-Disposition'])
+        blocks = list(response.streaming_content)
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(self.from_csv(gzip.decompress(b''.join(blocks))), self.expected(self.user))
+
+    def test_ndjson_stream(self):
+        response = self.client.get(reverse('dashboard:recommendations_export'), {'format': 'ndjson'})
+        self.assertEqual(self.from_ndjson(b''.join(response.streaming_content)), self.expected(self.user))
+
+    async def test_async_gzipped_stream(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.get(reverse('dashboard:recommendations_export'),
+                                               {'format': 'ndjson', 'gzip': '1'})
+        data = b''.join([block async for block in response.streaming_content])
+        rows = self.from_ndjson(gzip.decompress(data))
+        self.assertEqual(rows, await sync_to_async(self.expected)(self.user))
+
+    def test_command_writes_every_users_rows(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'export.csv.gz')
+        call_command('export_recommendations', path, gzip=True, chunk_size=500, stdout=io.StringIO())
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(self.from_csv(f.read()), self.expected())
+
+        call_command('export_recommendations', path, user='neighbour', format='ndjson', stdout=io.StringIO())
+        with open(path, 'rb') as f:
+            self.assertEqual([crop for _, crop, _ in self.from_ndjson(f.read())], ['jute'])
+
+
+class RecommendationHistoryTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+
+    def pages(self, limit):
+        ids, cursor = [], None
+        while True:
+            rows, cursor = history.page(self.user, cursor, limit)
+            ids.extend(row.pk for row in rows)
+            if cursor is None:
+                return ids
+
+    def test_pages_cover_rows_sharing_a_timestamp_exactly_once(self):
+        now = timezone.now()
+        tied = now - datetime.timedelta(hours=1)
+        created = [
+            make_recommendation(self.user, created_at=now),
+            *(make_recommendation(self.user, created_at=tied) for _ in range(4)),
+            make_recommendation(self.user, created_at=now - datetime.timedelta(hours=2)),
+        ]
+        make_recommendation(User.objects.create_user('neighbour'))
+
+        expected = [r.pk for r in sorted(created, key=lambda r: (r.created_at, r.pk), reverse=True)]
+        for limit in (1, 2, 3, 10):
+            self.assertEqual(self.pages(limit), expected)
+
+    def test_last_page_has_no_cursor(self):
+        for _ in range(2):
+            make_recommendation(self.user)
+        rows, cursor = history.page(self.user, limit=2)
+        self.assertEqual(len(rows), 2)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursors(self):
+        def encode(key):
+            return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+        for cursor in ('garbage!', encode('no separator'), encode('yesterday|5'), encode('2026-01-01T00:00:00|x'),
+                       base64.urlsafe_b64encode(b'\xff\xfe').decode()):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(history.InvalidCursor):
+                    history.decode_cursor(cursor)
+
+        response = self.client.get(reverse('dashboard:recommendation_history_api'), {'cursor': 'garbage!'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('dashboard:recommendation_history'), {'cursor': 'garbage!'})
+        self.assertRedirects(response, reverse('dashboard:recommendation_history'))
+
+    def test_api_pages_and_stats(self):
+        for _ in range(3):
+            make_recommendation(self.user)
+
+        first = self.client.get(reverse('dashboard:recommendation_history_api'), {'limit': 2, 'stats': 1}).json()
+        self.assertEqual(len(first['results']), 2)
+        self.assertEqual(first['stats']['total'], 3)
+        second = self.client.get(
+            reverse('dashboard:recommendation_history_api'), {'limit': 2, 'cursor': first['next_cursor']},
+        ).json()
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next_cursor'])
+        self.assertNotIn('stats', second)
+
+    def test_aggregates(self):
+        make_recommendation(self.user, 'rice', nitrogen=80, confidence=0.5)
+        make_recommendation(self.user, 'rice', nitrogen=100, confidence=0.7)
+        make_recommendation(self.user, 'maize', nitrogen=60, confidence=0.9)
+        make_recommendation(User.objects.create_user('neighbour'), 'maize')
+
+        stats = history.aggregates(self.user)
+        self.assertEqual(stats['total'], 3)
+        rice, maize = stats['crops']
+        self.assertEqual((rice['recommended_crop'], rice['count']), ('rice', 2))
+        self.assertAlmostEqual(rice['avg_nitrogen'], 90)
+        self.assertAlmostEqual(rice['avg_confidence'], 0.6)
+        self.assertAlmostEqual(rice['share'], 2 / 3)
+        self.assertEqual((maize['recommended_crop'], maize['count']), ('maize', 1))
+
+    def test_aggregates_without_recommendations(self):
+        self.assertEqual(history.aggregates(self.user), {'total': 0, 'crops': []})
+
+
+# Keyword checks of the fallback before it moved to a rule table, in the
+# order the old get_expert_fallback() tried them
+LEGACY_FALLBACK_KEYWORDS = [
+    ['hello', 'hi', 'hey', 'greetings', 'good morning', 'good afternoon', 'good evening', 'howdy', 'sup',
+     "what's up"],
+    ['thank', 'thanks', 'appreciate', 'helpful'],
+    ['how are you', 'how r u'],
+    ['crop'], ['soil'], ['pest'], ['water'], ['fertilizer'], ['plant'], ['weather'],
+]
+
+
+def legacy_fallback_rule(message):
+    message = message.lower()
+    for index, keywords in enumerate(LEGACY_FALLBACK_KEYWORDS):
+        if any(keyword in message for keyword in keywords):
+            return index
+    return None
+
+
+class FallbackMatcherTests(SimpleTestCase):
+
+    def test_table_keeps_the_legacy_rules_and_order(self):
+        rules, default = fallback.load_table(fallback.DEFAULT_TABLE)
+        self.assertEqual([rule['keywords'] for rule in rules], LEGACY_FALLBACK_KEYWORDS)
+        self.assertTrue(default.startswith("That's an interesting question!"))
+
+    def test_matches_the_legacy_keyword_fallback(self):
+        rng = random.Random(0)
+        keywords = [keyword for rule in LEGACY_FALLBACK_KEYWORDS for keyword in rule]
+        fragments = keywords + [keyword[:-1] for keyword in keywords] + [
+            'my', 'field', 'the', 'maize', 'is', 'dry', 'what', 'WATER', 'Soil', 'how', 'are', 'you', 'r', 'u',
+            'good', 'up', "what's", 'plan', 'thx', '?', '!', 'fertiliser', 'pH',
+        ]
+        messages = ['', ' ', 'this', 'Whitespace', 'sup?', 'HOW ARE YOU', 'plants and pests', 'soil water crop']
+        for _ in range(5000):
+            words = rng.choices(fragments, k=rng.randint(1, 8))
+            messages.append(rng.choice(['', ' ']).join(words))
+
+        for message in messages:
+            with self.subTest(message=message):
+                self.assertEqual(fallback.matcher.match(message), legacy_fallback_rule(message))
+
+    def test_responses(self):
+        self.assertEqual(get_expert_fallback('Best CROP for clay?'), fallback.matcher.responses[3])
+        # Substring semantics, as before: "this" contains "hi"
+        self.assertEqual(get_expert_fallback('Is this soil acidic?'), fallback.matcher.responses[0])
+        self.assertEqual(get_expert_fallback('Irrigation schedule for maize'), fallback.matcher.default)
+
+    def test_overlapping_keywords(self):
+        matcher = fallback.FallbackMatcher(
+            [{'keywords': ['tomato'], 'response': 'a'}, {'keywords': ['atom'], 'response': 'b'}], 'none',
+        )
+        self.assertEqual(matcher.respond('an atomato'), 'a')
+        self.assertEqual(matcher.respond('an atom'), 'b')
+        self.assertEqual(fallback.FallbackMatcher([], 'none').respond('anything'), 'none')
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def test_normalization(self):
+        self.assertEqual(normalize_question('What fertilizer should I use for wheat?'), 'fertilizer wheat')
+        self.assertEqual(normalize_question('Which FERTILIZERS for wheat!!'), 'fertilizer wheat')
+        self.assertEqual(normalize_question('What is it?'), '')
+
+    def test_exact_hit_after_normalization(self):
+        cache = ResponseCache()
+        cache.put('What fertilizer should I use for wheat?', 'urea')
+        self.assertEqual(cache.get('which fertilizers for WHEAT'), 'urea')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_similar_question_hits(self):
+        cache = ResponseCache()
+        cache.put('Best nitrogen fertilizer schedule for irrigated wheat', 'split doses')
+        self.assertEqual(cache.get('best nitrogen fertilizer schedule for wheat'), 'split doses')
+        self.assertEqual(cache.stats()['similar_hits'], 1)
+
+    def test_questions_about_different_crops_miss(self):
+        cache = ResponseCache()
+        cache.put('water maize', 'maize answer')
+        cache.put('How much water does maize need?', 'maize answer')
+        self.assertIsNone(cache.get('water wheat'))
+        self.assertIsNone(cache.get('How much water does wheat need?'))
+        self.assertIsNone(cache.get('fertilizer for rice'))
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_similarity_can_be_turned_off(self):
+        cache = ResponseCache(similarity=False)
+        cache.put('Best nitrogen fertilizer schedule for irrigated wheat', 'split doses')
+        self.assertIsNone(cache.get('best nitrogen fertilizer schedule for wheat'))
+
+    def test_expiry_and_eviction(self):
+        expired = ResponseCache(ttl=0)
+        expired.put('water maize', 'answer')
+        self.assertIsNone(expired.get('water maize'))
+        self.assertEqual(expired.stats()['expirations'], 1)
+
+        cache = ResponseCache(max_size=2)
+        cache.put('water maize', 'maize')
+        cache.put('water rice', 'rice')
+        cache.get('water maize')
+        cache.put('water cotton', 'cotton')
+        self.assertIsNone(cache.get('water rice'))
+        self.assertEqual(cache.get('water maize'), 'maize')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_evicted_questions_leave_the_index(self):
+        cache = ResponseCache(max_size=1)
+        cache.put('Best nitrogen fertilizer schedule for irrigated wheat', 'split doses')
+        cache.put('water maize', 'maize')
+        self.assertIsNone(cache.get('best nitrogen fertilizer schedule for wheat'))
+        self.assertNotIn('fertilizer', cache._index)
+
+
+class AgronomistCacheTests(TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+        patcher = mock.patch.object(views, 'get_response_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ask(self, username, message):
+        user, _ = User.objects.get_or_create(username=username)
+        self.client.force_login(user)
+        response = self.client.post(reverse('dashboard:ask_agronomist'), json.dumps({'message': message}),
+                                    content_type='application/json')
+        return response.json()
+
+    def test_hits_are_not_written_back(self):
+        first = self.ask('first', 'Best nitrogen fertilizer schedule for irrigated wheat')
+        self.assertNotIn('cached', first)
+        key = 'best nitrogen fertilizer schedule irrigated wheat'
+        expires_at = self.cache._entries[key][0]
+
+        with mock.patch.object(self.cache, 'put', wraps=self.cache.put) as put:
+            exact = self.ask('second', 'best nitrogen fertilizers schedule for IRRIGATED wheat')
+            similar = self.ask('third', 'best nitrogen fertilizer schedule for wheat')
+        self.assertTrue(exact['cached'])
+        self.assertEqual(similar['response'], first['response'])
+        put.assert_not_called()
+        # Neither renewed nor duplicated under the similar question
+        self.assertEqual(list(self.cache._entries), [key])
+        self.assertEqual(self.cache._entries[key][0], expires_at)
+        self.assertEqual(self.cache.stats()['similar_hits'], 1)
+
+    def test_standalone_questions_use_the_cache_mid_conversation(self):
+        self.ask('first', 'How much water does maize need?')
+        self.ask('second', 'Which soil suits cotton best?')
+
+        standalone = self.ask('second', 'how much water does MAIZE need')
+        self.assertTrue(standalone['cached'])
+
+        with mock.patch.object(self.cache, 'get', wraps=self.cache.get) as get:
+            follow_up = self.ask('second', 'What about its pests?')
+            continuation = self.ask('second', 'and for rice?')
+        self.assertNotIn('cached', follow_up)
+        self.assertNotIn('cached', continuation)
+        get.assert_not_called()
+        self.assertNotIn('pest', ' '.join(self.cache._entries))
+
+
+class AgronomistServiceTests(TestCase):
+
+    def service(self, max_concurrency=1, timeout=0.1, delay=0.0):
+        backend = agronomist.FakeBackend({'FAKE_REPLY': 'Answer to: {question}', 'FAKE_DELAY': delay})
+        return agronomist.AgronomistService(backend, timeout=timeout, max_concurrency=max_concurrency)
+
+    def test_fake_backend(self):
+        service = self.service()
+        self.assertEqual(service.complete('Best soil for rice?'), 'Answer to: Best soil for rice?')
+        self.assertEqual(''.join(service.stream('Best soil for rice?')), 'Answer to: Best soil for rice?')
+        self.assertEqual(asyncio.run(service.acomplete('Why?')), 'Answer to: Why?')
+
+    def test_blocking_calls_beyond_the_limit_are_refused(self):
+        service = self.service(max_concurrency=2)
+        held = [service.stream('one'), service.stream('two')]
+        for stream in held:
+            next(stream)
+        with self.assertRaises(agronomist.AgronomistUnavailable):
+            service.complete('three')
+
+        held[0].close()
+        self.assertEqual(service.complete('three'), 'Answer to: three')
+
+    def test_async_calls_beyond_the_limit_are_refused(self):
+        service = self.service(max_concurrency=2)
+
+        async def overflow():
+            held = [service.astream('one'), service.astream('two')]
+            for stream in held:
+                await stream.__anext__()
+            with self.assertRaises(agronomist.AgronomistUnavailable):
+                await service.acomplete('three')
+            await held[0].aclose()
+            self.assertEqual(await service.acomplete('three'), 'Answer to: three')
+            await held[1].aclose()
+
+        asyncio.run(overflow())
+
+    def test_slow_answers_time_out(self):
+        service = self.service(timeout=0.05, delay=0.2)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(service.acomplete('slow'))
+
+    def test_overflow_gets_the_expert_fallback(self):
+        service = self.service()
+        held = service.stream('held')
+        next(held)
+        self.addCleanup(held.close)
+        self.client.force_login(User.objects.create_user('farmer'))
+
+        message = 'How do I control aphids on cotton?'
+        with mock.patch.object(agronomist, 'get_service', return_value=service), \
+                mock.patch.object(views, 'get_response_cache', return_value=None):
+            response = self.client.post(reverse('dashboard:ask_agronomist'), json.dumps({'message': message}),
+                                        content_type='application/json')
+
+        self.assertEqual(response.json(), {'success': True, 'response': get_expert_fallback(message)})
+
+
+class ConversationMemoryTests(TestCase):
+
+    def history(self, turns, tokens=10):
+        messages = []
+        for i in range(1, turns + 1):
+            messages += [('user', f'question {i}', tokens), ('assistant', f'answer {i}', tokens)]
+        return messages
+
+    def test_window_keeps_the_newest_turns_that_fit(self):
+        # 35 tokens fit three messages, but the window never opens on an answer
+        messages = agronomist.build_context('', self.history(4), budget=35, summary_budget=100)
+
+        self.assertEqual(messages[1:], [
+            {'role': 'user', 'content': 'question 4'}, {'role': 'assistant', 'content': 'answer 4'},
+        ])
+        self.assertEqual(messages[0]['role'], 'system')
+        self.assertTrue(messages[0]['content'].endswith('question 1\nquestion 2\nquestion 3'))
+
+    def test_everything_fits(self):
+        history = self.history(2)
+        messages = agronomist.build_context('', history, budget=1000, summary_budget=100)
+        self.assertEqual([(m['role'], m['content']) for m in messages], [(r, c) for r, c, _ in history])
+
+    def test_summary_keeps_the_newest_lines_within_budget(self):
+        summary = agronomist.fold_summary('old one\nold two', ['new   question\n here', 'x' * 400], budget=45)
+        lines = summary.split('\n')
+        # The long question is cut to 40 tokens, so only the line before it still fits
+        self.assertEqual(lines[0], 'new question here')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith('...'))
+        self.assertEqual(agronomist.estimate_tokens(lines[1]), 40)
+
+    @override_settings(CROPMATE_AGRONOMIST={'HISTORY_TURNS': 2, 'CONTEXT_TOKENS': 1000, 'SUMMARY_TOKENS': 200})
+    def test_turns_leaving_the_window_are_folded_into_the_summary(self):
+        user = User.objects.create_user('farmer')
+        self.assertEqual(agronomist.load_conversation(user), (None, []))
+
+        conversation = None
+        for i in range(1, 4):
+            conversation = agronomist.record_turn(user, conversation, f'question {i}', f'answer {i}')
+
+        self.assertEqual(Conversation.objects.filter(user=user).count(), 1)
+        self.assertEqual(ChatMessage.objects.filter(conversation=conversation).count(), 6)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.summary, 'question 1')
+
+        loaded, context = agronomist.load_conversation(user)
+        self.assertEqual(loaded, conversation)
+        self.assertEqual(context[0]['content'], 'Earlier in this conversation the farmer asked:\nquestion 1')
+        self.assertEqual([m['content'] for m in context[1:]], ['question 2', 'answer 2', 'question 3', 'answer 3'])
+        self.assertEqual(agronomist.recent_messages(user, limit=2),
+                         [{'role': 'user', 'content': 'question 3'}, {'role': 'assistant', 'content': 'answer 3'}])
+
+
+def make_device(user, name='field-1'):
+    device = SensorDevice(user=user, name=name)
+    key = device.set_new_key()
+    device.save()
+    return device, key
+
+
+class SensorIngestTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.device, self.key = make_device(self.user)
+
+    def post(self, data, key=None):
+        return self.client.post(
+            reverse('dashboard:sensor_ingest_api'), json.dumps(data), content_type='application/json',
+            HTTP_X_DEVICE_KEY=self.key if key is None else key,
+        )
+
+    def test_requires_a_device_key(self):
+        self.assertEqual(self.post([{'nitrogen': 50}], key='').status_code, 401)
+        self.assertEqual(self.post([{'nitrogen': 50}], key='wrong').status_code, 401)
+
+    def test_invalid_readings_are_rejected_individually(self):
+        future = (timezone.now() + datetime.timedelta(hours=1)).isoformat()
+        response = self.post({'readings': [
+            {'timestamp': '2026-01-01T10:00:00Z', 'nitrogen': 50, 'humidity': 60},
+            {'timestamp': future, 'nitrogen': 50},
+            {'nitrogen': 501},
+            {'humidity': 'damp'},
+            {'timestamp': 'yesterday', 'nitrogen': 50},
+            {},
+            'not an object',
+            {'timestamp': 1767261600, 'soil_moisture': 30},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['total'], data['saved'], data['failed']), (8, 2, 6))
+        errors = {item['row']: item['errors'] for item in data['rejected']}
+        self.assertEqual(errors[1], ['timestamp is in the future'])
+        self.assertEqual(errors[2], ['nitrogen must be between 0 and 500'])
+        self.assertEqual(errors[3], ['humidity must be a number'])
+        self.assertEqual(errors[4], ['timestamp must be ISO 8601 or Unix seconds'])
+        self.assertEqual(errors[5], ['Reading has no measurements'])
+        self.assertEqual(errors[6], ['Reading must be an object'])
+
+        readings = SensorReading.objects.filter(device=self.device).order_by('timestamp')
+        self.assertEqual([r.timestamp.isoformat() for r in readings],
+                         ['2026-01-01T10:00:00+00:00', '2026-01-01T10:00:00+00:00'])
+        self.assertIsNone(readings[0].potassium)
+        self.device.refresh_from_db()
+        self.assertIsNotNone(self.device.last_seen_at)
+
+    @override_settings(CROPMATE_SENSORS={'MAX_BATCH': 2})
+    def test_batch_size_limit(self):
+        response = self.post([{'nitrogen': 50}] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(SensorReading.objects.exists())
+
+    def test_bad_bodies(self):
+        self.assertEqual(self.post([]).status_code, 400)
+        response = self.client.post(reverse('dashboard:sensor_ingest_api'), '{', content_type='application/json',
+                                    HTTP_X_DEVICE_KEY=self.key)
+        self.assertEqual(response.status_code, 400)
+
+    def rollup(self, resolution, bucket_start):
+        return SensorRollup.objects.get(device=self.device, resolution=resolution, metric='temperature',
+                                        bucket_start=bucket_start)
+
+    def test_rollups_merge_across_batches(self):
+        t0 = datetime.datetime(2026, 1, 1, 10, 0, tzinfo=datetime.timezone.utc)
+
+        def at(seconds, temperature):
+            return {'timestamp': (t0 + datetime.timedelta(seconds=seconds)).isoformat(), 'temperature': temperature}
+
+        sensors.ingest(self.device, [at(10, 20), at(40, 30)])
+        sensors.ingest(self.device, [at(50, 10), at(65, 25)])
+
+        minute = self.rollup(60, t0)
+        self.assertEqual((minute.count, minute.total, minute.minimum, minute.maximum), (3, 60, 10, 30))
+        self.assertEqual(minute.average, 20)
+        self.assertEqual(self.rollup(60, t0 + datetime.timedelta(minutes=1)).count, 1)
+        for resolution, start in ((3600, t0), (86400, t0.replace(hour=0))):
+            bucket = self.rollup(resolution, start)
+            self.assertEqual((bucket.count, bucket.total, bucket.minimum, bucket.maximum), (4, 85, 10, 30))
+        # Only metrics that were measured get buckets
+        self.assertFalse(SensorRollup.objects.filter(metric='nitrogen').exists())
+
+    def test_aggregate_matches_readings(self):
+        t0 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        readings = [
+            SensorReading(device=self.device, timestamp=t0 + datetime.timedelta(seconds=37 * i), humidity=40 + i % 7)
+            for i in range(500)
+        ]
+        buckets = sensors.aggregate(readings, [60, 3600])
+
+        for resolution in (60, 3600):
+            counts = [b[0] for (r, metric, _), b in buckets.items() if r == resolution]
+            totals = [b[1] for (r, metric, _), b in buckets.items() if r == resolution]
+            self.assertEqual(sum(counts), 500)
+            self.assertAlmostEqual(sum(totals), sum(r.humidity for r in readings))
+        for (resolution, metric, start), (count, total, minimum, maximum) in buckets.items():
+            inside = [r.humidity for r in readings
+                      if start <= r.timestamp < start + datetime.timedelta(seconds=resolution)]
+            self.assertEqual((count, minimum, maximum), (len(inside), min(inside), max(inside)))
+
+
+class CountingPipeline:
+    """Stands in for CropPipeline, recording what it was asked to predict."""
+
+    def __init__(self, version=1):
+        self.version = version
+        self.calls = []
+
+    def recommend_one(self, feature_list, k=3):
+        self.calls.append((list(feature_list), k))
+        return {'crop': 'rice', 'confidence': 0.9, 'top_crops': [], 'input': list(feature_list)}
+
+
+class PredictionCacheTests(SimpleTestCase):
+
+    SAMPLE = [90.2, 42.4, 43.1, 20.84, 82.01, 6.502, 202.9]
+
+    def test_nearby_inputs_share_a_bucket(self):
+        cache = PredictionCache()
+        pipeline = CountingPipeline()
+
+        first = cache.get_or_compute(pipeline, self.SAMPLE, 3)
+        second = cache.get_or_compute(pipeline, [90.4, 41.6, 42.9, 20.79, 82.04, 6.498, 203.1], 3)
+
+        self.assertIs(first, second)
+        self.assertEqual(len(pipeline.calls), 1)
+        # Predicted on the bucket's coordinates, not on whichever input came first
+        np.testing.assert_allclose(pipeline.calls[0][0], [90, 42, 43, 20.8, 82.0, 6.5, 203.0])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_other_buckets_and_k_miss(self):
+        cache = PredictionCache()
+        pipeline = CountingPipeline()
+        cache.get_or_compute(pipeline, self.SAMPLE, 3)
+        cache.get_or_compute(pipeline, self.SAMPLE, 1)
+        cache.get_or_compute(pipeline, [91] + self.SAMPLE[1:], 3)
+        self.assertEqual(len(pipeline.calls), 3)
+
+    def test_custom_resolution(self):
+        cache = PredictionCache(resolutions={'nitrogen': 10})
+        self.assertEqual(cache.quantize(self.SAMPLE)[0][0], 9)
+        self.assertEqual(cache.quantize([96] + self.SAMPLE[1:])[0][0], 10)
+
+    def test_model_reload_empties_the_cache(self):
+        cache = PredictionCache()
+        cache.get_or_compute(CountingPipeline(version=1), self.SAMPLE, 3)
+        reloaded = CountingPipeline(version=2)
+        cache.get_or_compute(reloaded, self.SAMPLE, 3)
+        self.assertEqual(len(reloaded.calls), 1)
+        self.assertEqual(cache.stats()['model_version'], 2)
+
+    def test_expiry_and_eviction(self):
+        pipeline = CountingPipeline()
+        expiring = PredictionCache(ttl=0)
+        expiring.get_or_compute(pipeline, self.SAMPLE, 3)
+        expiring.get_or_compute(pipeline, self.SAMPLE, 3)
+        self.assertEqual(expiring.stats()['expirations'], 1)
+
+        cache = PredictionCache(max_size=2)
+        for nitrogen in (10, 20, 10, 30):
+            cache.get_or_compute(pipeline, [nitrogen] + self.SAMPLE[1:], 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        calls = len(pipeline.calls)
+        cache.get_or_compute(pipeline, [10] + self.SAMPLE[1:], 3)
+        self.assertEqual(len(pipeline.calls), calls)
+
+    def test_cached_answer_matches_the_model(self):
+        pipeline = get_pipeline()
+        cache = PredictionCache()
+        for row in random_features(20, seed=2).tolist():
+            _, values = cache.quantize(row)
+            self.assertEqual(cache.get_or_compute(pipeline, row, 3), pipeline.recommend_one(values, k=3))
+
+
+class SensorHistoryTests(TestCase):
+
+    START = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    END = START + datetime.timedelta(days=2)
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+        self.device, _ = make_device(self.user)
+        # A reading every 10 minutes for two days
+        self.readings = [
+            (self.START + datetime.timedelta(minutes=10 * i), float(i % 50))
+            for i in range(2 * 24 * 6)
+        ]
+        sensors.ingest(self.device, [{'timestamp': t.isoformat(), 'nitrogen': n} for t, n in self.readings])
+
+    def get_history(self, start, end, points):
+        response = self.client.get(
+            reverse('dashboard:sensor_history_api', args=[self.device.pk]),
+            {'metrics': 'nitrogen', 'start': int(start.timestamp()), 'end': int(end.timestamp()), 'points': points},
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return data['resolution'], data['series']['nitrogen']
+
+    def expected(self, start, end, step):
+        slots = {}
+        for t, n in self.readings:
+            if start.timestamp() // step * step <= t.timestamp() < end.timestamp():
+                slots.setdefault(int(t.timestamp()) // step * step, []).append(n)
+        return [(slot, values) for slot, values in sorted(slots.items())]
+
+    def assert_series(self, series, start, end, step):
+        expected = self.expected(start, end, step)
+        self.assertEqual(len(series), len(expected))
+        for point, (slot, values) in zip(series, expected):
+            self.assertEqual(datetime.datetime.fromisoformat(point['t']).timestamp(), slot)
+            self.assertEqual(point['count'], len(values))
+            self.assertAlmostEqual(point['avg'], sum(values) / len(values))
+            self.assertEqual((point['min'], point['max']), (min(values), max(values)))
+
+    def test_choose_resolution(self):
+        hour = datetime.timedelta(hours=1)
+        self.assertEqual(sensors.choose_resolution(self.START, self.START + hour, 200, [60, 3600, 86400]), (60, 60))
+        self.assertEqual(sensors.choose_resolution(self.START, self.START + hour, 6, [60, 3600, 86400]), (60, 600))
+        month = datetime.timedelta(days=30)
+        # 720 hourly buckets merged four at a time stay under 200
+        self.assertEqual(sensors.choose_resolution(self.START, self.START + month, 200, [60, 3600, 86400]),
+                         (3600, 14400))
+        self.assertEqual(sensors.choose_resolution(self.START, self.START + month, 20, [60, 3600, 86400]),
+                         (86400, 86400 * 2))
+
+    def test_short_range_uses_minute_rollups(self):
+        start, end = self.START + datetime.timedelta(hours=5), self.START + datetime.timedelta(hours=7)
+        step, series = self.get_history(start, end, 200)
+        self.assertEqual(step, 60)
+        self.assertEqual(len(series), 12)
+        self.assert_series(series, start, end, step)
+
+    def test_long_range_is_merged_down_to_the_point_count(self):
+        step, series = self.get_history(self.START, self.END, 10)
+        # 48 hourly buckets merged five at a time
+        self.assertEqual(step, 5 * 3600)
+        self.assertLessEqual(len(series), 11)
+        self.assert_series(series, self.START, self.END, step)
+        self.assertEqual(sum(point['count'] for point in series), len(self.readings))
+
+    def test_merged_slots_match_the_finer_rollup(self):
+        start, end = self.START, self.START + datetime.timedelta(hours=6)
+        step, series = self.get_history(start, end, 4)
+        self.assertEqual(step, 2 * 3600)
+        self.assertEqual(len(series), 3)
+        self.assert_series(series, start, end, step)
+
+
+class SensorStreamTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+
+    def test_failed_snapshot_releases_the_subscription(self):
+        before = sensor_feed.feed.subscriber_count()
+        with mock.patch.object(sensor_feed, 'snapshot', side_effect=RuntimeError('database is down')):
+            with self.assertRaises(RuntimeError):
+                self.client.get(reverse('dashboard:sensor_stream'))
+        self.assertEqual(sensor_feed.feed.subscriber_count(), before)
+
+    @override_settings(CROPMATE_SENSORS={'STREAM_MAX_SUBSCRIBERS': 0})
+    def test_subscriber_limit(self):
+        response = self.client.get(reverse('dashboard:sensor_stream'))
+        self.assertEqual(response.status_code, 503)
+
+    def subscribe(self):
+        feed = sensor_feed.SensorFeed()
+        with mock.patch.object(sensor_feed.threading, 'Thread'):
+            subscription = feed.subscribe(self.user.pk)
+        return feed, subscription
+
+    def tick(self, feed):
+        feed.tick([self.user.pk], sensors.get_config())
+
+    def test_live_value_is_the_newest_by_timestamp(self):
+        device, _ = make_device(self.user)
+        feed, subscription = self.subscribe()
+        now = timezone.now()
+        # Newest first, so the oldest reading gets the highest pk
+        sensors.ingest(device, [
+            {'timestamp': (now - datetime.timedelta(minutes=minutes)).isoformat(), 'nitrogen': 100 - minutes}
+            for minutes in (1, 2, 3)
+        ])
+        self.tick(feed)
+
+        [update] = subscription.get(0)
+        self.assertEqual(update['nitrogen'], 99)
+        self.assertEqual(update['readings'], 3)
+        self.assertEqual(update['timestamp'], sensor_feed.snapshot(self.user.pk)[0]['timestamp'])
+
+    def test_rows_behind_the_cursor_still_reach_viewers(self):
+        device, _ = make_device(self.user)
+        feed, subscription = self.subscribe()
+        self.tick(feed)
+        # As if a transaction that took lower pks committed after the cursor moved past them
+        feed._cursor += 1000
+        sensors.ingest(device, [{'nitrogen': 80}])
+        self.tick(feed)
+
+        [update] = subscription.get(0)
+        self.assertEqual(update['nitrogen'], 80)
+        self.tick(feed)
+        self.assertEqual(subscription.get(0), [])
+
+
+class AutoRecommendTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('farmer', password='password')
+        self.forecast_cities = {'Lahore'}
+
+    def device(self, name, city='Lahore', **readings):
+        device, _ = make_device(self.user, name)
+        device.city = city
+        device.soil_ph = 6.5
+        device.save()
+        values = dict(nitrogen=90, phosphorus=42, potassium=43, temperature=20.8, humidity=82)
+        values.update(readings)
+        sensors.ingest(device, [{key: value for key, value in values.items() if value is not None}])
+        return device
+
+    def get_weather(self, city):
+        if city not in self.forecast_cities:
+            raise weather.WeatherServiceError('upstream down')
+        return {'total_rain_week': 200.0}, []
+
+    def recommend(self, **config):
+        with mock.patch.object(weather, 'get_weather', self.get_weather), \
+                override_settings(CROPMATE_AUTO_RECOMMEND=dict(auto_recommend.DEFAULTS, **config)):
+            return auto_recommend.recommend_changed()
+
+    def test_only_recommended_devices_are_stamped(self):
+        complete = self.device('complete')
+        no_forecast = self.device('no-forecast', city='Karachi')
+        incomplete = self.device('incomplete', potassium=None)
+
+        with self.assertLogs('dashboard.auto_recommend', 'WARNING') as logs:
+            created = self.recommend()
+
+        self.assertEqual(logs.output, ['WARNING:dashboard.auto_recommend:No forecast for Karachi, skipping its devices'])
+        self.assertEqual([r.device_id for r in created], [complete.pk])
+        recommendation = CropRecommendation.objects.get(device=complete)
+        self.assertEqual((recommendation.rainfall, recommendation.ph), (200.0, 6.5))
+        stamped = dict(SensorDevice.objects.values_list('name', 'recommended_at'))
+        self.assertIsNotNone(stamped['complete'])
+        self.assertIsNone(stamped['no-forecast'])
+        self.assertIsNone(stamped['incomplete'])
+
+        # Once the forecast is back the skipped device is picked up without new readings,
+        # while the recommended one waits for MIN_INTERVAL
+        self.forecast_cities.add('Karachi')
+        self.assertEqual([r.device_id for r in self.recommend()], [no_forecast.pk])
+        self.assertFalse(CropRecommendation.objects.filter(device=incomplete).exists())
+
+    def test_skipped_devices_do_not_stall_batches(self):
+        skipped = [self.device(f'skipped-{i}', city='Karachi') for i in range(3)]
+        complete = self.device('complete')
+
+        with self.assertLogs('dashboard.auto_recommend', 'WARNING'):
+            created = self.recommend(MAX_BATCH=1)
+
+        self.assertEqual([r.device_id for r in created], [complete.pk])
+        self.assertFalse(SensorDevice.objects.filter(pk__in=[d.pk for d in skipped], recommended_at__isnull=False))
+
+
+class PrefetchWeatherTests(SimpleTestCase):
+
+    def test_command_refuses_a_process_local_cache(self):
+        with mock.patch.object(weather, 'prefetch') as prefetch:
+            with self.assertRaisesMessage(CommandError, 'local to this process'):
+                call_command('prefetch_weather')
+        prefetch.assert_not_called()
+
+    def test_command_runs_against_a_shared_cache(self):
+        status = {'refreshed': 15, 'latency': 0.2, 'mode': 'multi', 'failures': {}}
+        with mock.patch.object(weather, 'cache_is_shared', return_value=True), \
+                mock.patch.object(weather, 'prefetch', return_value=status) as prefetch:
+            call_command('prefetch_weather', stdout=io.StringIO())
+        prefetch.assert_called_once()
+
+    def test_in_process_prefetcher_starts_once(self):
+        ran = threading.Event()
+        with mock.patch.object(weather, '_prefetcher', None), \
+                mock.patch.object(weather, 'prefetch', side_effect=lambda **kwargs: ran.set()):
+            thread = weather.start_prefetcher(interval=3600)
+            self.assertIs(weather.start_prefetcher(interval=3600), thread)
+            self.assertTrue(ran.wait(5))
+        self.assertTrue(thread.daemon)
+
+
+class StreamingCleanerTests(SimpleTestCase):
+
+    def stream(self, text, rng):
+        cleaner = StreamingCleaner()
+        out = []
+        pos = 0
+        while pos < len(text):
+            size = rng.randint(1, 4)
+            out.append(cleaner.feed(text[pos:pos + size]))
+            pos += size
+        out.append(cleaner.finish())
+        return ''.join(out)
+
+    def test_matches_clean_ai_response(self):
+        rng = random.Random(0)
+        cases = [
+            '## Soil\n\n* **Nitrogen**: 90 kg\n- Phosphorus  42\n\n\n\n`pH` 6.5',
+            'line one\r\nline two\r\n\r\n\r\nline three',
+            'Apply\xa0urea\u2028then\x0bwater \x0c twice',
+            '\t\xa0 - bullet\n  • next\n-5 degrees',
+        ]
+        alphabet = ['a', 'b', ' ', '\n', '\t', '\r', '\xa0', '\x0b', '\x0c', '\u2028', '*', '#', '`', '-', '•']
+        cases += [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 30))) for _ in range(2000)]
+        for text in cases:
+            self.assertEqual(self.stream(text, rng), clean_ai_response(text), repr(text))
+
+    def test_only_spaces_and_tabs_collapse(self):
+        self.assertEqual(self.stream('a \t b\xa0\xa0c\r \r d', random.Random(0)), 'a b\xa0\xa0c\r \r d')
+
+
+@override_settings(CROPMATE_PREDICTION_CACHE={'ENABLED': False})
+class CropGridTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pipeline = get_pipeline()
+        # One cell has no neighbours, so it never falls back as a boundary
+        self.bins = [1] * len(FEATURE_NAMES)
+        self.centre = [sum(DEFAULT_BOUNDS[name]) / 2 for name in FEATURE_NAMES]
+
+    def grid(self, top_k):
+        labels, confidence = build_grid(self.pipeline, DEFAULT_BOUNDS, self.bins, top_k=top_k)
+        return CropGrid(labels, confidence, DEFAULT_BOUNDS)
+
+    def test_fast_mode_keeps_the_top_k_shape(self):
+        grid = self.grid(top_k=3)
+        expected = self.pipeline.recommend_one(self.centre, k=3)
+        with mock.patch.object(prediction_cache, 'fast_lookup', grid.lookup):
+            fast = prediction_cache.recommend_one(self.centre, k=3)
+
+        self.assertEqual([c['crop'] for c in fast['top_crops']], [c['crop'] for c in expected['top_crops']])
+        for got, want in zip(fast['top_crops'], expected['top_crops']):
+            self.assertAlmostEqual(got['probability'], want['probability'], delta=1 / 255)
+        self.assertEqual(fast['crop'], expected['crop'])
+
+    def test_more_ranks_than_stored_use_the_model(self):
+        grid = self.grid(top_k=1)
+        self.assertEqual(len(grid.lookup(self.centre, k=1)), 1)
+        self.assertIsNone(grid.lookup(self.centre, k=2))
+        with mock.patch.object(prediction_cache, 'fast_lookup', grid.lookup):
+            self.assertEqual(prediction_cache.recommend_one(self.centre, k=3),
+                             self.pipeline.recommend_one(self.centre, k=3))
+
+    def test_grids_without_ranks_still_load(self):
+        ranked = self.grid(top_k=2)
+        legacy = CropGrid(ranked.labels[..., 0], ranked.confidence[..., 0], DEFAULT_BOUNDS)
+        self.assertEqual(legacy.depth, 1)
+        self.assertEqual(legacy.lookup(self.centre), ranked.lookup(self.centre))
+
+
+class WeatherCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = caches['default']
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+        self.config = weather._config()
+        coords = weather.CITY_COORDINATES['Lahore']
+        self.key = weather.cache_key(coords['lat'], coords['lon'])
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        patcher = mock.patch.object(weather, 'fetch_forecast', side_effect=self.fetch_forecast)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_forecast(self, city, lat, lon):
+        self.calls.append(city)
+        self.release.wait(5)
+        return {'city': city, 'fetch': len(self.calls)}, []
+
+    def store(self, age, **weather_data):
+        entry = {'weather_data': dict({'city': 'Lahore'}, **weather_data), 'forecast_data': [],
+                 'fetched_at': time.time() - age}
+        weather._store(self.cache, self.key, entry)
+        return entry
+
+    def test_concurrent_misses_share_one_fetch(self):
+        self.release.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(weather.get_entry('Lahore'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.calls, ['Lahore'])
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(self.cache.get(self.key)['weather_data']['fetch'], 1)
+
+    def test_stale_entry_is_served_while_it_refreshes(self):
+        stale = self.store(self.config['TTL'] + 60, fetch=0)
+        self.release.clear()
+
+        started = time.monotonic()
+        self.assertEqual(weather.get_entry('Lahore'), stale)
+        self.assertLess(time.monotonic() - started, 1)
+        # A second request during the refresh neither waits nor starts another fetch
+        self.assertEqual(weather.get_entry('Lahore'), stale)
+
+        self.release.set()
+        deadline = time.monotonic() + 5
+        while self.cache.get(self.key)['fetched_at'] == stale['fetched_at'] and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(self.calls, ['Lahore'])
+        self.assertEqual(weather.get_entry('Lahore')['weather_data']['fetch'], 1)
+
+    def test_upstream_failure_serves_a_degraded_entry(self):
+        age = self.config['TTL'] + self.config['STALE_TTL'] + 600
+        self.store(age, temperature=31)
+        with mock.patch.object(weather, 'fetch_forecast', side_effect=requests.exceptions.ConnectionError('down')):
+            entry = weather.get_entry('Lahore')
+            self.cache.delete(self.key)
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                weather.get_entry('Lahore')
+
+        self.assertTrue(entry['weather_data']['stale'])
+        self.assertEqual(entry['weather_data']['temperature'], 31)
+        self.assertEqual(entry['weather_data']['data_age_minutes'], round(age / 60))
+
+    async def test_degraded_entry_is_not_served_the_fresh_fragment(self):
+        entry = {'weather_data': {'city': 'Lahore', 'temp': 31}, 'forecast_data': [], 'fetched_at': time.time()}
+        fresh = await weather.arender_fragment('Lahore', entry)
+        self.assertNotIn('Last known data', fresh['forecast'])
+        self.assertEqual(await weather.arender_fragment('Lahore', entry), fresh)
+
+        degraded = weather._degraded(entry, self.config['TTL'] + self.config['STALE_TTL'] + 600)
+        fragment = await weather.arender_fragment('Lahore', degraded)
+        self.assertIn('Last known data', fragment['forecast'])
+        self.assertIn('31°C', fragment['forecast'])
+        # The fresh fragment is still there for requests that get fresh data
+        self.assertEqual(await self.cache.aget(weather.fragment_key('Lahore')), fresh)
+
+    def test_fetch_locked_by_another_process_is_awaited(self):
+        self.cache.add(self.key + ':fetching', True)
+        # The other process stores its result shortly after
+        timer = threading.Timer(0.2, self.store, args=(0,), kwargs={'fetch': 'elsewhere'})
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(weather.get_entry('Lahore')['weather_data']['fetch'], 'elsewhere')
+        self.assertEqual(self.calls, [])
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Answers 503 to the first `failures` requests to the server, then 200."""
+
+    def do_GET(self):
+        self.server.requests += 1
+        status = 503 if self.server.requests <= self.server.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def response(status):
+    response = requests.Response()
+    response.status_code = status
+    return response
+
+
+@override_settings(CROPMATE_HTTP=dict(
+    http_client.DEFAULTS, CIRCUIT_FAILURE_THRESHOLD=2, CIRCUIT_RESET_TIMEOUT=60, BACKOFF_FACTOR=0.05,
+    BACKOFF_JITTER=0.01,
+))
+class HttpClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = http_client.HttpClient()
+        self.send = mock.patch.object(self.client.session(), 'request').start()
+        # Quiet the "Opening circuit" warnings
+        mock.patch.object(http_client.logger, 'warning').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def get(self):
+        return self.client.get('upstream', 'http://upstream.test/')
+
+    def open_breaker(self):
+        self.send.side_effect = requests.exceptions.ConnectionError('refused')
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.get()
+        # As if the reset timeout had passed
+        self.client.breaker('upstream').opened_at -= 61
+
+    def test_consecutive_failures_open_the_circuit(self):
+        self.send.side_effect = [response(503), requests.exceptions.Timeout('slow')]
+        self.assertEqual(self.get().status_code, 503)
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.get()
+        self.assertEqual(self.client.stats()['upstream'], {'state': 'open', 'failures': 2})
+
+        with self.assertRaises(http_client.CircuitOpenError):
+            self.get()
+        self.assertEqual(self.send.call_count, 2)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        self.open_breaker()
+        blocked = []
+
+        def trial(*args, **kwargs):
+            # Only one call may probe a half-open upstream
+            with self.assertRaises(http_client.CircuitOpenError) as raised:
+                self.get()
+            blocked.append(raised.exception)
+            return response(200)
+
+        self.send.side_effect = trial
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(len(blocked), 1)
+        self.assertEqual(self.client.stats()['upstream'], {'state': 'closed', 'failures': 0})
+
+        self.open_breaker()
+        self.send.side_effect = requests.exceptions.ConnectionError('still down')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.get()
+        self.assertEqual(self.client.breaker('upstream').state, 'open')
+
+    def test_unexpected_error_releases_the_half_open_trial(self):
+        self.open_breaker()
+        self.send.side_effect = ValueError('bad url')
+        with self.assertRaises(ValueError):
+            self.get()
+
+        self.send.side_effect = None
+        self.send.return_value = response(200)
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(self.client.breaker('upstream').state, 'closed')
+
+    def test_session_retries_with_backoff(self):
+        mock.patch.stopall()
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+        server.requests, server.failures = 0, 2
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        started = time.monotonic()
+        result = self.client.get('local', f'http://127.0.0.1:{server.server_port}/')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(server.requests, 3)
+        # urllib3 sleeps BACKOFF_FACTOR * 2 ** (n - 1) before the n-th retry, skipping the first
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(self.client.breaker('local').state, 'closed')
+
+    async def test_async_retries_with_backoff(self):
+        statuses = iter([503, 502, 200])
+        transport = httpx.MockTransport(lambda request: httpx.Response(next(statuses)))
+        sleep = mock.AsyncMock()
+        with mock.patch.object(self.client, 'async_client', return_value=httpx.AsyncClient(transport=transport)), \
+                mock.patch.object(http_client.asyncio, 'sleep', sleep):
+            result = await self.client.aget('upstream', 'http://upstream.test/')
+
+        self.assertEqual(result.status_code, 200)
+        delays = [call.args[0] for call in sleep.await_args_list]
+        self.assertEqual(len(delays), 2)
+        for attempt, delay in enumerate(delays):
+            self.assertGreaterEqual(delay, 0.05 * 2 ** attempt)
+            self.assertLessEqual(delay, 0.05 * 2 ** attempt + 0.01)
+        self.assertEqual(self.client.breaker('upstream').state, 'closed')
+
+
+class AsgiTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        self.user = User.objects.create_user('farmer', password='password')
+        self.client.force_login(self.user)
+        self.entry = {'weather_data': {'city': 'Lahore', 'temp': 31}, 'forecast_data': [], 'fetched_at': time.time()}
+
+    async def call_asgi(self, path, receive, query_string=b''):
+        """Run the ASGI application on one request and return the messages it sent."""
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query_string, 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'cookie', f'sessionid={self.client.cookies["sessionid"].value}'.encode())],
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+        }
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await asyncio.wait_for(application(scope, receive, send), 5)
+        return sent
+
+    async def test_disconnect_cancels_the_view(self):
+        started, cancelled = asyncio.Event(), asyncio.Event()
+        messages = asyncio.Queue()
+        await messages.put({'type': 'http.request', 'body': b'', 'more_body': False})
+
+        async def aget_entry(city):
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        async def disconnect():
+            await started.wait()
+            await messages.put({'type': 'http.disconnect'})
+
+        with mock.patch.object(weather, 'aget_entry', aget_entry):
+            client = asyncio.ensure_future(disconnect())
+            sent = await self.call_asgi(reverse('dashboard:weather'), messages.get, b'city=Lahore')
+            await client
+
+        self.assertTrue(cancelled.is_set())
+        self.assertEqual(sent, [])
+
+    async def test_connected_client_gets_the_response(self):
+        messages = asyncio.Queue()
+        await messages.put({'type': 'http.request', 'body': b'', 'more_body': False})
+
+        with mock.patch.object(weather, 'aget_entry', mock.AsyncMock(return_value=self.entry)):
+            sent = await self.call_asgi(reverse('dashboard:weather'), messages.get, b'city=Lahore')
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(b'31\xc2\xb0C', b''.join(message.get('body', b'') for message in sent[1:]))
+
+    async def test_weather_view_under_wsgi_and_asgi(self):
+        url = reverse('dashboard:weather')
+        await sync_to_async(self.async_client.force_login)(self.user)
+        with mock.patch.object(weather, 'get_entry', return_value=self.entry) as get_entry, \
+                mock.patch.object(weather, 'aget_entry', mock.AsyncMock(return_value=self.entry)) as aget_entry:
+            wsgi = await sync_to_async(self.client.get)(url, {'city': 'Lahore'})
+            self.assertEqual((get_entry.call_count, aget_entry.await_count), (1, 0))
+            asgi = await self.async_client.get(url, {'city': 'Lahore'})
+            self.assertEqual((get_entry.call_count, aget_entry.await_count), (1, 1))
+
+        for response in (wsgi, asgi):
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('31°C', response.content.decode())
+
+    async def test_agronomist_view_under_wsgi_and_asgi(self):
+        backend = agronomist.FakeBackend({'FAKE_REPLY': 'Answer to: {question}', 'FAKE_DELAY': 0})
+        service = agronomist.AgronomistService(backend, timeout=1, max_concurrency=2)
+        url = reverse('dashboard:ask_agronomist')
+        await sync_to_async(self.async_client.force_login)(self.user)
+        with mock.patch.object(agronomist, 'get_service', return_value=service), \
+                mock.patch.object(views, 'get_response_cache', return_value=ResponseCache()), \
+                mock.patch.object(service, 'complete', wraps=service.complete) as complete, \
+                mock.patch.object(service, 'acomplete', wraps=service.acomplete) as acomplete:
+            wsgi = await sync_to_async(self.client.post)(url, json.dumps({'message': 'Best soil for rice?'}),
+                                                         content_type='application/json')
+            self.assertEqual((complete.call_count, acomplete.call_count), (1, 0))
+            asgi = await self.async_client.post(url, json.dumps({'message': 'When to sow cotton?'}),
+                                                content_type='application/json')
+            self.assertEqual((complete.call_count, acomplete.call_count), (1, 1))
+
+        self.assertEqual(wsgi.json(), {'success': True, 'response': 'Answer to: Best soil for rice?'})
+        self.assertEqual(asgi.json(), {'success': True, 'response': 'Answer to: When to sow cotton?'})
+        self.assertEqual(await ChatMessage.objects.filter(conversation__user=self.user).acount(), 4)
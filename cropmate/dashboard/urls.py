@@ -7,9 +7,19 @@ urlpatterns = [
     path('', views.dashboard_view, name='dashboard'),
     path('weather/', views.weather_view, name='weather'),
     path('sensors/', views.sensors_view, name='sensors'),
+    path('sensors/stream/', views.sensor_stream, name='sensor_stream'),
+    path('api/sensors/readings/', views.sensor_ingest_api, name='sensor_ingest_api'),
+    path('api/sensors/<int:device_id>/history/', views.sensor_history_api, name='sensor_history_api'),
     path('agronomist/', views.agronomist_view, name='agronomist'),
     path('ask-agronomist/', views.ask_agronomist, name='ask_agronomist'),
+    path('ask-agronomist/stream/', views.ask_agronomist_stream, name='ask_agronomist_stream'),
+    path('agronomist/new/', views.new_conversation, name='new_conversation'),
     path('recommendations/', views.recommendations_view, name='recommendations'),
+    path('recommendations/history/', views.recommendation_history, name='recommendation_history'),
+    path('api/recommendations/history/', views.recommendation_history_api, name='recommendation_history_api'),
+    path('api/recommendations/export/', views.recommendations_export, name='recommendations_export'),
+    path('api/recommendations/batch/', views.recommendations_batch_api, name='recommendations_batch_api'),
+    path('api/recommendations/batch/csv/', views.recommendations_batch_csv, name='recommendations_batch_csv'),
     path('settings/', views.settings_view, name='settings'),
     path('settings/update-profile/', views.update_profile, name='update_profile'),
     path('settings/change-password/', views.change_password, name='change_password'),
@@ -1,21 +1,44 @@
 from django.shortcuts import render, redirect
+from django.utils import timezone
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from .forms import LoginForm, SignupForm
-from .models import CropRecommendation
+from .models import CropRecommendation, SensorDevice, SensorReading
+from .crop_model import get_pipeline, rows_to_matrix, validate_features, FEATURE_NAMES
+from .prediction_cache import recommend_one as cached_recommend_one
+from .response_cache import get_response_cache
+from . import agronomist, export, fallback, history, sensor_feed, sensors, weather
+import asyncio
+import csv
+import datetime
+import io
 import json
-import os
-import numpy as np
-import pickle
-from groq import Groq
+import math
+import time
+from asgiref.sync import sync_to_async
+from functools import wraps
+from itertools import islice
 import re
 import requests
-from datetime import datetime, timedelta
+
+
+def async_login_required(view):
+    """login_required for async views (Django 4.2's decorator only wraps sync ones)."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+        if user is None:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
 
 
 @login_required
@@ -23,101 +46,29 @@ def dashboard_view(request):
     return render(request, 'dashboard/dashboard.html')
 
 
-@login_required
-def weather_view(request):
+@async_login_required
+async def weather_view(request):
     city = request.GET.get('city', 'Lahore')
     
     weather_data = None
-    forecast_data = None
+    weather_fragment = None
     error_message = None
     
-    city_coordinates = {
-        'Karachi': {'lat': 24.8607, 'lon': 67.0011},
-        'Lahore': {'lat': 31.5204, 'lon': 74.3587},
-        'Islamabad': {'lat': 33.6844, 'lon': 73.0479},
-        'Rawalpindi': {'lat': 33.5651, 'lon': 73.0169},
-        'Faisalabad': {'lat': 31.4504, 'lon': 73.1350},
-        'Multan': {'lat': 30.1575, 'lon': 71.5249},
-        'Peshawar': {'lat': 34.0151, 'lon': 71.5249},
-        'Quetta': {'lat': 30.1798, 'lon': 66.9750},
-        'Sialkot': {'lat': 32.4945, 'lon': 74.5229},
-        'Gujranwala': {'lat': 32.1877, 'lon': 74.1945},
-        'Bahawalpur': {'lat': 29.3544, 'lon': 71.6911},
-        'Sargodha': {'lat': 32.0836, 'lon': 72.6711},
-        'Hyderabad': {'lat': 25.3792, 'lon': 68.3683},
-        'Sukkur': {'lat': 27.7058, 'lon': 68.8574},
-        'Sahiwal': {'lat': 30.6682, 'lon': 73.1114}
-    }
-    
-    if city not in city_coordinates:
+    if city not in weather.CITY_COORDINATES:
         error_message = f"City '{city}' not found. Please select from available cities."
     else:
         try:
-            coords = city_coordinates[city]
-            lat = coords['lat']
-            lon = coords['lon']
-            
-            current_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,apparent_temperature,precipitation,weather_code,cloud_cover,pressure_msl,surface_pressure,wind_speed_10m,wind_direction_10m&daily=weather_code,temperature_2m_max,temperature_2m_min,precipitation_sum,precipitation_probability_max,wind_speed_10m_max&timezone=Asia/Karachi&forecast_days=7"
-            
-            response = requests.get(current_url, timeout=5)
-            
-            if response.status_code == 200:
-                data = response.json()
-                current = data['current']
-                daily = data['daily']
-                
-                weather_data = {
-                    'city': city,
-                    'country': 'PK',
-                    'temp': round(current['temperature_2m'], 1),
-                    'feels_like': round(current['apparent_temperature'], 1),
-                    'pressure': round(current['pressure_msl'], 0),
-                    'humidity': current['relative_humidity_2m'],
-                    'visibility': 10,
-                    'wind_speed': round(current['wind_speed_10m'], 1),
-                    'wind_deg': current['wind_direction_10m'],
-                    'wind_dir': get_wind_direction(current['wind_direction_10m']),
-                    'clouds': current['cloud_cover'],
-                    'condition': get_weather_condition(current['weather_code']),
-                    'description': get_weather_description(current['weather_code']),
-                    'icon': get_weather_icon(current['weather_code']),
-                    'rain_1h': round(current['precipitation'], 1),
-                    'dt': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                }
-                
-                forecast_data = []
-                for i in range(7):
-                    forecast_data.append({
-                        'date': daily['time'][i],
-                        'day_name': datetime.strptime(daily['time'][i], '%Y-%m-%d').strftime('%A'),
-                        'day_short': datetime.strptime(daily['time'][i], '%Y-%m-%d').strftime('%a'),
-                        'temp_max': round(daily['temperature_2m_max'][i], 1),
-                        'temp_min': round(daily['temperature_2m_min'][i], 1),
-                        'temp_avg': round((daily['temperature_2m_max'][i] + daily['temperature_2m_min'][i]) / 2, 1),
-                        'condition': get_weather_condition(daily['weather_code'][i]),
-                        'rain': round(daily['precipitation_sum'][i], 1),
-                        'wind_speed_avg': round(daily['wind_speed_10m_max'][i], 1),
-                        'humidity_avg': 0,
-                        'icon': get_weather_icon(daily['weather_code'][i])
-                    })
-                
-                precipitation_chart = []
-                for i in range(min(7, len(daily['time']))):
-                    precipitation_chart.append({
-                        'time': datetime.strptime(daily['time'][i], '%Y-%m-%d').strftime('%a'),
-                        'rain': daily['precipitation_sum'][i],
-                        'pop': daily['precipitation_probability_max'][i] if daily['precipitation_probability_max'][i] else 0
-                    })
-                
-                total_rain_week = sum(daily['precipitation_sum'])
-                weather_data['precipitation_chart'] = precipitation_chart
-                weather_data['total_rain_today'] = round(daily['precipitation_sum'][0], 1)
-                weather_data['rain_probability'] = round(daily['precipitation_probability_max'][0], 1) if daily['precipitation_probability_max'][0] else 0
-                weather_data['total_rain_week'] = round(total_rain_week, 1)
-                
+            # Served from the shared weather cache; only misses reach Open-Meteo. Under
+            # WSGI every request gets a fresh event loop, so an async client would be
+            # built and thrown away each time: use the pooled session instead
+            if isinstance(request, ASGIRequest):
+                entry = await weather.aget_entry(city)
             else:
-                error_message = "Unable to fetch weather data. Please try again."
-                
+                entry = await sync_to_async(weather.get_entry)(city)
+            weather_data = entry['weather_data']
+            weather_fragment = await weather.arender_fragment(city, entry)
+        except weather.WeatherServiceError:
+            error_message = "Unable to fetch weather data. Please try again."
         except requests.exceptions.Timeout:
             error_message = "Weather service is taking too long to respond. Please try again."
         except requests.exceptions.RequestException:
@@ -125,82 +76,205 @@ def weather_view(request):
         except Exception as e:
             error_message = f"An error occurred: {str(e)}"
     
-    popular_cities = [
-        'Karachi', 'Lahore', 'Islamabad', 'Rawalpindi', 'Faisalabad', 
-        'Multan', 'Peshawar', 'Quetta', 'Sialkot', 'Gujranwala',
-        'Bahawalpur', 'Sargodha', 'Hyderabad', 'Sukkur', 'Sahiwal'
-    ]
-    
     context = {
         'weather_data': weather_data,
-        'forecast_data': forecast_data,
-        'popular_cities': popular_cities,
+        'weather_fragment': weather_fragment,
+        'popular_cities': weather.POPULAR_CITIES,
         'selected_city': city,
         'error_message': error_message,
-        'precipitation_chart_json': json.dumps(weather_data.get('precipitation_chart', [])) if weather_data else '[]'
     }
     
-    return render(request, 'dashboard/weather.html', context)
+    return await sync_to_async(render)(request, 'dashboard/weather.html', context)
 
 
-def get_weather_condition(code):
-    conditions = {
-        0: 'Clear', 1: 'Mainly Clear', 2: 'Partly Cloudy', 3: 'Overcast',
-        45: 'Foggy', 48: 'Foggy', 51: 'Drizzle', 53: 'Drizzle', 55: 'Drizzle',
-        61: 'Rain', 63: 'Rain', 65: 'Heavy Rain', 71: 'Snow', 73: 'Snow', 75: 'Snow',
-        77: 'Snow', 80: 'Rain Showers', 81: 'Rain Showers', 82: 'Heavy Rain',
-        85: 'Snow', 86: 'Snow', 95: 'Thunderstorm', 96: 'Thunderstorm', 99: 'Thunderstorm'
-    }
-    return conditions.get(code, 'Clear')
-
-
-def get_weather_description(code):
-    descriptions = {
-        0: 'Clear sky', 1: 'Mainly clear', 2: 'Partly cloudy', 3: 'Overcast',
-        45: 'Fog', 48: 'Depositing rime fog', 51: 'Light drizzle', 53: 'Moderate drizzle',
-        55: 'Dense drizzle', 61: 'Slight rain', 63: 'Moderate rain', 65: 'Heavy rain',
-        71: 'Slight snow', 73: 'Moderate snow', 75: 'Heavy snow', 77: 'Snow grains',
-        80: 'Slight rain showers', 81: 'Moderate rain showers', 82: 'Violent rain showers',
-        85: 'Slight snow showers', 86: 'Heavy snow showers', 95: 'Thunderstorm',
-        96: 'Thunderstorm with hail', 99: 'Thunderstorm with heavy hail'
-    }
-    return descriptions.get(code, 'Clear sky')
+@login_required
+def sensors_view(request):
+    return render(request, 'dashboard/sensors.html', {
+        'devices': SensorDevice.objects.filter(user=request.user).order_by('name'),
+        'metric_ranges': sensors.METRIC_RANGES,
+        'recommendation': (
+            CropRecommendation.objects.filter(user=request.user, device__isnull=False)
+            .select_related('device').first()
+        ),
+    })
+
+
+@async_login_required
+async def sensor_stream(request):
+    """
+    Server-Sent Events with the latest reading of each of the user's
+    devices: a snapshot on connect, then coalesced updates from the shared
+    sensor feed. The stream ends after STREAM_MAX_AGE and EventSource
+    reconnects, so no connection holds a worker indefinitely.
+    """
+    config = sensors.get_config()
+    is_asgi = isinstance(request, ASGIRequest)
+    loop = asyncio.get_running_loop() if is_asgi else None
+
+    def open_feed():
+        subscription = sensor_feed.feed.subscribe(request.user.pk, loop)
+        try:
+            return subscription, sensor_feed.snapshot(request.user.pk)
+        except BaseException:
+            # Nothing will ever read this subscription; don't let it hold a slot
+            sensor_feed.feed.unsubscribe(subscription)
+            raise
 
+    try:
+        subscription, snapshot = await sync_to_async(open_feed)()
+    except sensor_feed.TooManySubscribers:
+        return JsonResponse({'success': False, 'error': 'Too many live viewers, try again shortly'}, status=503)
 
-def get_weather_icon(code):
-    icons = {
-        0: '01d', 1: '02d', 2: '03d', 3: '04d',
-        45: '50d', 48: '50d', 51: '09d', 53: '09d', 55: '09d',
-        61: '10d', 63: '10d', 65: '10d', 71: '13d', 73: '13d', 75: '13d',
-        77: '13d', 80: '09d', 81: '09d', 82: '09d',
-        85: '13d', 86: '13d', 95: '11d', 96: '11d', 99: '11d'
-    }
-    return icons.get(code, '01d')
+    events = (_sensor_events_async if is_asgi else _sensor_events_sync)(subscription, snapshot, config)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
-def get_wind_direction(degree):
-    if degree is None:
-        return 'N/A'
-    
-    directions = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
-                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
-    index = round(degree / 22.5) % 16
-    return directions[index]
+async def _sensor_events_async(subscription, snapshot, config):
+    try:
+        yield f"retry: {int(config['STREAM_INTERVAL'] * 1000)}\n\n"
+        yield sse_event('readings', {'devices': snapshot})
+        deadline = time.monotonic() + config['STREAM_MAX_AGE']
+        while not subscription.closed and time.monotonic() < deadline:
+            updates = await subscription.aget(config['STREAM_HEARTBEAT'])
+            yield sse_event('readings', {'devices': updates}) if updates else ': keepalive\n\n'
+    finally:
+        sensor_feed.feed.unsubscribe(subscription)
+
+
+def _sensor_events_sync(subscription, snapshot, config):
+    try:
+        yield f"retry: {int(config['STREAM_INTERVAL'] * 1000)}\n\n"
+        yield sse_event('readings', {'devices': snapshot})
+        deadline = time.monotonic() + config['STREAM_MAX_AGE']
+        while not subscription.closed and time.monotonic() < deadline:
+            updates = subscription.get(config['STREAM_HEARTBEAT'])
+            yield sse_event('readings', {'devices': updates}) if updates else ': keepalive\n\n'
+    finally:
+        sensor_feed.feed.unsubscribe(subscription)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def sensor_ingest_api(request):
+    """
+    Batched readings from one device, authenticated by its X-Device-Key
+    header: {"readings": [{"timestamp": ..., "nitrogen": ..., ...}, ...]} or a bare list.
+    """
+    device = sensors.authenticate_device(request.headers.get('X-Device-Key'))
+    if device is None:
+        return JsonResponse({'success': False, 'error': 'Unknown or missing device key'}, status=401)
+
+    try:
+        data = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'success': False, 'error': 'Request body must be valid JSON'}, status=400)
+
+    rows = data.get('readings') if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not rows:
+        return JsonResponse({'success': False, 'error': 'No readings provided'}, status=400)
+    max_batch = sensors.get_config()['MAX_BATCH']
+    if len(rows) > max_batch:
+        return JsonResponse({
+            'success': False,
+            'error': f'Too many readings: at most {max_batch} per batch.'
+        }, status=400)
+
+    saved, rejected = sensors.ingest(device, rows)
+    return JsonResponse({
+        'success': True,
+        'total': len(rows),
+        'saved': len(saved),
+        'failed': len(rejected),
+        'rejected': rejected,
+    })
 
 
 @login_required
-def sensors_view(request):
-    return render(request, 'dashboard/sensors.html')
+def sensor_history_api(request, device_id):
+    """
+    Min/max/avg series for one of the user's devices. Query parameters:
+    metrics (comma-separated, default all), start and end (ISO 8601 or Unix
+    seconds, default the last 24 hours) and points (how many buckets the
+    chart wants; the coarsest rollup giving at least that many is merged
+    down to at most that many, and resolution is the resulting bucket width).
+    """
+    device = SensorDevice.objects.filter(pk=device_id, user=request.user).first()
+    if device is None:
+        return JsonResponse({'success': False, 'error': 'Device not found'}, status=404)
+
+    metrics = [m for m in request.GET.get('metrics', '').split(',') if m] or SensorReading.METRICS
+    unknown = [m for m in metrics if m not in SensorReading.METRICS]
+    if unknown:
+        return JsonResponse({'success': False, 'error': f"Unknown metrics: {', '.join(unknown)}"}, status=400)
+
+    now = timezone.now()
+    try:
+        end = sensors.parse_timestamp(request.GET.get('end'), now)
+        start = sensors.parse_timestamp(request.GET.get('start'), end - datetime.timedelta(days=1))
+        points = int(request.GET.get('points', 200))
+    except (ValueError, OverflowError, OSError):
+        return JsonResponse({'success': False, 'error': 'Invalid start, end or points'}, status=400)
+    if start >= end or not 1 <= points <= 10000:
+        return JsonResponse({'success': False, 'error': 'Invalid start, end or points'}, status=400)
+
+    resolution, series = sensors.history(device, metrics, start, end, points)
+    return JsonResponse({
+        'success': True,
+        'device': {'id': device.pk, 'name': device.name},
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'resolution': resolution,
+        'series': series,
+    })
 
 
 @login_required
 def agronomist_view(request):
-    return render(request, 'dashboard/agronomist.html')
+    context = {'chat_history': agronomist.recent_messages(request.user)}
+    return render(request, 'dashboard/agronomist.html', context)
 
 
 @login_required
 @require_http_methods(["POST"])
-def ask_agronomist(request):
+def new_conversation(request):
+    agronomist.start_conversation(request.user)
+    return JsonResponse({'success': True})
+
+
+class _Turn:
+    """One question: the context it is asked in, and where the finished answer goes."""
+
+    def __init__(self, user, conversation, question, context):
+        self.user = user
+        self.conversation = conversation
+        self.question = question
+        self.context = context
+        # A follow-up's answer depends on the conversation, so it is neither reused nor shared
+        self.cache = get_response_cache() if not context or not agronomist.is_follow_up(question) else None
+        self.cached = False
+
+    def lookup(self):
+        """The cached answer to this question, or None."""
+        answer = self.cache.get(self.question) if self.cache else None
+        self.cached = answer is not None
+        return answer
+
+    def finish(self, answer):
+        if not answer:
+            return
+        # Putting a hit back would renew its TTL, or copy a similar hit under this question
+        if self.cache and not self.cached:
+            self.cache.put(self.question, answer)
+        agronomist.record_turn(self.user, self.conversation, self.question, answer)
+
+
+@async_login_required
+async def ask_agronomist(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
     try:
         data = json.loads(request.body)
         user_message = data.get('message', '').strip()
@@ -208,60 +282,23 @@ def ask_agronomist(request):
         if not user_message:
             return JsonResponse({'success': False, 'error': 'No message provided'})
 
-        try:
-            client = Groq(
-                api_key="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"
-            )
-            
-            system_prompt = """
-You are a professional agronomist. Your only role is to give clear, practical, agriculture-focused advice. Always answer directly, briefly, and to the point. Do not give generic suggestions such as “contact your local expert,” “seek local advice,” or “consult professionals.” Provide the best possible farming guidance using your own knowledge.
-
-You must stay strictly on farming topics: crops, soil health, fertilizers, irrigation, pests, climate, yield improvement, and farm management. When the user goes off-topic, politely redirect them back to agriculture.
-
-Your responses must follow these rules:
-
-Short and concise
-
-Contains only the essential information
-
-Always relevant to farming
-
-Friendly and professional
-
-No emojis or decorative symbols
-
-No unnecessary storytelling, small talk, or disclaimers
+        conversation, context = await sync_to_async(agronomist.load_conversation)(request.user)
+        turn = _Turn(request.user, conversation, user_message, context)
 
-Do not refer the user to local offices or third-party experts
+        cached = turn.lookup()
+        if cached is not None:
+            await sync_to_async(turn.finish)(cached)
+            return JsonResponse({'success': True, 'response': cached, 'cached': True})
 
-Examples
-
-User: How can you help me?
-Assistant: I can help you with crop advice, soil improvement, fertilizer planning, pest control, irrigation methods, and practical steps to improve your farm. Tell me what crop or issue you want to focus on.
-
-User: What fertilizer should I use for wheat?
-Assistant: Apply a balanced NPK, typically around 60–80 kg nitrogen, 30–40 kg phosphorus, and 20–25 kg potassium per hectare. Adjust based on soil tests.
-
-User: Tell me a story.
-Assistant: I focus on farming topics. If you want, I can explain how a farmer improves soil health or increases yield.
-
-
-
-
-            """
-
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                model="llama-3.1-8b-instant",
-                temperature=0.8,
-                max_tokens=200
-            )
-            
-            ai_response = chat_completion.choices[0].message.content
+        try:
+            service = agronomist.get_service()
+            if isinstance(request, ASGIRequest):
+                ai_response = await service.acomplete(user_message, context)
+            else:
+                # A new event loop per WSGI request would get a new async client every time
+                ai_response = await sync_to_async(service.complete)(user_message, context)
             cleaned_response = clean_ai_response(ai_response)
+            await sync_to_async(turn.finish)(cleaned_response)
             
             return JsonResponse({
                 'success': True,
@@ -282,20 +319,116 @@ Assistant: I focus on farming topics. If you want, I can explain how a farmer im
         })
 
 
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+@async_login_required
+async def ask_agronomist_stream(request):
+    """
+    Same as ask_agronomist, but forwards the completion as Server-Sent Events
+    (token, then done or error) while Groq generates it.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        user_message = json.loads(request.body).get('message', '').strip()
+    except (ValueError, AttributeError):
+        user_message = ''
+    if not user_message:
+        return JsonResponse({'success': False, 'error': 'No message provided'})
+
+    conversation, context = await sync_to_async(agronomist.load_conversation)(request.user)
+    turn = _Turn(request.user, conversation, user_message, context)
+
+    cached = turn.lookup()
+    if cached is not None:
+        await sync_to_async(turn.finish)(cached)
+        response = HttpResponse(
+            sse_event('token', {'text': cached}) + sse_event('done', {'cached': True}),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    # Django 4.2 buffers async iterators under WSGI and sync ones under ASGI,
+    # so hand it the kind the server can stream
+    if isinstance(request, ASGIRequest):
+        events = _stream_events_async(turn)
+    else:
+        events = _stream_events_sync(turn)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def _stream_events_async(turn):
+    cleaner = StreamingCleaner()
+    sent = []
+    try:
+        async for delta in agronomist.get_service().astream(turn.question, turn.context):
+            text = cleaner.feed(delta)
+            if text:
+                sent.append(text)
+                yield sse_event('token', {'text': text})
+        text = cleaner.finish()
+        if text:
+            sent.append(text)
+            yield sse_event('token', {'text': text})
+        await sync_to_async(turn.finish)(''.join(sent))
+    except Exception:
+        if sent:
+            yield sse_event('error', {'error': 'The response was interrupted. Please try again.'})
+            return
+        yield sse_event('token', {'text': get_expert_fallback(turn.question)})
+    yield sse_event('done', {})
+
+
+def _stream_events_sync(turn):
+    cleaner = StreamingCleaner()
+    sent = []
+    try:
+        for delta in agronomist.get_service().stream(turn.question, turn.context):
+            text = cleaner.feed(delta)
+            if text:
+                sent.append(text)
+                yield sse_event('token', {'text': text})
+        text = cleaner.finish()
+        if text:
+            sent.append(text)
+            yield sse_event('token', {'text': text})
+        turn.finish(''.join(sent))
+    except Exception:
+        if sent:
+            yield sse_event('error', {'error': 'The response was interrupted. Please try again.'})
+            return
+        yield sse_event('token', {'text': get_expert_fallback(turn.question)})
+    yield sse_event('done', {})
+
+
+_MARKDOWN_RE = re.compile(r'\*+')
+_HEADING_RE = re.compile(r'#+\s*')
+_BACKTICK_RE = re.compile(r'`+')
+_BULLET_RE = re.compile(r'^\s*[•●◦▪▫-]\s+', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n+')
+_SPACES_RE = re.compile(r'[ \t]+')
+
+
 def clean_ai_response(response):
 
     
     # Remove markdown formatting (asterisks, hashtags, backticks)
-    cleaned = re.sub(r'\*+', '', response)
-    cleaned = re.sub(r'#+\s*', '', cleaned)
-    cleaned = re.sub(r'`+', '', cleaned)
+    cleaned = _MARKDOWN_RE.sub('', response)
+    cleaned = _HEADING_RE.sub('', cleaned)
+    cleaned = _BACKTICK_RE.sub('', cleaned)
     
     # Replace bullet points with numbers or remove them
-    cleaned = re.sub(r'^\s*[•●◦▪▫-]\s+', '', cleaned, flags=re.MULTILINE)
+    cleaned = _BULLET_RE.sub('', cleaned)
     
     # Clean up excessive whitespace
-    cleaned = re.sub(r'\n\s*\n\s*\n+', '\n\n', cleaned)
-    cleaned = re.sub(r'[ \t]+', ' ', cleaned)
+    cleaned = _BLANK_LINES_RE.sub('\n\n', cleaned)
+    cleaned = _SPACES_RE.sub(' ', cleaned)
     
     # Preserve line breaks but clean up
     lines = [line.strip() for line in cleaned.split('\n')]
@@ -304,43 +437,90 @@ def clean_ai_response(response):
     return cleaned.strip()
 
 
-def get_expert_fallback(user_message):
-    message_lower = user_message.lower()
-    
-    greetings = ['hello', 'hi', 'hey', 'greetings', 'good morning', 'good afternoon', 'good evening', 'howdy', 'sup', 'what\'s up']
-    if any(greeting in message_lower for greeting in greetings):
-        return """Hey there! Great to see you. I'm here and ready to help with whatever you're growing. Whether it's pest problems keeping you up at night or you're planning your dream garden, I've got your back. What's on your mind today?"""
-    
-    thanks = ['thank', 'thanks', 'appreciate', 'helpful']
-    if any(word in message_lower for word in thanks):
-        return """You're very welcome! That's what I'm here for. Happy to help anytime you need farming advice. Good luck out there, and don't hesitate to ask if something else comes up!"""
-    
+class StreamingCleaner:
+    """
+    clean_ai_response() applied to a stream: feed() each chunk as it arrives
+    and show whatever it returns. Whitespace and a possible bullet are held
+    back until the next visible character decides what they become. Like
+    clean_ai_response(), only '\n' breaks lines and only spaces and tabs are
+    collapsed; other whitespace inside a line (\r, \xa0, \u2028...) is kept.
+    """
+
+    BULLETS = '•●◦▪▫-'
+
+    def __init__(self):
+        self.started = False
+        self.line_start = True
+        self.newlines = 0
+        self.pending = ''
+        self.in_heading = False
+        self.in_bullet = False
+        self.bullet = None
+
+    def feed(self, text):
+        out = []
+        for ch in text:
+            if ch == '*':
+                continue
+            if ch == '`':
+                # Backticks are stripped after headings, so '#`  x' keeps its space
+                self.in_heading = False
+                continue
+            if ch == '#':
+                self.in_heading = True
+                continue
+            if ch.isspace():
+                if self.in_heading:
+                    continue
+                if self.bullet is not None:
+                    # A bullet also swallows the blank lines before it
+                    self.bullet = None
+                    self.in_bullet = True
+                    self.newlines = min(self.newlines, 1)
+                    self.pending = ''
+                if self.in_bullet:
+                    # The next bullet only counts if this one's whitespace ended a line
+                    self.line_start = ch == '\n'
+                    continue
+                if ch == '\n':
+                    self.newlines += 1
+                    self.line_start = True
+                else:
+                    self.pending += ch
+                continue
+            self.in_heading = False
+            self.in_bullet = False
+            if self.line_start and self.bullet is None and ch in self.BULLETS:
+                self.bullet = ch
+                continue
+            self._flush(out)
+            out.append(ch)
+        return ''.join(out)
+
+    def finish(self):
+        """Return what is still held back once the stream has ended."""
+        out = []
+        if self.bullet is not None:
+            self._flush(out)
+        return ''.join(out)
+
+    def _flush(self, out):
+        if self.started:
+            if self.newlines:
+                out.append('\n' * min(self.newlines, 2))
+            elif self.pending:
+                out.append(_SPACES_RE.sub(' ', self.pending))
+        if self.bullet is not None:
+            out.append(self.bullet)
+        self.started = True
+        self.line_start = False
+        self.newlines = 0
+        self.pending = ''
+        self.bullet = None
 
-    if 'how are you' in message_lower or 'how r u' in message_lower:
-        return """I'm doing great, thanks for asking! Always excited when farmers stop by for advice. How are things going with your crops? Anything I can help you with today?"""
-    
-    expert_responses = {
-        'crop': """Good question! Start by testing your soil - it tells you what'll grow best. Tomatoes, lettuce, peppers, and herbs are solid choices for most climates and beginners love them. Consider your local frost dates and market demand too. My advice? Start small, see what thrives, then expand. What's your growing zone?""",
-        
-        'soil': """Ah, soil - the foundation of everything! Here's the deal: add 2-3 inches of compost yearly, test your pH (shoot for 6.0-7.0), and use cover crops in the off-season. Mulch helps too. Good soil should feel alive in your hands - dark, crumbly, full of life. Give it some love and it'll give back tenfold!""",
-        
-        'pest': """Pests are frustrating, I get it! Best defense is good offense - use resistant varieties and give plants proper spacing. Check weekly to catch problems early. Ladybugs and lacewings are nature's pest control (and they work for free!). Try neem oil or insecticidal soap before going chemical. What pests are you dealing with?""",
-        
-        'water': """Great question! Water in early morning (6-8 AM) - less evaporation, plants get moisture for the day. Deep watering 2-3 times weekly beats daily sprinkles every time. Stick your finger in the soil 2-3 inches deep - dry? Water it. Mulch is your friend here, saves so much water. What are you growing?""",
-        
-        'fertilizer': """Smart to ask before feeding! Test your soil first - no point adding what you already have. Balanced 10-10-10 works for general feeding. Apply at planting and monthly during growing. Love organic? Try compost, aged manure, or fish emulsion. Remember: more isn't better - over-fertilizing burns plants and pollutes water.""",
-        
-        'plant': """Planting time! Choose healthy transplants or quality seeds. Depth and spacing matter - crowded plants fight for resources. Water well after planting and keep soil moist until they settle in. Mulch helps retain moisture and keeps weeds down. Check on them regularly for pests or diseases. First time planting?""",
-        
-        'weather': """Weather - the thing we can't control but always talk about! Check your local forecast and frost dates before planting. Most crops need consistent temps for germination. Too hot? Provide shade cloth. Too cold? Use row covers or cold frames. What's your weather throwing at you right now?"""
-    }
-    
 
-    for keyword, response in expert_responses.items():
-        if keyword in message_lower:
-            return response
-    
-    return """That's an interesting question! For the most accurate advice for your specific situation, I'd recommend contacting your local agricultural extension office - they know your area's quirks better than anyone. They offer free soil testing too! In the meantime, what specific challenge are you facing? The more details you share, the better I can help!"""
+def get_expert_fallback(user_message):
+    return fallback.matcher.respond(user_message)
 
 
 def login_view(request):
@@ -405,6 +585,7 @@ def logout_view(request):
 def recommendations_view(request):
 
     prediction_result = None
+    recommendation = None
     input_data = {}
     
     if request.method == 'POST':
@@ -432,6 +613,10 @@ def recommendations_view(request):
             ph = float(ph_val)
             rainfall = float(rainfall_val)
             
+            # float() accepts 'inf' and 'nan', which the model can't use
+            if not all(math.isfinite(x) for x in [nitrogen, phosphorus, potassium, temperature, humidity, ph, rainfall]):
+                raise ValueError('Non-finite input')
+            
             # Store input data for display
             input_data = {
                 'nitrogen': nitrogen,
@@ -446,32 +631,11 @@ def recommendations_view(request):
             # Prepare features for prediction
             feature_list = [nitrogen, phosphorus, potassium, temperature, humidity, ph, rainfall]
             
-            # Load the pickle models
-            model_path = os.path.join(os.path.dirname(__file__), 'ml_models', 'model.pkl')
-            scaler_path = os.path.join(os.path.dirname(__file__), 'ml_models', 'standscaler.pkl')
-            minmax_path = os.path.join(os.path.dirname(__file__), 'ml_models', 'minmaxscaler.pkl')
-            
-            model = pickle.load(open(model_path, 'rb'))
-            sc = pickle.load(open(scaler_path, 'rb'))
-            ms = pickle.load(open(minmax_path, 'rb'))
+            # Shared pipeline behind the quantized prediction cache
+            recommendation = cached_recommend_one(feature_list, k=getattr(settings, 'CROPMATE_TOP_K', 3))
+            crop = recommendation['crop']
             
-            # Make prediction
-            single_pred = np.array(feature_list).reshape(1, -1)
-            scaled_features = ms.transform(single_pred)
-            final_features = sc.transform(scaled_features)
-            prediction = model.predict(final_features)
-            
-            # Crop dictionary
-            crop_dict = {
-                1: "Rice", 2: "Maize", 3: "Jute", 4: "Cotton", 5: "Coconut", 
-                6: "Papaya", 7: "Orange", 8: "Apple", 9: "Muskmelon", 10: "Watermelon", 
-                11: "Grapes", 12: "Mango", 13: "Banana", 14: "Pomegranate", 15: "Lentil", 
-                16: "Blackgram", 17: "Mungbean", 18: "Mothbeans", 19: "Pigeonpeas", 
-                20: "Kidneybeans", 21: "Chickpea", 22: "Coffee"
-            }
-            
-            if prediction[0] in crop_dict:
-                crop = crop_dict[prediction[0]]
+            if crop is not None:
                 prediction_result = f"{crop} is the best crop to be cultivated with these conditions"
                 
                 # Save recommendation to database
@@ -484,7 +648,8 @@ def recommendations_view(request):
                     humidity=humidity,
                     ph=ph,
                     rainfall=rainfall,
-                    recommended_crop=crop
+                    recommended_crop=crop,
+                    confidence=recommendation['confidence']
                 )
                 
                 messages.success(request, f'Recommendation: {crop}')
@@ -502,6 +667,7 @@ def recommendations_view(request):
     
     context = {
         'prediction_result': prediction_result,
+        'top_crops': recommendation['top_crops'] if recommendation else [],
         'input_data': input_data,
         'recent_recommendations': recent_recommendations
     }
@@ -509,6 +675,162 @@ def recommendations_view(request):
     return render(request, 'dashboard/recommendations.html', context)
 
 
+def _run_batch_recommendations(user, rows):
+    """
+    Validate, predict and store a batch of soil samples. Invalid rows are
+    reported individually and never abort the rest of the batch.
+    """
+    max_rows = getattr(settings, 'CROPMATE_BATCH_MAX_ROWS', 5000)
+    if len(rows) > max_rows:
+        return JsonResponse({
+            'success': False,
+            'error': f'Too many rows: at most {max_rows} samples per batch.'
+        }, status=400)
+
+    matrix = rows_to_matrix(rows)
+    valid, errors = validate_features(matrix)
+    valid_indices = valid.nonzero()[0]
+    recommendations = get_pipeline().recommend(matrix[valid_indices], k=getattr(settings, 'CROPMATE_TOP_K', 3))
+
+    results = [{'row': i, 'success': False, 'errors': errors.get(i, [])} for i in range(len(rows))]
+    to_create = []
+    for i, recommendation in zip(valid_indices.tolist(), recommendations):
+        crop = recommendation['crop']
+        if crop is None:
+            results[i]['errors'] = ['Could not determine the best crop']
+            continue
+        values = dict(zip(FEATURE_NAMES, matrix[i].tolist()))
+        results[i] = {
+            'row': i,
+            'success': True,
+            'recommended_crop': crop,
+            'confidence': recommendation['confidence'],
+            'top_crops': recommendation['top_crops'],
+            'input': values,
+        }
+        to_create.append(CropRecommendation(
+            user=user, recommended_crop=crop, confidence=recommendation['confidence'], **values
+        ))
+
+    CropRecommendation.objects.bulk_create(to_create)
+
+    return JsonResponse({
+        'success': True,
+        'total': len(rows),
+        'saved': len(to_create),
+        'failed': len(rows) - len(to_create),
+        'results': results,
+    })
+
+
+@login_required
+@require_http_methods(["POST"])
+def recommendations_batch_api(request):
+    """Batch recommendations from a JSON body: {"samples": [{...}, ...]} or a bare list."""
+    try:
+        data = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'success': False, 'error': 'Request body must be valid JSON'}, status=400)
+
+    rows = data.get('samples') if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not rows:
+        return JsonResponse({'success': False, 'error': 'No samples provided'}, status=400)
+
+    return _run_batch_recommendations(request.user, rows)
+
+
+@login_required
+@require_http_methods(["POST"])
+def recommendations_batch_csv(request):
+    """Batch recommendations from an uploaded CSV file with a header row."""
+    upload = request.FILES.get('file')
+    if upload is None:
+        return JsonResponse({'success': False, 'error': 'No CSV file uploaded'}, status=400)
+
+    try:
+        text = io.TextIOWrapper(upload.file, encoding='utf-8-sig')
+        # One row past the limit is enough for _run_batch_recommendations() to reject
+        # the batch; don't parse the rest of an oversized file
+        max_rows = getattr(settings, 'CROPMATE_BATCH_MAX_ROWS', 5000)
+        rows = list(islice(csv.DictReader(text), max_rows + 1))
+    except (UnicodeDecodeError, csv.Error):
+        return JsonResponse({'success': False, 'error': 'File must be a UTF-8 encoded CSV'}, status=400)
+
+    if not rows:
+        return JsonResponse({'success': False, 'error': 'CSV file has no data rows'}, status=400)
+
+    return _run_batch_recommendations(request.user, rows)
+
+
+def _page_size(request):
+    try:
+        limit = int(request.GET.get('limit', history.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = history.DEFAULT_PAGE_SIZE
+    return max(1, min(limit, history.MAX_PAGE_SIZE))
+
+
+@login_required
+def recommendation_history(request):
+    try:
+        recommendations, next_cursor = history.page(request.user, request.GET.get('cursor'), _page_size(request))
+    except history.InvalidCursor:
+        return redirect('dashboard:recommendation_history')
+    return render(request, 'dashboard/recommendation_history.html', {
+        'recommendations': recommendations,
+        'next_cursor': next_cursor,
+        'is_first_page': not request.GET.get('cursor'),
+        'stats': history.aggregates(request.user),
+    })
+
+
+@login_required
+def recommendation_history_api(request):
+    """
+    The user's recommendations, newest first: ?limit=N (at most 100) and
+    ?cursor= from the previous page's next_cursor. ?stats=1 adds per-crop
+    aggregates.
+    """
+    try:
+        recommendations, next_cursor = history.page(request.user, request.GET.get('cursor'), _page_size(request))
+    except history.InvalidCursor as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    data = {
+        'success': True,
+        'results': [history.serialize(r) for r in recommendations],
+        'next_cursor': next_cursor,
+    }
+    if request.GET.get('stats'):
+        data['stats'] = history.aggregates(request.user)
+    return JsonResponse(data)
+
+
+@login_required
+def recommendations_export(request):
+    """
+    Download recommendations as ?format=csv (default) or ndjson, gzipped with
+    ?gzip=1. Staff can export every user's rows with ?all=1.
+    """
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return JsonResponse({'success': False, 'error': 'format must be csv or ndjson'}, status=400)
+    compress = request.GET.get('gzip') == '1'
+
+    queryset = CropRecommendation.objects.all()
+    if not (request.user.is_staff and request.GET.get('all') == '1'):
+        queryset = queryset.filter(user=request.user)
+
+    # Same WSGI/ASGI split as the SSE views: the other kind would be buffered whole
+    generate = export.astream if isinstance(request, ASGIRequest) else export.stream
+    response = StreamingHttpResponse(
+        generate(queryset, fmt, compress),
+        content_type='application/gzip' if compress else export.FORMATS[fmt][0],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{export.filename(fmt, compress)}"'
+    return response
+
+
 @login_required
 def settings_view(request):
   
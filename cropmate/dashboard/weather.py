@@ -0,0 +1,584 @@
+"""
+Open-Meteo weather lookups behind Django's cache framework.
+
+Parsed weather_data/forecast_data for a location are cached for TTL seconds
+and then served stale for up to STALE_TTL more while a single background
+refresh runs. Older entries are kept for DEGRADED_TTL and returned, flagged
+as stale, when the upstream fails or its circuit breaker is open.
+Concurrent misses for the same key share one upstream fetch within a
+process, and a cache.add() lock keeps other processes from stampeding the
+API with the same request.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.template.loader import render_to_string
+
+from . import http_client
+
+logger = logging.getLogger(__name__)
+
+FORECAST_URL = 'https://api.open-meteo.com/v1/forecast'
+# Circuit breaker name for the Open-Meteo API in http_client
+UPSTREAM = 'open-meteo'
+
+CITY_COORDINATES = {
+    'Karachi': {'lat': 24.8607, 'lon': 67.0011},
+    'Lahore': {'lat': 31.5204, 'lon': 74.3587},
+    'Islamabad': {'lat': 33.6844, 'lon': 73.0479},
+    'Rawalpindi': {'lat': 33.5651, 'lon': 73.0169},
+    'Faisalabad': {'lat': 31.4504, 'lon': 73.1350},
+    'Multan': {'lat': 30.1575, 'lon': 71.5249},
+    'Peshawar': {'lat': 34.0151, 'lon': 71.5249},
+    'Quetta': {'lat': 30.1798, 'lon': 66.9750},
+    'Sialkot': {'lat': 32.4945, 'lon': 74.5229},
+    'Gujranwala': {'lat': 32.1877, 'lon': 74.1945},
+    'Bahawalpur': {'lat': 29.3544, 'lon': 71.6911},
+    'Sargodha': {'lat': 32.0836, 'lon': 72.6711},
+    'Hyderabad': {'lat': 25.3792, 'lon': 68.3683},
+    'Sukkur': {'lat': 27.7058, 'lon': 68.8574},
+    'Sahiwal': {'lat': 30.6682, 'lon': 73.1114}
+}
+
+POPULAR_CITIES = list(CITY_COORDINATES)
+
+FORECAST_PARAMS = {
+    'current': 'temperature_2m,relative_humidity_2m,apparent_temperature,precipitation,weather_code,'
+               'cloud_cover,pressure_msl,surface_pressure,wind_speed_10m,wind_direction_10m',
+    'daily': 'weather_code,temperature_2m_max,temperature_2m_min,precipitation_sum,'
+             'precipitation_probability_max,wind_speed_10m_max',
+    'timezone': 'Asia/Karachi',
+    'forecast_days': 7,
+}
+
+
+class WeatherServiceError(Exception):
+    """The upstream weather API answered, but not with usable data."""
+
+
+def _config():
+    config = {
+        'TTL': 600,
+        'STALE_TTL': 3600,
+        'DEGRADED_TTL': 86400,
+        'CACHE_ALIAS': 'default',
+        'TIMEOUT': 5,
+        'LOCK_TIMEOUT': 15,
+        'PREFETCH_INTERVAL': 0,
+        'PREFETCH_WORKERS': 4,
+    }
+    config.update(getattr(settings, 'CROPMATE_WEATHER_CACHE', {}))
+    return config
+
+
+def cache_key(lat, lon, params=FORECAST_PARAMS):
+    fingerprint = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:12]
+    return f'weather:v1:{lat:.4f},{lon:.4f}:{fingerprint}'
+
+
+WEATHER_CONDITIONS = {
+    0: 'Clear', 1: 'Mainly Clear', 2: 'Partly Cloudy', 3: 'Overcast',
+    45: 'Foggy', 48: 'Foggy', 51: 'Drizzle', 53: 'Drizzle', 55: 'Drizzle',
+    61: 'Rain', 63: 'Rain', 65: 'Heavy Rain', 71: 'Snow', 73: 'Snow', 75: 'Snow',
+    77: 'Snow', 80: 'Rain Showers', 81: 'Rain Showers', 82: 'Heavy Rain',
+    85: 'Snow', 86: 'Snow', 95: 'Thunderstorm', 96: 'Thunderstorm', 99: 'Thunderstorm'
+}
+
+WEATHER_DESCRIPTIONS = {
+    0: 'Clear sky', 1: 'Mainly clear', 2: 'Partly cloudy', 3: 'Overcast',
+    45: 'Fog', 48: 'Depositing rime fog', 51: 'Light drizzle', 53: 'Moderate drizzle',
+    55: 'Dense drizzle', 61: 'Slight rain', 63: 'Moderate rain', 65: 'Heavy rain',
+    71: 'Slight snow', 73: 'Moderate snow', 75: 'Heavy snow', 77: 'Snow grains',
+    80: 'Slight rain showers', 81: 'Moderate rain showers', 82: 'Violent rain showers',
+    85: 'Slight snow showers', 86: 'Heavy snow showers', 95: 'Thunderstorm',
+    96: 'Thunderstorm with hail', 99: 'Thunderstorm with heavy hail'
+}
+
+WEATHER_ICONS = {
+    0: '01d', 1: '02d', 2: '03d', 3: '04d',
+    45: '50d', 48: '50d', 51: '09d', 53: '09d', 55: '09d',
+    61: '10d', 63: '10d', 65: '10d', 71: '13d', 73: '13d', 75: '13d',
+    77: '13d', 80: '09d', 81: '09d', 82: '09d',
+    85: '13d', 86: '13d', 95: '11d', 96: '11d', 99: '11d'
+}
+
+WIND_DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                   'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+def get_weather_condition(code):
+    return WEATHER_CONDITIONS.get(code, 'Clear')
+
+
+def get_weather_description(code):
+    return WEATHER_DESCRIPTIONS.get(code, 'Clear sky')
+
+
+def get_weather_icon(code):
+    return WEATHER_ICONS.get(code, '01d')
+
+
+def get_wind_direction(degree):
+    if degree is None:
+        return 'N/A'
+    return WIND_DIRECTIONS[round(degree / 22.5) % 16]
+
+
+def parse_forecast(city, data):
+    """Turn an Open-Meteo forecast payload into the weather_data/forecast_data the page renders."""
+    current = data['current']
+    daily = data['daily']
+
+    weather_data = {
+        'city': city,
+        'country': 'PK',
+        'temp': round(current['temperature_2m'], 1),
+        'feels_like': round(current['apparent_temperature'], 1),
+        'pressure': round(current['pressure_msl'], 0),
+        'humidity': current['relative_humidity_2m'],
+        'visibility': 10,
+        'wind_speed': round(current['wind_speed_10m'], 1),
+        'wind_deg': current['wind_direction_10m'],
+        'wind_dir': get_wind_direction(current['wind_direction_10m']),
+        'clouds': current['cloud_cover'],
+        'condition': get_weather_condition(current['weather_code']),
+        'description': get_weather_description(current['weather_code']),
+        'icon': get_weather_icon(current['weather_code']),
+        'rain_1h': round(current['precipitation'], 1),
+        'dt': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+    forecast_data = []
+    for i, date in enumerate(daily['time'][:7]):
+        day = datetime.strptime(date, '%Y-%m-%d')
+        forecast_data.append({
+            'date': date,
+            'day_name': day.strftime('%A'),
+            'day_short': day.strftime('%a'),
+            'temp_max': round(daily['temperature_2m_max'][i], 1),
+            'temp_min': round(daily['temperature_2m_min'][i], 1),
+            'temp_avg': round((daily['temperature_2m_max'][i] + daily['temperature_2m_min'][i]) / 2, 1),
+            'condition': get_weather_condition(daily['weather_code'][i]),
+            'rain': round(daily['precipitation_sum'][i], 1),
+            'wind_speed_avg': round(daily['wind_speed_10m_max'][i], 1),
+            'humidity_avg': 0,
+            'icon': get_weather_icon(daily['weather_code'][i])
+        })
+
+    precipitation_chart = []
+    for i, day in enumerate(forecast_data):
+        precipitation_chart.append({
+            'time': day['day_short'],
+            'rain': daily['precipitation_sum'][i],
+            'pop': daily['precipitation_probability_max'][i] if daily['precipitation_probability_max'][i] else 0
+        })
+
+    total_rain_week = sum(daily['precipitation_sum'])
+    weather_data['precipitation_chart'] = precipitation_chart
+    weather_data['total_rain_today'] = round(daily['precipitation_sum'][0], 1)
+    weather_data['rain_probability'] = round(daily['precipitation_probability_max'][0], 1) if daily['precipitation_probability_max'][0] else 0
+    weather_data['total_rain_week'] = round(total_rain_week, 1)
+
+    return weather_data, forecast_data
+
+
+def fetch_forecast(city, lat, lon):
+    """Fetch and parse one location from Open-Meteo, bypassing the cache."""
+    params = dict(FORECAST_PARAMS, latitude=lat, longitude=lon)
+    response = http_client.client.get(UPSTREAM, FORECAST_URL, params=params)
+    if response.status_code != 200:
+        raise WeatherServiceError(f'Open-Meteo returned HTTP {response.status_code}')
+    return parse_forecast(city, response.json())
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _single_flight(key, fn, wait_timeout):
+    """Run fn() once per key at a time in this process; concurrent callers share its result."""
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+
+    if not leader:
+        if not call.event.wait(wait_timeout):
+            raise requests.exceptions.Timeout('Timed out waiting for a shared weather fetch')
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        call.event.set()
+
+
+def _store(cache, key, entry):
+    config = _config()
+    cache.set(key, entry, timeout=config['TTL'] + config['STALE_TTL'] + config['DEGRADED_TTL'])
+
+
+def _wait_for_entry(cache, key, newer_than, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None and entry['fetched_at'] > newer_than:
+            return entry
+    return None
+
+
+def refresh(city, lat, lon, newer_than=0.0):
+    """
+    Fetch one location upstream and store it. Callers in this process share
+    one fetch; if another process already holds the fetch lock we wait for
+    its result (an entry fetched after `newer_than`) before fetching ourselves.
+    """
+    config = _config()
+    cache = caches[config['CACHE_ALIAS']]
+    key = cache_key(lat, lon)
+    lock_key = key + ':fetching'
+
+    def fetch():
+        locked = cache.add(lock_key, True, timeout=config['LOCK_TIMEOUT'])
+        try:
+            if not locked:
+                entry = _wait_for_entry(cache, key, newer_than, config['TIMEOUT'])
+                if entry is not None:
+                    return entry
+            weather_data, forecast_data = fetch_forecast(city, lat, lon)
+            entry = {'weather_data': weather_data, 'forecast_data': forecast_data, 'fetched_at': time.time()}
+            _store(cache, key, entry)
+            return entry
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    return _single_flight(key, fetch, wait_timeout=config['TIMEOUT'] * 3)
+
+
+def _refresh_in_background(city, lat, lon, newer_than):
+    key = cache_key(lat, lon)
+    with _inflight_lock:
+        if key in _inflight:
+            return
+
+    def run():
+        try:
+            refresh(city, lat, lon, newer_than)
+        except Exception:
+            logger.warning('Background weather refresh for %s failed', city, exc_info=True)
+
+    threading.Thread(target=run, name=f'weather-refresh-{city}', daemon=True).start()
+
+
+def _degraded(entry, age):
+    return dict(entry, weather_data=dict(entry['weather_data'], stale=True, data_age_minutes=round(age / 60)))
+
+
+def get_entry(city):
+    """
+    The cache entry ({'weather_data', 'forecast_data', 'fetched_at'}) for a
+    city in CITY_COORDINATES, from the cache when possible. If the upstream
+    is down, data older than the stale window is still returned, flagged
+    with weather_data['stale']. Raises KeyError for unknown cities and the
+    upstream's requests or WeatherServiceError exceptions when nothing
+    usable is cached.
+    """
+    coords = CITY_COORDINATES[city]
+    lat, lon = coords['lat'], coords['lon']
+    config = _config()
+    cache = caches[config['CACHE_ALIAS']]
+    entry = cache.get(cache_key(lat, lon))
+
+    if entry is not None:
+        age = time.time() - entry['fetched_at']
+        if age < config['TTL']:
+            return entry
+        if age < config['TTL'] + config['STALE_TTL']:
+            _refresh_in_background(city, lat, lon, newer_than=entry['fetched_at'])
+            return entry
+
+    try:
+        return refresh(city, lat, lon, newer_than=entry['fetched_at'] if entry else 0.0)
+    except (requests.exceptions.RequestException, WeatherServiceError):
+        if entry is None:
+            raise
+        # Last known good data beats an error page while Open-Meteo is down
+        return _degraded(entry, age)
+
+
+def get_weather(city):
+    """Return (weather_data, forecast_data) for a city; see get_entry()."""
+    entry = get_entry(city)
+    return entry['weather_data'], entry['forecast_data']
+
+
+async def afetch_forecast(city, lat, lon):
+    """Async fetch_forecast() over the shared httpx client."""
+    params = dict(FORECAST_PARAMS, latitude=lat, longitude=lon)
+    response = await http_client.client.aget(UPSTREAM, FORECAST_URL, params=params)
+    if response.status_code != 200:
+        raise WeatherServiceError(f'Open-Meteo returned HTTP {response.status_code}')
+    return parse_forecast(city, response.json())
+
+
+# Per event loop: cache key -> Future of the fetch in flight
+_async_inflight = weakref.WeakKeyDictionary()
+
+
+async def arefresh(city, lat, lon, newer_than=0.0):
+    """Async refresh(): one fetch per key per event loop, cache.aadd() lock across processes."""
+    config = _config()
+    cache = caches[config['CACHE_ALIAS']]
+    key = cache_key(lat, lon)
+    lock_key = key + ':fetching'
+    inflight = _async_inflight.setdefault(asyncio.get_running_loop(), {})
+
+    if key in inflight:
+        # shield() so one waiter disconnecting doesn't cancel the fetch for everyone else
+        return await asyncio.shield(inflight[key])
+
+    async def fetch():
+        locked = await cache.aadd(lock_key, True, timeout=config['LOCK_TIMEOUT'])
+        try:
+            if not locked:
+                deadline = time.monotonic() + config['TIMEOUT']
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+                    entry = await cache.aget(key)
+                    if entry is not None and entry['fetched_at'] > newer_than:
+                        return entry
+            weather_data, forecast_data = await afetch_forecast(city, lat, lon)
+            entry = {'weather_data': weather_data, 'forecast_data': forecast_data, 'fetched_at': time.time()}
+            await cache.aset(key, entry, timeout=config['TTL'] + config['STALE_TTL'] + config['DEGRADED_TTL'])
+            return entry
+        finally:
+            if locked:
+                await cache.adelete(lock_key)
+            inflight.pop(key, None)
+
+    inflight[key] = asyncio.ensure_future(fetch())
+    return await asyncio.shield(inflight[key])
+
+
+async def aget_entry(city):
+    """
+    Async get_entry(), with the same caching, staleness and degradation
+    rules. Only worth it on a long-lived event loop (ASGI): the httpx client
+    and in-flight map it uses are per loop.
+    """
+    coords = CITY_COORDINATES[city]
+    lat, lon = coords['lat'], coords['lon']
+    config = _config()
+    cache = caches[config['CACHE_ALIAS']]
+    entry = await cache.aget(cache_key(lat, lon))
+
+    if entry is not None:
+        age = time.time() - entry['fetched_at']
+        if age < config['TTL']:
+            return entry
+        if age < config['TTL'] + config['STALE_TTL']:
+            # A thread outlives the request's event loop, which a task might not
+            _refresh_in_background(city, lat, lon, newer_than=entry['fetched_at'])
+            return entry
+
+    try:
+        return await arefresh(city, lat, lon, newer_than=entry['fetched_at'] if entry else 0.0)
+    except (requests.exceptions.RequestException, WeatherServiceError):
+        if entry is None:
+            raise
+        return _degraded(entry, age)
+
+
+async def aget_weather(city):
+    entry = await aget_entry(city)
+    return entry['weather_data'], entry['forecast_data']
+
+
+def fragment_key(city, stale=False):
+    return f'weather:v1:fragment:{city}' + (':stale' if stale else '')
+
+
+async def arender_fragment(city, entry):
+    """
+    The weather page's forecast markup and chart script for a cache entry.
+    They only change when the forecast does, so they are rendered once per
+    entry['fetched_at'] and shared by every request until the next refresh.
+    A degraded entry has its own fragment, marked as last known data.
+    """
+    config = _config()
+    cache = caches[config['CACHE_ALIAS']]
+    key = fragment_key(city, stale=entry['weather_data'].get('stale', False))
+    fragment = await cache.aget(key)
+    if fragment is not None and fragment['version'] == entry['fetched_at']:
+        return fragment
+
+    weather_data, forecast_data = entry['weather_data'], entry['forecast_data']
+    rendered = {
+        'version': entry['fetched_at'],
+        'forecast': render_to_string('dashboard/weather_forecast.html', {
+            'weather_data': weather_data,
+            'forecast_data': forecast_data,
+        }),
+        'chart': render_to_string('dashboard/weather_chart.html', {
+            'precipitation_chart_json': json.dumps(weather_data.get('precipitation_chart', [])),
+        }),
+    }
+    # Don't let a process still holding an older entry replace a newer fragment
+    if fragment is None or fragment['version'] < rendered['version']:
+        await cache.aset(key, rendered,
+                         timeout=config['TTL'] + config['STALE_TTL'] + config['DEGRADED_TTL'])
+    return rendered
+
+
+PREFETCH_STATUS_KEY = 'weather:v1:prefetch-status'
+
+
+def fetch_forecasts(cities):
+    """Fetch and parse several cities with one multi-location Open-Meteo request."""
+    params = dict(
+        FORECAST_PARAMS,
+        latitude=','.join(str(CITY_COORDINATES[city]['lat']) for city in cities),
+        longitude=','.join(str(CITY_COORDINATES[city]['lon']) for city in cities),
+    )
+    response = http_client.client.get(UPSTREAM, FORECAST_URL, params=params)
+    if response.status_code != 200:
+        raise WeatherServiceError(f'Open-Meteo returned HTTP {response.status_code}')
+    payload = response.json()
+    # A single location comes back as an object, several as a list in request order
+    if isinstance(payload, dict):
+        payload = [payload]
+    if len(payload) != len(cities):
+        raise WeatherServiceError(f'Expected {len(cities)} locations, got {len(payload)}')
+    return {city: parse_forecast(city, data) for city, data in zip(cities, payload)}
+
+
+def prefetch(cities=None, workers=4, multi_location=True):
+    """
+    Refresh the cached forecast of every city, preferably in one upstream
+    request, otherwise with a bounded thread pool. Records and returns a
+    status dict with latency, mode and per-city failures.
+    """
+    cities = list(cities or CITY_COORDINATES)
+    config = _config()
+    cache = caches[config['CACHE_ALIAS']]
+    started = time.perf_counter()
+    results = {}
+    failures = {}
+    mode = 'multi'
+
+    if multi_location:
+        try:
+            results = fetch_forecasts(cities)
+        except (requests.exceptions.RequestException, WeatherServiceError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Multi-location weather fetch failed, falling back to per-city requests: %s', e)
+
+    if not results:
+        mode = 'threads'
+
+        def fetch(city):
+            coords = CITY_COORDINATES[city]
+            return fetch_forecast(city, coords['lat'], coords['lon'])
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='weather-prefetch') as pool:
+            futures = {pool.submit(fetch, city): city for city in cities}
+            for future in as_completed(futures):
+                city = futures[future]
+                try:
+                    results[city] = future.result()
+                except Exception as e:
+                    failures[city] = str(e) or e.__class__.__name__
+
+    fetched_at = time.time()
+    for city, (weather_data, forecast_data) in results.items():
+        coords = CITY_COORDINATES[city]
+        entry = {'weather_data': weather_data, 'forecast_data': forecast_data, 'fetched_at': fetched_at}
+        _store(cache, cache_key(coords['lat'], coords['lon']), entry)
+
+    status = {
+        'finished_at': fetched_at,
+        'latency': time.perf_counter() - started,
+        'mode': mode,
+        'refreshed': len(results),
+        'failures': failures,
+    }
+    cache.set(PREFETCH_STATUS_KEY, status, timeout=None)
+    return status
+
+
+def prefetch_status():
+    """The last prefetch run's status plus the current age in seconds of each city's data."""
+    cache = caches[_config()['CACHE_ALIAS']]
+    keys = {city: cache_key(c['lat'], c['lon']) for city, c in CITY_COORDINATES.items()}
+    entries = cache.get_many(keys.values())
+    now = time.time()
+    ages = {
+        city: now - entries[key]['fetched_at'] if key in entries else None
+        for city, key in keys.items()
+    }
+    return {'last_run': cache.get(PREFETCH_STATUS_KEY), 'ages': ages}
+
+
+def cache_is_shared():
+    """Whether the weather cache is visible to other processes, i.e. not locmem or dummy."""
+    return not isinstance(caches[_config()['CACHE_ALIAS']], (LocMemCache, DummyCache))
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def start_prefetcher(interval=None, workers=None):
+    """
+    Run prefetch() every interval seconds on a daemon thread in this process,
+    for deployments without a shared cache that a prefetch_weather process
+    could fill. Started at most once per process; returns the thread.
+    """
+    global _prefetcher
+    config = _config()
+    interval = interval or config['PREFETCH_INTERVAL']
+    workers = workers or config['PREFETCH_WORKERS']
+
+    def run():
+        while True:
+            started = time.monotonic()
+            try:
+                prefetch(workers=workers)
+            except Exception:
+                logger.warning('In-process weather prefetch failed', exc_info=True)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = threading.Thread(target=run, name='weather-prefetcher', daemon=True)
+            _prefetcher.start()
+    return _prefetcher